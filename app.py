@@ -1,21 +1,81 @@
-from fastapi import FastAPI, Request
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from config.db import _is_testing
+import pymongo.errors as pymongo_exceptions
+from config.db import _is_testing, close_connection_to_mongo, initialize_database, run_in_db_executor
+from config.logs import setup_logging
+from config.main import DB_INIT_RETRY_SECONDS
 from routes.users import router as user_router
 from routes.commands import router as commands_router
 from routes.devices import router as devices_router
+from routes.admin import router as admin_router
+from utils.coalescer import STATUS_COALESCER
+from utils.compression import CompressionMiddleware
+from utils.errors import ServiceUnavailableException
+from utils.metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    METRICS_REGISTRY,
+    RequestMetricsMiddleware,
+    monitor_event_loop_lag,
+    preallocate_route_metrics,
+)
+from utils.request_logging import RequestLoggingMiddleware
+from utils.responses import TimedORJSONResponse
+from utils.server_timing import ServerTimingMiddleware
 import logging
 
-logging.basicConfig(filename='logs.txt',
-                    level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+setup_logging()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Initializes the database in the background once the worker has
+    started (after fork), and closes the client on shutdown. `/ready`
+    fails until the initialization is done.
+    """
+    app.state.ready = False
+    init_task = asyncio.create_task(_initialize_database_until_ready(app))
+    lag_task = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    init_task.cancel()
+    lag_task.cancel()
+    await asyncio.gather(init_task, lag_task, return_exceptions=True)
+    # answer the status updates still buffered before the client goes away
+    await run_in_db_executor(STATUS_COALESCER.stop)
+    # tests share one client between app instances
+    if not _is_testing():
+        await run_in_db_executor(close_connection_to_mongo)
+
+
+async def _initialize_database_until_ready(app: FastAPI) -> None:
+    """
+    Builds the client, warms the pool and verifies the indexes, retrying
+    until the database is reachable, then marks the worker ready.
+    """
+    while True:
+        try:
+            await run_in_db_executor(initialize_database)
+            break
+        except pymongo_exceptions.PyMongoError as error:
+            logging.error(
+                f"database initialization failed, retrying in {DB_INIT_RETRY_SECONDS}s: {error}")
+            await asyncio.sleep(DB_INIT_RETRY_SECONDS)
+
+    app.state.ready = True
+    logging.info("database initialized, worker ready")
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedORJSONResponse)
+app.state.ready = False
 
 app.include_router(user_router)
 app.include_router(commands_router)
 app.include_router(devices_router)
+app.include_router(admin_router)
 
 # test hello
 
@@ -25,15 +85,28 @@ async def root():
     return {"message": "Hello, TEST NEW!"}
 
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
+@app.get("/ready", summary="Readiness probe", status_code=200)
+async def ready():
+    """
+    Fails with a 503 until the worker has finished initializing the database.
+    """
+    if not app.state.ready:
+        raise ServiceUnavailableException(
+            detail="Database initialization in progress")
+    return {"ready": True}
+
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+async def metrics():
     """
-    Middleware that logs incoming and outgoing requests.
+    Metrics of this worker in the Prometheus text format.
     """
-    logging.info(f"Incoming request: {request.method} {request.url}")
-    response = await call_next(request)
-    logging.info(f"Outgoing response: {response.status_code}")
-    return response
+    return PlainTextResponse(METRICS_REGISTRY.render(),
+                             media_type=METRICS_CONTENT_TYPE)
+
+
+preallocate_route_metrics(app.routes)
+
 
 origins = [
     "http://localhost:5173",
@@ -73,3 +146,12 @@ app.add_middleware(CORSMiddleware,
 app.add_middleware(
     TrustedHostMiddleware,
     allowed_hosts=ALLOWED_HOSTS if not _is_testing() else ["*"],)
+
+# inside the request logging middleware, whose request context it reads
+app.add_middleware(ServerTimingMiddleware)
+# added last so it wraps everything, including the CORS headers
+app.add_middleware(CompressionMiddleware)
+# same span as the request log, counting requests rejected further in
+app.add_middleware(RequestMetricsMiddleware)
+# outermost, so the logged latency covers every other middleware
+app.add_middleware(RequestLoggingMiddleware)
@@ -6,15 +6,40 @@ this ensures that we have a single source of truth in regards to transactions
 as well as making sure that we never accidentally swap from the production
 database to the testing database.
 """
-from dataclasses import dataclass
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
 import logging
 import os
+import threading
+import time
 from uuid import uuid4
-from typing import Dict, Any, Optional
-from pymongo import MongoClient, IndexModel
+from typing import Dict, Any, Callable, Optional
+from pymongo import MongoClient
 from pymongo.collection import Collection
 import pymongo.errors as pymongo_exceptions
-from config.main import DB_URI, USERS_COLLECTION_NAME, COMMANDS_COLLECTION_NAME, DEVICES_COLLECTION_NAME
+from config.main import (
+    DB_URI,
+    DB_EXECUTOR_WORKERS,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_POOL_WARMUP_TIMEOUT_SECONDS,
+    USERS_COLLECTION_NAME,
+    COMMANDS_COLLECTION_NAME,
+    DEVICES_COLLECTION_NAME,
+)
+from config.indexes import INDEX_REGISTRY, IndexDrift, get_collection_index_drift
+from config.pool import POOL_METRICS
+from config.memory_db import MemoryClient
+from utils.metrics import MONGO_COMMAND_METRICS
+from utils.request_context import record_db_call
+from utils.slow_queries import SLOW_QUERY_LOG
+
+# DB_URI scheme that runs the app on the in-memory engine, without a mongod
+IN_MEMORY_DB_URI_SCHEME = "memory://"
 
 
 def get_users_collection() -> Collection:
@@ -47,6 +72,99 @@ def get_devices_collection() -> Collection:
     return devices_collection
 
 
+def get_async_users_collection() -> "AsyncCollection":
+    """
+    awaitable handle alias for users collection
+    """
+    return AsyncCollection(get_users_collection())
+
+
+def get_async_commands_collection() -> "AsyncCollection":
+    """
+    awaitable handle alias for commands collection
+    """
+    return AsyncCollection(get_commands_collection())
+
+
+def get_async_devices_collection() -> "AsyncCollection":
+    """
+    awaitable handle alias for devices collection
+    """
+    return AsyncCollection(get_devices_collection())
+
+
+# blocking driver calls made on behalf of async code all run here, so the
+# event loop never waits on the network
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS,
+                                 thread_name_prefix="db")
+
+
+async def run_in_db_executor(func: Callable, *args, **kwargs) -> Any:
+    """
+    Runs a blocking database call on the db executor and awaits its result,
+    adding the time spent waiting to the current request's db time.
+
+    The call runs in a copy of the caller's context, so the command
+    listeners can tell which request issued a command.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(
+            DB_EXECUTOR, functools.partial(context.run, func, *args, **kwargs))
+    finally:
+        record_db_call(time.perf_counter() - started)
+
+
+class AsyncCollection:
+    """
+    Awaitable facade over a pymongo `Collection`.
+
+    Every operation runs the blocking call on `DB_EXECUTOR`, which is how
+    motor works internally as well. Unlike a motor client it isn't tied to
+    a single event loop, and it wraps whatever `get_*_collection` returns,
+    so the mock database and patched collections keep working.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await run_in_db_executor(self.collection.find_one, *args, **kwargs)
+
+    async def find_to_list(self, *args, **kwargs) -> list[Dict[str, Any]]:
+        """
+        Runs `find` and drains the cursor, returning every document.
+        Takes the same arguments as `Collection.find` (including
+        `sort` and `limit`).
+        """
+        def _find_to_list():
+            return list(self.collection.find(*args, **kwargs))
+        return await run_in_db_executor(_find_to_list)
+
+    async def insert_one(self, *args, **kwargs):
+        return await run_in_db_executor(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await run_in_db_executor(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await run_in_db_executor(self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await run_in_db_executor(self.collection.update_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await run_in_db_executor(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await run_in_db_executor(self.collection.bulk_write, *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs) -> int:
+        return await run_in_db_executor(self.collection.count_documents, *args, **kwargs)
+
+
 def get_database() -> MongoClient:
     """
     Returns a valid client to the database.
@@ -66,6 +184,63 @@ def close_connection_to_mongo() -> None:
     db_instance.close_client_connection()
 
 
+def initialize_database() -> Dict[str, IndexDrift]:
+    """
+    Eagerly builds the database instance, warms its connection pool and
+    brings the indexes in line with the registry, returning the drift found.
+
+    Meant to run once per worker at startup, after fork, so no request
+    pays for client creation or index checks.
+    """
+    global GLOBAL_DATABASE_INSTANCE
+    with GLOBAL_DATABASE_LOCK:
+        if not __check_global_db_already_exists():
+            GLOBAL_DATABASE_INSTANCE = _new_database_instance(
+                setup_indexes=False)
+    db_instance = _get_global_database_instance()
+
+    if not _is_testing():
+        if db_instance.warm_connection_pool():
+            logging.info(f"mongo connection pool warmed: {get_pool_stats()}")
+        else:
+            logging.warning(
+                f"mongo connection pool not fully warmed: {get_pool_stats()}")
+
+    return db_instance.repair_index_drift()
+
+
+def warm_connection_pool() -> bool:
+    """
+    Public facing method for opening the minimum pool connections up front
+    """
+    db_instance = _get_global_database_instance()
+    return db_instance.warm_connection_pool()
+
+
+def get_pool_stats() -> Dict[str, float]:
+    """
+    Public facing method for reading the connection pool gauges
+    """
+    return POOL_METRICS.snapshot()
+
+
+def get_index_drift() -> Dict[str, IndexDrift]:
+    """
+    Public facing method for diffing the index registry against the database
+    """
+    db_instance = _get_global_database_instance()
+    return db_instance.get_index_drift()
+
+
+def repair_index_drift() -> Dict[str, IndexDrift]:
+    """
+    Public facing method for creating the registry indexes missing from
+    the database
+    """
+    db_instance = _get_global_database_instance()
+    return db_instance.repair_index_drift()
+
+
 def get_database_client_name() -> str:
     """
     Returns the name of the database singleton.
@@ -105,6 +280,14 @@ def _is_testing_with_mock() -> bool:
     return os.environ.get("_called_from_test_with_mock") == "True"
 
 
+def _is_in_memory() -> bool:
+    """
+    Whether the database is the in-memory engine instead of a mongod,
+    either for tests or because DB_URI uses the `memory://` scheme.
+    """
+    return _is_testing_with_mock() or DB_URI.startswith(IN_MEMORY_DB_URI_SCHEME)
+
+
 def _get_database_name_str() -> str:
     """
     Dynamically return the name of the current database.
@@ -147,13 +330,28 @@ class Database:
     Utility class that holds the main database client instance.
     """
 
-    def __init__(self):
+    def __init__(self, setup_indexes: bool = True):
         """
         Creates a Database instance with a MongoClient set to the global DB_URI.
+
+        `setup_indexes=False` leaves the indexes to the caller.
         """
-        self.client = MongoClient(DB_URI)
+        self.client = self._create_client()
         self.database_name = _get_database_name_str()
-        self.__setup_database_indexes()
+        if setup_indexes:
+            self.__setup_database_indexes()
+
+    def _create_client(self) -> MongoClient:
+        """
+        Builds the pooled client for the global DB_URI.
+        """
+        return MongoClient(
+            DB_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            event_listeners=[POOL_METRICS, MONGO_COMMAND_METRICS, SLOW_QUERY_LOG])
 
     def set_and_make_test_db(self):
         """
@@ -175,6 +373,20 @@ class Database:
         """
         self.client.close()
 
+    def warm_connection_pool(self) -> bool:
+        """
+        Connects to the server and waits for the pool to hold
+        `MONGO_MIN_POOL_SIZE` connections, so the first requests don't
+        pay for the handshakes.
+
+        pymongo's background maintenance fills the pool up to
+        minPoolSize once a server is selected; the ping selects it.
+        Returns whether the pool was filled before the warmup timeout.
+        """
+        self.client.admin.command("ping")
+        return POOL_METRICS.wait_for_open_connections(
+            MONGO_MIN_POOL_SIZE, MONGO_POOL_WARMUP_TIMEOUT_SECONDS)
+
     def get_database_name(self) -> str:
         """
         Get the mongo client's current database name
@@ -218,85 +430,76 @@ class Database:
         """
         return "test" in self.database_name and _is_testing()
 
-    def __setup_database_indexes(self) -> None:
+    def get_index_drift(self) -> Dict[str, IndexDrift]:
         """
-        Sets up the database indexes for the unique fields.
+        Diffs the index registry against the indexes present in the
+        current database, returning the drift keyed by collection name.
+        """
+        db_instance = self.client[self.database_name]
+        return {
+            collection_name: get_collection_index_drift(
+                index_models, db_instance[collection_name].index_information())
+            for collection_name, index_models in INDEX_REGISTRY.items()
+        }
+
+    def repair_index_drift(self) -> Dict[str, IndexDrift]:
+        """
+        Creates every registry index that is missing from the database.
 
-        If the indexes are set up already, does nothing, making
-        it safe to call multiple times.
+        Indexes that exist with different keys or options are only
+        reported, since fixing them means dropping an index.
+        Returns the drift found before repairing.
         """
-        indexes_dict = self.__get_index_command_dict()
         db_instance = self.client[self.database_name]
+        drift_dict = self.get_index_drift()
 
-        indexes_already_setup = self.__check_indexes_already_exist()
+        for collection_name, drift in drift_dict.items():
+            if drift.missing:
+                db_instance[collection_name].create_indexes(drift.missing)
+            if drift.changed:
+                logging.warning(
+                    f"indexes on {collection_name} differ from the registry: {drift.changed}")
 
-        if not indexes_already_setup:
-            for collection_name, index_models in indexes_dict.items():
-                db_instance[collection_name].create_indexes(index_models)
+        return drift_dict
 
-    def __get_index_command_dict(self) -> Dict[str, IndexModel]:  # pylint: disable=no-self-use
+    def __setup_database_indexes(self) -> None:
         """
-        Returns a dict with all of the collection names as keys and
-        their corresponding IndexModel.
+        Sets up the registry indexes that are missing from the database.
 
-        Can be iterated over to insert the correct indexes into the collections.
+        Safe to call multiple times. Outside of tests the indexes are
+        built on a background thread so startup doesn't wait on them.
         """
+        if _is_testing():
+            self.repair_index_drift()
+            return
 
-        indexes_dict = {
-            "members": [IndexModel("email", unique=True)],
-        }
-
-        return indexes_dict
+        threading.Thread(target=self.__repair_index_drift_and_log,
+                         name="index-setup",
+                         daemon=True).start()
 
-    def __check_indexes_already_exist(self) -> bool:
+    def __repair_index_drift_and_log(self) -> None:
         """
-        Uses the database instance to check if all of the collection
-        indexes have been created
+        Background thread target for `repair_index_drift`.
         """
-        db_instance = self.client[self.database_name]
-        master_indexes_dict = self.__get_master_dict_of_indexes()
-
         try:
-            for collection_name, index_dict in master_indexes_dict.items():
-                db_collection = db_instance[collection_name]
-                indexes_match = db_collection.index_information() == index_dict
-                assert indexes_match
-            return True
-        except AssertionError:
-            return False
-
-    def __get_master_dict_of_indexes(self) -> Dict[str, Any]:  # pylint: disable=no-self-use
-        """
-        Returns the dict object with all of the indexes that should be
-        in the collections.
-
-        Keys for the dict are collection names, and the values are
-        their indexes.
-
-        Used to verify that the indexes present in the database are
-        valid and match the spec.
-        """
-
-        indexes_dict = {
-            "members": {
-                '_id_': {
-                    'v': 2,
-                    'key': [('_id', 1)]
-                },
-                'email_1': {
-                    'v': 2,
-                    'unique': True,
-                    'key': [('email', 1)]
-                }
-            },
-        }
+            drift_dict = self.repair_index_drift()
+        except pymongo_exceptions.PyMongoError as error:
+            logging.error(f"failed to set up database indexes: {error}")
+            return
 
-        return indexes_dict
+        for collection_name, drift in drift_dict.items():
+            if drift.missing:
+                names = [x.document["name"] for x in drift.missing]
+                logging.info(
+                    f"created missing indexes on {collection_name}: {names}")
 
 
 # enforces singleton pattern behind the scenes
 # must start uninstanciated so the env vars can load in prior
 GLOBAL_DATABASE_INSTANCE = None
+# guards the creation of the instance, which can race between db executor
+# threads and the startup initialization
+GLOBAL_DATABASE_LOCK = threading.Lock()
 
 
 def _uninstanciate_global_db_instance():
@@ -304,6 +507,15 @@ def _uninstanciate_global_db_instance():
     GLOBAL_DATABASE_INSTANCE = None
 
 
+def _new_database_instance(setup_indexes: bool = True) -> "Database":
+    """
+    Creates the database instance matching the environment.
+    """
+    if _is_in_memory():
+        return MockDatabase(setup_indexes=setup_indexes)
+    return Database(setup_indexes=setup_indexes)
+
+
 def _get_global_database_instance(test: Optional[bool] = None) -> Database:
     """
     Primitive and dangerous method to get the database instance
@@ -314,14 +526,13 @@ def _get_global_database_instance(test: Optional[bool] = None) -> Database:
     if test and test is True:
         global IS_TESTING_GLOB
         IS_TESTING_GLOB = True
-    if _is_testing_with_mock():
-        return MockDatabase()
-
     database_already_instanciated = __check_global_db_already_exists()
 
     global GLOBAL_DATABASE_INSTANCE
     if not database_already_instanciated:
-        GLOBAL_DATABASE_INSTANCE = Database()
+        with GLOBAL_DATABASE_LOCK:
+            if not __check_global_db_already_exists():
+                GLOBAL_DATABASE_INSTANCE = _new_database_instance()
 
     if database_already_instanciated and IS_TESTING_GLOB and GLOBAL_DATABASE_INSTANCE._check_current_db_is_for_testing() is False:
         GLOBAL_DATABASE_INSTANCE.set_and_make_test_db()
@@ -329,111 +540,22 @@ def _get_global_database_instance(test: Optional[bool] = None) -> Database:
     return GLOBAL_DATABASE_INSTANCE
 
 
-@dataclass
-class MockResponse:
-    inserted_id: str
-    modified_count: Optional[int]
-
-
-class MockCollection:
-    def __init__(self, collection_name: str):
-        self.collection_name = collection_name
-        self.mapping = {}
-
-    def insert_one(self, data: dict[str, Any]) -> MockResponse:
-        # do not allow dupes
-        if self.collection_name == USERS_COLLECTION_NAME:
-            if self.mapping.get(data.get("email")):
-                raise pymongo_exceptions.DuplicateKeyError(
-                    "Duplicate key error")
-        if self.mapping.get(data.get("_id")):
-            raise pymongo_exceptions.DuplicateKeyError("Duplicate key error")
-
-        if self.collection_name == USERS_COLLECTION_NAME:
-            self.mapping[data.get("email")] = data
-        else:
-            self.mapping[data.get("_id")] = data
-        return MockResponse(inserted_id=data.get("_id"))
-
-    def find_one(self, data: dict[str, Any]) -> dict[str, Any]:
-        if self.collection_name == USERS_COLLECTION_NAME:
-            resp = self.mapping.get(data.get("email"))
-        else:
-            resp = self.mapping.get(data.get("_id"))
-
-        if resp == {}:
-            return None
-        return resp
-
-    def update_one(self, data: dict[str, Any],
-                   update: dict[str, Any]) -> MockResponse:
-        if self.collection_name == USERS_COLLECTION_NAME:
-            self.mapping[data.get("email")] = update
-        else:
-            self.mapping[data.get("_id")] = update
-
-        return MockResponse(inserted_id="", modified_count=1)
-
-    def __repr__(self) -> str:
-        return str(self.mapping)
-
-
-class MockMongoClient:
-    def __init__(self, db_name: str):
-        self.inner = None
-        self._setup_dict(db_name)
-
-    def _setup_dict(self, db_name: str):
-        self.inner = {
-            db_name: {
-                USERS_COLLECTION_NAME: MockCollection(USERS_COLLECTION_NAME),
-                DEVICES_COLLECTION_NAME: MockCollection(DEVICES_COLLECTION_NAME),
-                COMMANDS_COLLECTION_NAME: MockCollection(
-                    COMMANDS_COLLECTION_NAME)
-            }
-        }
-
-    def get_client(self) -> dict[str, Any]:
-        return self.inner
-
-    def close(self):
-        pass
-
-
-class MockDatabase:
-    def __init__(self):
-        self.database_name = _get_database_name_str()
-        self.client = MockMongoClient(self.database_name)
-
-    def get_database_client(self) -> MockMongoClient:
-        """
-        Returns the instance's db client.
-        """
-        return self.client.get_client()
-
-    def get_database_name(self) -> str:
-        """
-        Get the mongo client's current database name
-        """
-        return self.database_name
+class MockDatabase(Database):
+    """
+    `Database` backed by the in-memory engine in `config/memory_db.py`
+    instead of a mongod, used when testing with the mock and for
+    `memory://` URIs. One instance lives for the whole process, so its
+    state persists across requests.
+    """
 
-    def delete_test_database(self) -> None:
-        """
-        Deletes the current testing database.
+    def _create_client(self) -> MemoryClient:
+        return MemoryClient()
 
-        Will never delete the production database, even if it
-        is the current database being used.
-        """
-        return
-
-    def close_client_connection(self) -> None:
+    def warm_connection_pool(self) -> bool:
         """
-        Closes the client's connection to mongo.
+        The in-memory client has no pool to warm.
         """
-        self.client.close()
-
-    def clear_test_collections(self) -> None:
-        pass
+        return True
 
 
 def __check_global_db_already_exists() -> bool:  # pylint: disable=invalid-name
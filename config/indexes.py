@@ -0,0 +1,89 @@
+"""
+Declarative registry of every index the application relies on.
+
+Each query issued by the routes and `utils/*` helpers should be backed by
+one of the indexes below; the database setup diffs this registry against
+`index_information()` on startup and creates whatever is missing.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict
+from pymongo import ASCENDING, IndexModel
+from config.main import USERS_COLLECTION_NAME, COMMANDS_COLLECTION_NAME, DEVICES_COLLECTION_NAME
+
+INDEX_REGISTRY: Dict[str, list[IndexModel]] = {
+    USERS_COLLECTION_NAME: [
+        # login/registration lookups by email, duplicate email guard
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    COMMANDS_COLLECTION_NAME: [
+        # /recent, /claim, device channel: pending commands oldest-first
+        IndexModel([("device_id", ASCENDING), ("status", ASCENDING),
+                    ("created_at", ASCENDING), ("_id", ASCENDING)]),
+        # /batch/get/all: keyset pages over a device's history
+        IndexModel([("device_id", ASCENDING), ("created_at", ASCENDING),
+                    ("_id", ASCENDING)]),
+    ],
+    DEVICES_COLLECTION_NAME: [
+        # /devices/get/all, and covers its ETag check (ids and versions)
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING),
+                    ("version", ASCENDING)]),
+    ],
+}
+
+# index options that change the behaviour of an index, compared when
+# checking an existing index against the registry
+COMPARED_INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression",
+                          "expireAfterSeconds")
+
+
+@dataclass
+class IndexDrift:
+    """
+    Difference between the registry and the indexes present on a collection.
+
+    `missing` indexes can be created safely, `changed` ones share a name
+    with a registry entry but differ in keys or options and need a manual
+    drop, and `extra` ones aren't in the registry at all.
+    """
+    missing: list[IndexModel] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    extra: list[str] = field(default_factory=list)
+
+    def has_drift(self) -> bool:
+        return bool(self.missing or self.changed or self.extra)
+
+
+def get_collection_index_drift(index_models: list[IndexModel],
+                               index_information: Dict[str, Any]) -> IndexDrift:
+    """
+    Diffs the registry entries for one collection against the output
+    of that collection's `index_information()`.
+    """
+    drift = IndexDrift()
+    expected_names = set()
+
+    for index_model in index_models:
+        spec = index_model.document
+        name = spec["name"]
+        expected_names.add(name)
+        existing = index_information.get(name)
+
+        if existing is None:
+            drift.missing.append(index_model)
+        elif not _index_matches_spec(spec, existing):
+            drift.changed.append(name)
+
+    drift.extra = [name for name in index_information
+                   if name != "_id_" and name not in expected_names]
+    return drift
+
+
+def _index_matches_spec(spec: Dict[str, Any], existing: Dict[str, Any]) -> bool:
+    """
+    Checks the keys and behaviour-changing options of an existing index
+    against its registry spec.
+    """
+    if list(spec["key"].items()) != [tuple(x) for x in existing["key"]]:
+        return False
+    return all(spec.get(option) == existing.get(option)
+               for option in COMPARED_INDEX_OPTIONS)
@@ -0,0 +1,134 @@
+"""
+Non-blocking, structured logging.
+
+`setup_logging` points the root logger at a `DroppingQueueHandler`: callers
+(the event loop included) only put the record on a bounded in-memory queue,
+and a `QueueListener` thread formats it as a JSON line and writes it to a
+size-rotated file. When the writer falls behind, say on a slow disk, records
+are dropped and counted instead of making requests wait.
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+import orjson
+
+from config.main import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_QUEUE_SIZE
+
+# attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    "", logging.INFO, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object: timestamp, level, logger, message,
+    the fields passed through `extra`, and the traceback, if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                line[key] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exc_info"] = record.exc_text
+        return orjson.dumps(line, default=str).decode()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    `QueueHandler` that drops records when the queue is full rather than
+    blocking or reporting an error for each of them.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.lock_dropped = threading.Lock()
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock_dropped:
+                self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Merges the message arguments and renders the traceback while they
+        are still current, leaving the formatting to the writer thread.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+_LISTENER: Optional[logging.handlers.QueueListener] = None
+_QUEUE_HANDLER: Optional[DroppingQueueHandler] = None
+_SETUP_LOCK = threading.Lock()
+
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """
+    Routes the root logger through the queue and starts the writer
+    thread, which is drained and stopped at exit. Safe to call more than
+    once.
+    """
+    global _LISTENER, _QUEUE_HANDLER
+    with _SETUP_LOCK:
+        if _LISTENER is not None:
+            return
+
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8", delay=True)
+        file_handler.setFormatter(JsonFormatter())
+
+        _QUEUE_HANDLER = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _LISTENER = logging.handlers.QueueListener(
+            _QUEUE_HANDLER.queue, file_handler, respect_handler_level=True)
+        _LISTENER.start()
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(_QUEUE_HANDLER)
+        atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """
+    Writes out the queued records and stops the writer thread.
+    """
+    global _LISTENER, _QUEUE_HANDLER
+    with _SETUP_LOCK:
+        if _LISTENER is None:
+            return
+        logging.getLogger().removeHandler(_QUEUE_HANDLER)
+        _LISTENER.stop()
+        _LISTENER, _QUEUE_HANDLER = None, None
+
+
+def get_dropped_log_records() -> int:
+    """
+    Number of records dropped because the writer fell behind.
+    """
+    handler = _QUEUE_HANDLER
+    return handler.dropped if handler is not None else 0
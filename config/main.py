@@ -25,3 +25,105 @@ if not JWT_SECRET_KEY:
     raise Exception("Key Error: JWT_SECRET_KEY not set!")
 
 JWT_EXPIRY_TIME = 3000
+
+# lifetime of the device tokens minted at device registration, in days
+DEVICE_TOKEN_EXPIRY_DAYS = int(os.environ.get("DEVICE_TOKEN_EXPIRY_DAYS", 365))
+
+# upper bound on how long a long-poll request may be parked, in seconds
+LONG_POLL_MAX_WAIT_SECONDS = float(
+    os.environ.get("LONG_POLL_MAX_WAIT_SECONDS", 30))
+
+# device WebSocket channel limits
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 100))
+WS_PING_INTERVAL_SECONDS = float(
+    os.environ.get("WS_PING_INTERVAL_SECONDS", 20))
+WS_PING_TIMEOUT_SECONDS = float(os.environ.get("WS_PING_TIMEOUT_SECONDS", 10))
+
+# most pending commands a device can claim in a single request
+CLAIM_COMMANDS_MAX_LIMIT = int(os.environ.get("CLAIM_COMMANDS_MAX_LIMIT", 100))
+
+# most status transitions accepted by a single bulk update request
+BULK_STATUS_MAX_UPDATES = int(os.environ.get("BULK_STATUS_MAX_UPDATES", 1000))
+
+# write-behind coalescing of single status updates: how long updates are
+# buffered before being flushed together (0 disables coalescing), and the
+# batch size that triggers an early flush
+COMMAND_STATUS_COALESCE_WINDOW_MS = float(
+    os.environ.get("COMMAND_STATUS_COALESCE_WINDOW_MS", 0))
+COMMAND_STATUS_COALESCE_MAX_BATCH = int(
+    os.environ.get("COMMAND_STATUS_COALESCE_MAX_BATCH", 1000))
+
+# commands written per insert_many call when creating batch commands
+BATCH_INSERT_CHUNK_SIZE = int(os.environ.get("BATCH_INSERT_CHUNK_SIZE", 1000))
+
+# page sizes for GET /commands/batch/get/all
+COMMANDS_PAGE_DEFAULT_LIMIT = int(
+    os.environ.get("COMMANDS_PAGE_DEFAULT_LIMIT", 100))
+COMMANDS_PAGE_MAX_LIMIT = int(os.environ.get("COMMANDS_PAGE_MAX_LIMIT", 1000))
+
+# number of recent command ids kept on each device document; trimming drops
+# the older ids for good, so it is off (0, keeps all) unless configured
+DEVICE_COMMAND_HISTORY_LIMIT = int(
+    os.environ.get("DEVICE_COMMAND_HISTORY_LIMIT", 0))
+
+# threads running blocking Mongo calls on behalf of async request handlers
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", 32))
+
+# Mongo connection pool; a wait queue timeout of 0 waits forever. Keep the
+# max pool size at or above DB_EXECUTOR_WORKERS so the executor never starves
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 10))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(
+    os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+
+# how long startup waits for MONGO_MIN_POOL_SIZE connections to open
+MONGO_POOL_WARMUP_TIMEOUT_SECONDS = float(
+    os.environ.get("MONGO_POOL_WARMUP_TIMEOUT_SECONDS", 10))
+
+# number of already-verified JWTs whose claims are kept in memory
+JWT_CLAIMS_CACHE_SIZE = int(os.environ.get("JWT_CLAIMS_CACHE_SIZE", 10000))
+
+# per-process cache of authenticated user principals
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL_SECONDS = float(
+    os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", 60))
+
+# bcrypt executor: worker threads, extra queued jobs admitted, and how long
+# a queued job may wait for a worker before the request gets a 503
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", 4))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", 64))
+HASH_QUEUE_TIMEOUT_SECONDS = float(
+    os.environ.get("HASH_QUEUE_TIMEOUT_SECONDS", 2))
+
+# response compression: smallest body worth compressing, gzip level and
+# brotli quality (brotli is used only if the package is installed), and the
+# chunk size above which compression moves off the event loop
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", 1024))
+GZIP_COMPRESS_LEVEL = int(os.environ.get("GZIP_COMPRESS_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 4))
+COMPRESSION_OFFLOAD_SIZE = int(
+    os.environ.get("COMPRESSION_OFFLOAD_SIZE", 256 * 1024))
+
+# structured request log: file, size-based rotation, records buffered for
+# the writer thread before new ones get dropped, and the share of
+# successful agent polls (/commands/recent, /commands/claim) that is logged
+LOG_FILE = os.environ.get("LOG_FILE", "logs.txt")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+AGENT_POLL_LOG_SAMPLE_RATE = float(
+    os.environ.get("AGENT_POLL_LOG_SAMPLE_RATE", 0.01))
+
+# seconds between wake-ups of the event loop lag monitor behind /metrics
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(
+    os.environ.get("EVENT_LOOP_LAG_INTERVAL_SECONDS", 0.5))
+
+# Mongo operations at least this slow go to the slow-query log, which keeps
+# the latest SLOW_QUERY_LOG_SIZE of them (see /admin/slow-queries)
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", 100))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", 200))
+
+# seconds between attempts to initialize the database at startup
+DB_INIT_RETRY_SECONDS = float(os.environ.get("DB_INIT_RETRY_SECONDS", 5))
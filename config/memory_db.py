@@ -0,0 +1,1282 @@
+"""
+In-memory stand-in for the parts of the pymongo client API the app uses.
+
+`MemoryClient` mirrors `MongoClient` closely enough for every accessor in
+`config/db.py`, so routes, utils and tests run unchanged against it: query
+operators (`$in`, `$or`, ranges, `$exists`, ...), sort/skip/limit cursors,
+projections, the usual update operators including `$push` with
+`$each`/`$slice`, `find_one_and_update`, `insert_many` and `bulk_write` with
+pymongo's result and error types, and unique and secondary indexes.
+
+Documents are copied on the way in and out, so callers can't mutate stored
+state. Every collection is guarded by its own lock, making it safe to use
+from the db executor threads. State lives as long as the client, which the
+mock database keeps for the whole process.
+"""
+from collections.abc import Mapping
+import datetime
+import itertools
+import re
+import threading
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from bson.objectid import ObjectId
+from pymongo import (
+    ASCENDING,
+    DeleteMany,
+    DeleteOne,
+    IndexModel,
+    InsertOne,
+    ReplaceOne,
+    ReturnDocument,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, WriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+BAD_VALUE_ERROR_CODE = 2
+IMMUTABLE_FIELD_ERROR_CODE = 66
+
+ID_INDEX_NAME = "_id_"
+
+# missing values, so that `{field: None}` and sparse indexes behave
+# like mongo's
+_MISSING = object()
+
+
+def _clone(value: Any) -> Any:
+    """
+    Copies the mutable containers of a document; scalars are immutable.
+    """
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _hashable(value: Any) -> Any:
+    """
+    Hashable stand-in for a document value, used as an index key.
+    Booleans are kept apart from the numbers they hash equal to.
+    """
+    if isinstance(value, dict):
+        return ("dict", tuple((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ("list", tuple(_hashable(v) for v in value))
+    if isinstance(value, bool):
+        return ("bool", value)
+    return value
+
+
+def _type_rank(value: Any) -> int:
+    """
+    Position of the value's type in mongo's cross-type comparison order.
+    """
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _compare(a: Any, b: Any) -> int:
+    """
+    Three-way comparison following mongo's ordering across types.
+    """
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a == 1:
+        return 0
+    if isinstance(a, dict):
+        return _compare(list(a.items()), list(b.items()))
+    if isinstance(a, (list, tuple)):
+        for x, y in zip(a, b):
+            result = _compare(x, y)
+            if result:
+                return result
+        return (len(a) > len(b)) - (len(a) < len(b))
+    return (a > b) - (a < b)
+
+
+def _values_equal(a: Any, b: Any) -> bool:
+    return _type_rank(a) == _type_rank(b) and _compare(a, b) == 0
+
+
+class _SortKey:
+    """
+    Sort key over several fields with per-field directions.
+    """
+    __slots__ = ("values", "directions")
+
+    def __init__(self, values: list, directions: list):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other: "_SortKey") -> bool:
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            result = _compare(a, b)
+            if result:
+                return result * direction < 0
+        return False
+
+
+def _get_path_values(value: Any, parts: list[str]) -> list[Any]:
+    """
+    Every value reached by following the dotted path, descending into
+    arrays the way mongo does. An empty list means the path is missing.
+    """
+    if not parts:
+        return [value]
+    part, rest = parts[0], parts[1:]
+
+    if isinstance(value, dict):
+        if part not in value:
+            return []
+        return _get_path_values(value[part], rest)
+
+    if isinstance(value, list):
+        if part.isdigit():
+            index = int(part)
+            if index < len(value):
+                return _get_path_values(value[index], rest)
+            return []
+        found = []
+        for element in value:
+            if isinstance(element, dict):
+                found.extend(_get_path_values(element, parts))
+        return found
+
+    return []
+
+
+def _get_sort_value(document: dict, field: str, direction: int) -> Any:
+    """
+    Value a document sorts by: arrays sort by their smallest element
+    ascending and their largest descending.
+    """
+    values = _get_path_values(document, field.split("."))
+    if not values:
+        return None
+    expanded = []
+    for value in values:
+        if isinstance(value, list):
+            expanded.extend(value)
+        else:
+            expanded.append(value)
+    if not expanded:
+        return None
+    pick = min if direction > 0 else max
+    return pick(expanded, key=lambda x: _SortKey([x], [1]))
+
+
+def _expand(values: list[Any]) -> list[Any]:
+    """
+    The values a query compares against: each value, plus the elements
+    of the arrays among them.
+    """
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _is_operator_dict(value: Any) -> bool:
+    return (isinstance(value, dict) and bool(value)
+            and all(k.startswith("$") for k in value))
+
+
+def _match_equal(values: list[Any], target: Any) -> bool:
+    if not values:
+        return target is None
+    if target is None and any(v is None for v in _expand(values)):
+        return True
+    return any(_values_equal(v, target) for v in _expand(values))
+
+
+def _match_range(values: list[Any], target: Any, accept) -> bool:
+    rank = _type_rank(target)
+    if rank == 1:
+        return accept(0) and (not values or None in _expand(values))
+    return any(_type_rank(v) == rank and accept(_compare(v, target))
+               for v in _expand(values))
+
+
+def _match_operators(values: list[Any], operators: dict) -> bool:
+    """
+    Checks the values found at a path against a dict of query operators.
+    """
+    for operator, target in operators.items():
+        if operator == "$eq":
+            matched = _match_equal(values, target)
+        elif operator == "$ne":
+            matched = not _match_equal(values, target)
+        elif operator == "$gt":
+            matched = _match_range(values, target, lambda x: x > 0)
+        elif operator == "$gte":
+            matched = _match_range(values, target, lambda x: x >= 0)
+        elif operator == "$lt":
+            matched = _match_range(values, target, lambda x: x < 0)
+        elif operator == "$lte":
+            matched = _match_range(values, target, lambda x: x <= 0)
+        elif operator == "$in":
+            matched = any(_match_equal(values, x) for x in target)
+        elif operator == "$nin":
+            matched = not any(_match_equal(values, x) for x in target)
+        elif operator == "$exists":
+            matched = bool(values) == bool(target)
+        elif operator == "$size":
+            matched = any(isinstance(v, list) and len(v) == target
+                          for v in values)
+        elif operator == "$all":
+            matched = all(_match_equal(values, x) for x in target)
+        elif operator == "$elemMatch":
+            matched = any(_match_element(element, target)
+                          for v in values if isinstance(v, list)
+                          for element in v)
+        elif operator == "$not":
+            matched = not _match_operators(values, target)
+        elif operator == "$regex":
+            flags = _regex_flags(operators.get("$options", ""))
+            matched = any(isinstance(v, str) and re.search(target, v, flags)
+                          for v in _expand(values))
+        elif operator == "$options":
+            matched = True
+        else:
+            raise OperationFailure(f"unknown operator: {operator}")
+        if not matched:
+            return False
+    return True
+
+
+def _regex_flags(options: str) -> int:
+    flags = 0
+    for option, flag in (("i", re.IGNORECASE), ("m", re.MULTILINE),
+                         ("s", re.DOTALL), ("x", re.VERBOSE)):
+        if option in options:
+            flags |= flag
+    return flags
+
+
+def _match_element(element: Any, condition: Any) -> bool:
+    """
+    `$elemMatch` and `$pull` condition against a single array element.
+    """
+    if _is_operator_dict(condition):
+        return _match_operators([element], condition)
+    if isinstance(condition, dict) and isinstance(element, dict):
+        return match_filter(element, condition)
+    return _values_equal(element, condition)
+
+
+def match_filter(document: dict, query: Optional[Mapping]) -> bool:
+    """
+    Whether the document matches the query filter.
+    """
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == "$and":
+            matched = all(match_filter(document, x) for x in condition)
+        elif key == "$or":
+            matched = any(match_filter(document, x) for x in condition)
+        elif key == "$nor":
+            matched = not any(match_filter(document, x) for x in condition)
+        elif key.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {key}")
+        else:
+            values = _get_path_values(document, key.split("."))
+            if _is_operator_dict(condition):
+                matched = _match_operators(values, condition)
+            elif isinstance(condition, re.Pattern):
+                matched = any(isinstance(v, str) and condition.search(v)
+                              for v in _expand(values))
+            else:
+                matched = _match_equal(values, condition)
+        if not matched:
+            return False
+    return True
+
+
+def _normalize_sort(key_or_list: Any,
+                    direction: Optional[int] = None) -> list[tuple[str, int]]:
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or ASCENDING)]
+    if isinstance(key_or_list, Mapping):
+        return list(key_or_list.items())
+    return [(x, ASCENDING) if isinstance(x, str) else tuple(x)
+            for x in key_or_list]
+
+
+def _apply_projection(document: dict, projection: Any) -> dict:
+    """
+    Applies an inclusion or exclusion projection to a copy of the document.
+    """
+    if projection is None:
+        return _clone(document)
+    if not isinstance(projection, Mapping):
+        projection = {field: 1 for field in projection}
+
+    include_id = bool(projection.get("_id", 1))
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(_is_operator_dict(v) for v in fields.values()):
+        raise OperationFailure("projection operators are not supported")
+
+    if fields and all(bool(v) for v in fields.values()):
+        result: dict = {}
+        if include_id and "_id" in document:
+            result["_id"] = _clone(document["_id"])
+        for field in fields:
+            _copy_path(document, result, field.split("."))
+        return result
+
+    if fields and any(bool(v) for v in fields.values()):
+        raise OperationFailure(
+            "cannot mix inclusion and exclusion in a projection")
+
+    result = _clone(document)
+    for field in fields:
+        _unset_path(result, field.split("."))
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _copy_path(source: Any, target: dict, parts: list[str]) -> None:
+    if not isinstance(source, dict) or parts[0] not in source:
+        return
+    value = source[parts[0]]
+    if len(parts) == 1:
+        target[parts[0]] = _clone(value)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(parts[0], {}), parts[1:])
+    elif isinstance(value, list):
+        copied = []
+        for element in value:
+            if isinstance(element, dict):
+                element_target: dict = {}
+                _copy_path(element, element_target, parts[1:])
+                copied.append(element_target)
+        target[parts[0]] = copied
+
+
+def _traverse_for_write(document: dict, parts: list[str],
+                        create: bool) -> tuple[Any, str]:
+    """
+    Returns the container holding the last path segment, creating the
+    intermediate documents when `create` is set, or (None, key) if the
+    path can't be reached.
+    """
+    container: Any = document
+    for part in parts[:-1]:
+        if isinstance(container, list) and part.isdigit():
+            index = int(part)
+            if index >= len(container):
+                if not create:
+                    return None, parts[-1]
+                container.extend([None] * (index + 1 - len(container)))
+            if container[index] is None and create:
+                container[index] = {}
+            container = container[index]
+        elif isinstance(container, dict):
+            if part not in container:
+                if not create:
+                    return None, parts[-1]
+                container[part] = {}
+            container = container[part]
+        else:
+            if not create:
+                return None, parts[-1]
+            raise WriteError(
+                f"Cannot create field '{part}' in element {container!r}",
+                BAD_VALUE_ERROR_CODE)
+    return container, parts[-1]
+
+
+def _get_path(document: dict, path: str) -> Any:
+    container, key = _traverse_for_write(document, path.split("."), False)
+    if isinstance(container, dict):
+        return container.get(key, _MISSING)
+    if isinstance(container, list) and key.isdigit() and int(key) < len(container):
+        return container[int(key)]
+    return _MISSING
+
+
+def _set_path(document: dict, path: str, value: Any) -> None:
+    container, key = _traverse_for_write(document, path.split("."), True)
+    if isinstance(container, list):
+        if not key.isdigit():
+            raise WriteError(
+                f"Cannot create field '{key}' in an array", BAD_VALUE_ERROR_CODE)
+        index = int(key)
+        if index >= len(container):
+            container.extend([None] * (index + 1 - len(container)))
+        container[index] = value
+    elif isinstance(container, dict):
+        container[key] = value
+    else:
+        raise WriteError(f"Cannot set field '{path}'", BAD_VALUE_ERROR_CODE)
+
+
+def _unset_path(document: dict, parts: list[str]) -> None:
+    container, key = _traverse_for_write(document, parts, False)
+    if isinstance(container, dict):
+        container.pop(key, None)
+    elif isinstance(container, list) and key.isdigit() and int(key) < len(container):
+        container[int(key)] = None
+
+
+def _get_array_for_write(document: dict, path: str, operator: str) -> list:
+    current = _get_path(document, path)
+    if current is _MISSING:
+        current = []
+        _set_path(document, path, current)
+    if not isinstance(current, list):
+        raise WriteError(
+            f"The field '{path}' must be an array to apply {operator}",
+            BAD_VALUE_ERROR_CODE)
+    return current
+
+
+def _apply_push(document: dict, path: str, spec: Any) -> None:
+    array = _get_array_for_write(document, path, "$push")
+    if _is_operator_dict(spec) and "$each" in spec:
+        unknown = set(spec) - {"$each", "$slice", "$position"}
+        if unknown:
+            raise WriteError(f"Unsupported $push modifiers: {sorted(unknown)}",
+                             BAD_VALUE_ERROR_CODE)
+        values = [_clone(x) for x in spec["$each"]]
+        position = spec.get("$position")
+        if position is None:
+            array.extend(values)
+        else:
+            array[position:position] = values
+        if "$slice" in spec:
+            limit = spec["$slice"]
+            if limit >= 0:
+                del array[limit:]
+            else:
+                del array[:max(len(array) + limit, 0)]
+    else:
+        array.append(_clone(spec))
+
+
+def _apply_add_to_set(document: dict, path: str, spec: Any) -> None:
+    array = _get_array_for_write(document, path, "$addToSet")
+    values = spec["$each"] if _is_operator_dict(spec) and "$each" in spec else [spec]
+    for value in values:
+        if not any(_values_equal(x, value) for x in array):
+            array.append(_clone(value))
+
+
+def _apply_pull(document: dict, path: str, condition: Any) -> None:
+    current = _get_path(document, path)
+    if not isinstance(current, list):
+        return
+    current[:] = [x for x in current if not _match_element(x, condition)]
+
+
+def _apply_inc(document: dict, path: str, amount: Any) -> None:
+    current = _get_path(document, path)
+    if current is _MISSING:
+        _set_path(document, path, amount)
+        return
+    if _type_rank(current) != 2:
+        raise WriteError(
+            f"Cannot apply $inc to a value of non-numeric type at '{path}'",
+            BAD_VALUE_ERROR_CODE)
+    _set_path(document, path, current + amount)
+
+
+def apply_update(document: dict, update: Mapping, is_insert: bool = False) -> None:
+    """
+    Applies an operator update document in place.
+    """
+    if not update or not all(k.startswith("$") for k in update):
+        raise ValueError("update only works with $ operators")
+
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if path == "_id" or path.startswith("_id."):
+                if operator in ("$set", "$setOnInsert") and (
+                        is_insert or _values_equal(document.get("_id"), value)):
+                    pass
+                else:
+                    raise WriteError(
+                        "Performing an update on the path '_id' would "
+                        "modify the immutable field '_id'",
+                        IMMUTABLE_FIELD_ERROR_CODE)
+
+            if operator == "$set":
+                _set_path(document, path, _clone(value))
+            elif operator == "$setOnInsert":
+                if is_insert:
+                    _set_path(document, path, _clone(value))
+            elif operator == "$unset":
+                _unset_path(document, path.split("."))
+            elif operator == "$inc":
+                _apply_inc(document, path, value)
+            elif operator in ("$min", "$max"):
+                current = _get_path(document, path)
+                better = -1 if operator == "$min" else 1
+                if current is _MISSING or _compare(value, current) == better:
+                    _set_path(document, path, _clone(value))
+            elif operator == "$push":
+                _apply_push(document, path, value)
+            elif operator == "$addToSet":
+                _apply_add_to_set(document, path, value)
+            elif operator == "$pull":
+                _apply_pull(document, path, value)
+            elif operator == "$pop":
+                array = _get_path(document, path)
+                if isinstance(array, list) and array:
+                    array.pop(0 if value < 0 else -1)
+            elif operator == "$rename":
+                current = _get_path(document, path)
+                if current is not _MISSING:
+                    _unset_path(document, path.split("."))
+                    _set_path(document, value, current)
+            elif operator == "$currentDate":
+                _set_path(document, path, datetime.datetime.utcnow())
+            else:
+                raise WriteError(f"Unknown modifier: {operator}",
+                                 BAD_VALUE_ERROR_CODE)
+
+
+def _get_upsert_seed(query: Optional[Mapping]) -> dict:
+    """
+    The document an upsert starts from: the equality fields of the filter.
+    """
+    seed: dict = {}
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            for sub_query in condition:
+                for sub_key, value in _get_upsert_seed(sub_query).items():
+                    seed[sub_key] = value
+        elif key.startswith("$"):
+            continue
+        elif _is_operator_dict(condition):
+            if "$eq" in condition:
+                _set_path(seed, key, _clone(condition["$eq"]))
+        else:
+            _set_path(seed, key, _clone(condition))
+    return seed
+
+
+class MemoryIndex:
+    """
+    Single index over a collection.
+
+    Keeps the documents bucketed by the value of the leading field, which
+    narrows down equality and `$in` queries on it, and by full key for
+    unique indexes. Array values are indexed per element, like a
+    multikey index.
+    """
+
+    def __init__(self, document: Mapping):
+        self.name = document["name"]
+        self.key = list(document["key"].items())
+        self.fields = [field for field, _ in self.key]
+        self.unique = bool(document.get("unique", False))
+        self.sparse = bool(document.get("sparse", False))
+        self.partial_filter = document.get("partialFilterExpression")
+        self.options = {k: v for k, v in document.items()
+                        if k not in ("name", "key")}
+        self.by_leading: Dict[Any, set] = {}
+        self.by_key: Dict[tuple, set] = {}
+
+    def get_information(self) -> dict:
+        return {"v": 2, "key": list(self.key), **self.options}
+
+    def covers(self, document: dict) -> bool:
+        if self.partial_filter is not None and not match_filter(
+                document, self.partial_filter):
+            return False
+        if self.sparse and all(
+                not _get_path_values(document, f.split(".")) for f in self.fields):
+            return False
+        return True
+
+    def can_plan(self) -> bool:
+        """
+        Whether the index holds every document, so its buckets can be
+        used to narrow down a query.
+        """
+        return not self.sparse and self.partial_filter is None
+
+    def _field_keys(self, document: dict, field: str) -> list:
+        values = _get_path_values(document, field.split("."))
+        if not values:
+            return [None]
+        keys = []
+        for value in values:
+            if not isinstance(value, list):
+                keys.append(_hashable(value))
+            elif value:
+                keys.extend(_hashable(x) for x in value)
+            else:
+                keys.append(None)
+        return keys
+
+    def get_keys(self, document: dict) -> set[tuple]:
+        return set(itertools.product(
+            *[self._field_keys(document, field) for field in self.fields]))
+
+    def find_duplicate(self, document: dict, doc_key: Any) -> Optional[tuple]:
+        """
+        Returns a key the document would share with another document,
+        if this is a unique index.
+        """
+        if not self.unique or not self.covers(document):
+            return None
+        for key in self.get_keys(document):
+            owners = self.by_key.get(key)
+            if owners and owners - {doc_key}:
+                return key
+        return None
+
+    def add(self, document: dict, doc_key: Any) -> None:
+        if not self.covers(document):
+            return
+        keys = self.get_keys(document)
+        for leading in {key[0] for key in keys}:
+            self.by_leading.setdefault(leading, set()).add(doc_key)
+        if self.unique:
+            for key in keys:
+                self.by_key.setdefault(key, set()).add(doc_key)
+
+    def remove(self, document: dict, doc_key: Any) -> None:
+        if not self.covers(document):
+            return
+        keys = self.get_keys(document)
+        for leading in {key[0] for key in keys}:
+            bucket = self.by_leading.get(leading)
+            if bucket is not None:
+                bucket.discard(doc_key)
+                if not bucket:
+                    del self.by_leading[leading]
+        if self.unique:
+            for key in keys:
+                owners = self.by_key.get(key)
+                if owners is not None:
+                    owners.discard(doc_key)
+                    if not owners:
+                        del self.by_key[key]
+
+
+def _get_planning_values(query: Mapping, field: str) -> Optional[list]:
+    """
+    The scalar values an equality or `$in` condition on the field allows,
+    or None if the query can't be narrowed down on it.
+    """
+    if field not in query:
+        return None
+    condition = query[field]
+    if _is_operator_dict(condition):
+        if set(condition) == {"$eq"}:
+            values = [condition["$eq"]]
+        elif set(condition) == {"$in"}:
+            values = list(condition["$in"])
+        else:
+            return None
+    elif isinstance(condition, (dict, list, re.Pattern)):
+        return None
+    else:
+        values = [condition]
+    if any(isinstance(x, (dict, list, re.Pattern)) for x in values):
+        return None
+    return values
+
+
+class MemoryCursor:
+    """
+    Lazily evaluated cursor returned by `MemoryCollection.find`. The query
+    runs when the cursor is first iterated.
+    """
+
+    def __init__(self, collection: "MemoryCollection", query: Optional[Mapping],
+                 projection: Any = None, sort: Any = None, limit: int = 0,
+                 skip: int = 0):
+        self.collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = _normalize_sort(sort)
+        self._limit = limit
+        self._skip = skip
+        self._results: Optional[list[dict]] = None
+        self._position = 0
+
+    def _check_not_started(self) -> None:
+        if self._results is not None:
+            raise OperationFailure("cannot modify a cursor after iterating it")
+
+    def sort(self, key_or_list: Any, direction: Optional[int] = None) -> "MemoryCursor":
+        self._check_not_started()
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit: int) -> "MemoryCursor":
+        self._check_not_started()
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> "MemoryCursor":
+        self._check_not_started()
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size: int) -> "MemoryCursor":
+        return self
+
+    def clone(self) -> "MemoryCursor":
+        return MemoryCursor(self.collection, self._query, self._projection,
+                            self._sort, self._limit, self._skip)
+
+    def rewind(self) -> "MemoryCursor":
+        self._results = None
+        self._position = 0
+        return self
+
+    def close(self) -> None:
+        self._results = []
+        self._position = 0
+
+    @property
+    def alive(self) -> bool:
+        return self._results is None or self._position < len(self._results)
+
+    def __iter__(self) -> "MemoryCursor":
+        return self
+
+    def __next__(self) -> dict:
+        if self._results is None:
+            self._results = self.collection._run_query(
+                self._query, self._projection, self._sort,
+                abs(self._limit), self._skip)
+        if self._position >= len(self._results):
+            raise StopIteration
+        document = self._results[self._position]
+        self._position += 1
+        return document
+
+    next = __next__
+
+    def __enter__(self) -> "MemoryCursor":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class MemoryCollection:
+    """
+    In-memory counterpart of a pymongo `Collection`.
+    """
+
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.lock = threading.RLock()
+        # document key -> document, in insertion order
+        self.documents: Dict[Any, dict] = {}
+        # document key -> insertion number, to keep index lookups in
+        # natural order
+        self.sequence: Dict[Any, int] = {}
+        self.inserted = itertools.count()
+        self.indexes: Dict[str, MemoryIndex] = {}
+
+    # -- reads -------------------------------------------------------------
+
+    def find(self, filter: Optional[Mapping] = None, projection: Any = None,
+             *args, sort: Any = None, limit: int = 0, skip: int = 0,
+             **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, self._as_filter(filter), projection,
+                            sort=sort, limit=limit, skip=skip)
+
+    def find_one(self, filter: Any = None, projection: Any = None, *args,
+                 sort: Any = None, skip: int = 0, **kwargs) -> Optional[dict]:
+        results = self._run_query(self._as_filter(filter), projection,
+                                  _normalize_sort(sort), 1, skip)
+        return results[0] if results else None
+
+    def count_documents(self, filter: Mapping, *args, limit: int = 0,
+                        skip: int = 0, **kwargs) -> int:
+        with self.lock:
+            count = sum(1 for _ in self._iter_matching(filter))
+        count = max(count - skip, 0)
+        return min(count, limit) if limit else count
+
+    def estimated_document_count(self, **kwargs) -> int:
+        return len(self.documents)
+
+    def distinct(self, key: str, filter: Optional[Mapping] = None,
+                 **kwargs) -> list:
+        distinct_values: list = []
+        with self.lock:
+            for _, document in self._iter_matching(filter):
+                for value in _expand(_get_path_values(document, key.split("."))):
+                    if isinstance(value, list):
+                        continue
+                    if not any(_values_equal(value, x) for x in distinct_values):
+                        distinct_values.append(_clone(value))
+        return distinct_values
+
+    # -- writes ------------------------------------------------------------
+
+    def insert_one(self, document: dict, *args, **kwargs) -> InsertOneResult:
+        with self.lock:
+            inserted_id = self._insert(document)
+        return InsertOneResult(inserted_id, True)
+
+    def insert_many(self, documents: Iterable[dict], ordered: bool = True,
+                    *args, **kwargs) -> InsertManyResult:
+        documents = list(documents)
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self.bulk_write([InsertOne(x) for x in documents], ordered=ordered)
+        return InsertManyResult([x["_id"] for x in documents], True)
+
+    def update_one(self, filter: Mapping, update: Mapping, upsert: bool = False,
+                   *args, **kwargs) -> UpdateResult:
+        with self.lock:
+            raw_result = self._update(filter, update, upsert, multi=False)
+        return UpdateResult(raw_result, True)
+
+    def update_many(self, filter: Mapping, update: Mapping, upsert: bool = False,
+                    *args, **kwargs) -> UpdateResult:
+        with self.lock:
+            raw_result = self._update(filter, update, upsert, multi=True)
+        return UpdateResult(raw_result, True)
+
+    def replace_one(self, filter: Mapping, replacement: Mapping,
+                    upsert: bool = False, *args, **kwargs) -> UpdateResult:
+        with self.lock:
+            raw_result = self._replace(filter, replacement, upsert)
+        return UpdateResult(raw_result, True)
+
+    def delete_one(self, filter: Mapping, *args, **kwargs) -> DeleteResult:
+        with self.lock:
+            deleted = self._delete(filter, multi=False)
+        return DeleteResult({"n": deleted}, True)
+
+    def delete_many(self, filter: Mapping, *args, **kwargs) -> DeleteResult:
+        with self.lock:
+            deleted = self._delete(filter, multi=True)
+        return DeleteResult({"n": deleted}, True)
+
+    def find_one_and_update(self, filter: Mapping, update: Mapping,
+                            projection: Any = None, sort: Any = None,
+                            upsert: bool = False,
+                            return_document: bool = ReturnDocument.BEFORE,
+                            *args, **kwargs) -> Optional[dict]:
+        with self.lock:
+            found = self._first_match(filter, _normalize_sort(sort))
+            if found is None:
+                if not upsert:
+                    return None
+                document = _get_upsert_seed(filter)
+                apply_update(document, update, is_insert=True)
+                self._insert(document, copy=False)
+                return (_apply_projection(document, projection)
+                        if return_document == ReturnDocument.AFTER else None)
+
+            doc_key, document = found
+            before = _apply_projection(document, projection)
+            self._modify(doc_key, document, lambda x: apply_update(x, update))
+            if return_document == ReturnDocument.AFTER:
+                return _apply_projection(self.documents[doc_key], projection)
+            return before
+
+    def find_one_and_delete(self, filter: Mapping, projection: Any = None,
+                            sort: Any = None, *args, **kwargs) -> Optional[dict]:
+        with self.lock:
+            found = self._first_match(filter, _normalize_sort(sort))
+            if found is None:
+                return None
+            doc_key, document = found
+            self._remove(doc_key)
+            return _apply_projection(document, projection)
+
+    def bulk_write(self, requests: Iterable[Any], ordered: bool = True,
+                   *args, **kwargs) -> BulkWriteResult:
+        result = {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0,
+                  "nUpserted": 0, "nMatched": 0, "nModified": 0,
+                  "nRemoved": 0, "upserted": []}
+        with self.lock:
+            for index, request in enumerate(requests):
+                try:
+                    self._apply_bulk_request(request, index, result)
+                except (DuplicateKeyError, WriteError) as error:
+                    result["writeErrors"].append({
+                        "index": index, "code": error.code,
+                        "errmsg": str(error), "op": _get_request_doc(request)})
+                    if ordered:
+                        break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _apply_bulk_request(self, request: Any, index: int, result: dict) -> None:
+        if isinstance(request, InsertOne):
+            self._insert(request._doc)
+            result["nInserted"] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+            if isinstance(request, ReplaceOne):
+                raw_result = self._replace(request._filter, request._doc,
+                                           request._upsert)
+            else:
+                raw_result = self._update(request._filter, request._doc,
+                                          request._upsert,
+                                          multi=isinstance(request, UpdateMany))
+            if "upserted" in raw_result:
+                result["nUpserted"] += 1
+                result["upserted"].append(
+                    {"index": index, "_id": raw_result["upserted"]})
+            else:
+                result["nMatched"] += raw_result["n"]
+                result["nModified"] += raw_result["nModified"]
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            result["nRemoved"] += self._delete(
+                request._filter, multi=isinstance(request, DeleteMany))
+        else:
+            raise TypeError(f"{request!r} is not a valid request")
+
+    # -- indexes -----------------------------------------------------------
+
+    def create_indexes(self, indexes: list[IndexModel], *args, **kwargs) -> list[str]:
+        return [self._create_index(x.document) for x in indexes]
+
+    def create_index(self, keys: Any, **kwargs) -> str:
+        return self._create_index(IndexModel(keys, **kwargs).document)
+
+    def index_information(self, *args, **kwargs) -> Dict[str, dict]:
+        information = {ID_INDEX_NAME: {"v": 2, "key": [("_id", 1)]}}
+        with self.lock:
+            for name, index in self.indexes.items():
+                information[name] = index.get_information()
+        return information
+
+    def drop_index(self, index_or_name: Any, *args, **kwargs) -> None:
+        name = index_or_name
+        if not isinstance(name, str):
+            name = IndexModel(index_or_name).document["name"]
+        with self.lock:
+            if name not in self.indexes:
+                raise OperationFailure(f"index not found with name [{name}]")
+            del self.indexes[name]
+
+    def drop_indexes(self, *args, **kwargs) -> None:
+        with self.lock:
+            self.indexes.clear()
+
+    def drop(self, *args, **kwargs) -> None:
+        self.database.drop_collection(self.name)
+
+    def _create_index(self, document: Mapping) -> str:
+        with self.lock:
+            name = document["name"]
+            existing = self.indexes.get(name)
+            if existing is not None:
+                if existing.key != list(document["key"].items()):
+                    raise OperationFailure(
+                        f"An existing index has the same name as the "
+                        f"requested index: {name}")
+                return name
+
+            index = MemoryIndex(document)
+            for doc_key, stored in self.documents.items():
+                if index.find_duplicate(stored, doc_key) is not None:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: "
+                        f"{self.full_name} index: {name}",
+                        DUPLICATE_KEY_ERROR_CODE)
+                index.add(stored, doc_key)
+            self.indexes[name] = index
+            return name
+
+    # -- internals, all called with the lock held ----------------------------
+
+    @staticmethod
+    def _as_filter(filter: Any) -> Optional[Mapping]:
+        if filter is None or isinstance(filter, Mapping):
+            return filter
+        return {"_id": filter}
+
+    def _candidate_keys(self, query: Optional[Mapping]) -> Optional[list]:
+        """
+        Narrows the query down with the `_id` or a secondary index,
+        returning the keys of the candidate documents (a superset of the
+        matches) or None if the whole collection has to be scanned.
+        """
+        if not query:
+            return None
+        id_values = _get_planning_values(query, "_id")
+        if id_values is not None:
+            return [key for key in dict.fromkeys(_hashable(x) for x in id_values)
+                    if key in self.documents]
+
+        best: Optional[set] = None
+        for index in self.indexes.values():
+            if not index.can_plan():
+                continue
+            values = _get_planning_values(query, index.fields[0])
+            if values is None:
+                continue
+            candidates: set = set()
+            for value in values:
+                candidates |= index.by_leading.get(_hashable(value), set())
+                if value is None:
+                    candidates |= index.by_leading.get(None, set())
+            if best is None or len(candidates) < len(best):
+                best = candidates
+        if best is None:
+            return None
+        return sorted(best, key=self.sequence.__getitem__)
+
+    def _iter_matching(self, query: Optional[Mapping]) -> Iterator[tuple[Any, dict]]:
+        keys = self._candidate_keys(query)
+        if keys is None:
+            items: Iterable = list(self.documents.items())
+        else:
+            items = [(key, self.documents[key]) for key in keys]
+        for doc_key, document in items:
+            if match_filter(document, query):
+                yield doc_key, document
+
+    def _sorted_matches(self, query: Optional[Mapping],
+                        sort: list[tuple[str, int]]) -> list[tuple[Any, dict]]:
+        matches = list(self._iter_matching(query))
+        if sort:
+            directions = [direction for _, direction in sort]
+            matches.sort(key=lambda item: _SortKey(
+                [_get_sort_value(item[1], field, direction)
+                 for field, direction in sort], directions))
+        return matches
+
+    def _first_match(self, query: Optional[Mapping],
+                     sort: list[tuple[str, int]]) -> Optional[tuple[Any, dict]]:
+        if not sort:
+            return next(self._iter_matching(query), None)
+        matches = self._sorted_matches(query, sort)
+        return matches[0] if matches else None
+
+    def _run_query(self, query: Optional[Mapping], projection: Any,
+                   sort: list[tuple[str, int]], limit: int, skip: int) -> list[dict]:
+        with self.lock:
+            if sort:
+                matches: Iterable = self._sorted_matches(query, sort)
+            else:
+                matches = self._iter_matching(query)
+            matches = itertools.islice(matches, skip,
+                                       skip + limit if limit else None)
+            return [_apply_projection(document, projection)
+                    for _, document in matches]
+
+    def _check_unique(self, document: dict, doc_key: Any) -> None:
+        for index in self.indexes.values():
+            duplicate = index.find_duplicate(document, doc_key)
+            if duplicate is not None:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.full_name} "
+                    f"index: {index.name} dup key: {duplicate}",
+                    DUPLICATE_KEY_ERROR_CODE,
+                    {"keyPattern": dict(index.key), "index": 0})
+
+    def _insert(self, document: dict, copy: bool = True) -> Any:
+        if "_id" not in document:
+            # pymongo sets the generated id on the caller's document too
+            document["_id"] = ObjectId()
+        stored = _clone(document) if copy else document
+        doc_key = _hashable(stored["_id"])
+        if doc_key in self.documents:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.full_name} "
+                f"index: {ID_INDEX_NAME} dup key: {{ _id: {stored['_id']!r} }}",
+                DUPLICATE_KEY_ERROR_CODE,
+                {"keyPattern": {"_id": 1}, "index": 0})
+        self._check_unique(stored, doc_key)
+        self.documents[doc_key] = stored
+        self.sequence[doc_key] = next(self.inserted)
+        for index in self.indexes.values():
+            index.add(stored, doc_key)
+        return stored["_id"]
+
+    def _remove(self, doc_key: Any) -> None:
+        document = self.documents.pop(doc_key)
+        del self.sequence[doc_key]
+        for index in self.indexes.values():
+            index.remove(document, doc_key)
+
+    def _modify(self, doc_key: Any, document: dict, change) -> bool:
+        """
+        Applies `change` to a copy of the stored document and swaps it in
+        if it still satisfies the unique indexes. Returns whether the
+        document changed.
+        """
+        updated = _clone(document)
+        change(updated)
+        if updated == document:
+            return False
+        self._check_unique(updated, doc_key)
+        for index in self.indexes.values():
+            index.remove(document, doc_key)
+        self.documents[doc_key] = updated
+        for index in self.indexes.values():
+            index.add(updated, doc_key)
+        return True
+
+    def _update(self, query: Mapping, update: Mapping, upsert: bool,
+                multi: bool) -> dict:
+        if not update or not all(k.startswith("$") for k in update):
+            raise ValueError("update only works with $ operators")
+        matches = list(self._iter_matching(query))
+        if not multi:
+            matches = matches[:1]
+
+        if not matches and upsert:
+            document = _get_upsert_seed(query)
+            apply_update(document, update, is_insert=True)
+            upserted_id = self._insert(document, copy=False)
+            return {"n": 1, "nModified": 0, "upserted": upserted_id}
+
+        modified = sum(
+            self._modify(doc_key, document, lambda x: apply_update(x, update))
+            for doc_key, document in matches)
+        return {"n": len(matches), "nModified": modified}
+
+    def _replace(self, query: Mapping, replacement: Mapping, upsert: bool) -> dict:
+        if any(k.startswith("$") for k in replacement):
+            raise ValueError("replacement can not include $ operators")
+        found = self._first_match(query, [])
+        if found is None:
+            if not upsert:
+                return {"n": 0, "nModified": 0}
+            document = {**_get_upsert_seed(query), **_clone(dict(replacement))}
+            return {"n": 1, "nModified": 0,
+                    "upserted": self._insert(document, copy=False)}
+
+        doc_key, document = found
+
+        def _swap(x: dict) -> None:
+            doc_id = x["_id"]
+            if "_id" in replacement and not _values_equal(replacement["_id"], doc_id):
+                raise WriteError(
+                    "The _id field cannot be changed", IMMUTABLE_FIELD_ERROR_CODE)
+            x.clear()
+            x["_id"] = doc_id
+            x.update(_clone(dict(replacement)))
+        return {"n": 1, "nModified": int(self._modify(doc_key, document, _swap))}
+
+    def _delete(self, query: Mapping, multi: bool) -> int:
+        matches = [doc_key for doc_key, _ in self._iter_matching(query)]
+        if not multi:
+            matches = matches[:1]
+        for doc_key in matches:
+            self._remove(doc_key)
+        return len(matches)
+
+
+def _get_request_doc(request: Any) -> Any:
+    return getattr(request, "_doc", None) or getattr(request, "_filter", None)
+
+
+class MemoryDatabase:
+    """
+    In-memory counterpart of a pymongo `Database`.
+    """
+
+    def __init__(self, client: "MemoryClient", name: str):
+        self.client = client
+        self.name = name
+        self.lock = threading.Lock()
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self.get_collection(name)
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get_collection(name)
+
+    def get_collection(self, name: str, *args, **kwargs) -> MemoryCollection:
+        with self.lock:
+            collection = self.collections.get(name)
+            if collection is None:
+                collection = MemoryCollection(self, name)
+                self.collections[name] = collection
+            return collection
+
+    def list_collection_names(self, *args, **kwargs) -> list[str]:
+        with self.lock:
+            return list(self.collections)
+
+    def drop_collection(self, name_or_collection: Any, *args, **kwargs) -> None:
+        name = getattr(name_or_collection, "name", name_or_collection)
+        with self.lock:
+            self.collections.pop(name, None)
+
+    def command(self, command: Any, *args, **kwargs) -> dict:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == "ping":
+            return {"ok": 1.0}
+        raise OperationFailure(f"no such command: '{name}'")
+
+
+class MemoryClient:
+    """
+    In-memory counterpart of a pymongo `MongoClient`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        return self.get_database(name)
+
+    def get_database(self, name: str, *args, **kwargs) -> MemoryDatabase:
+        with self.lock:
+            database = self.databases.get(name)
+            if database is None:
+                database = MemoryDatabase(self, name)
+                self.databases[name] = database
+            return database
+
+    @property
+    def admin(self) -> MemoryDatabase:
+        return self.get_database("admin")
+
+    def list_database_names(self, *args, **kwargs) -> list[str]:
+        with self.lock:
+            return list(self.databases)
+
+    def drop_database(self, name_or_database: Any, *args, **kwargs) -> None:
+        name = getattr(name_or_database, "name", name_or_database)
+        with self.lock:
+            self.databases.pop(name, None)
+
+    def close(self) -> None:
+        pass
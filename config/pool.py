@@ -0,0 +1,135 @@
+"""
+Connection pool instrumentation for the Mongo client.
+
+`POOL_METRICS` is registered as an event listener on the client and keeps
+per-process gauges of the pool: open and in-use connections, requests
+waiting for a connection, and how long checkouts wait. A latency spike with
+flat checkout waits points at Mongo. Growing waits with `in_use` pinned at
+`MONGO_MAX_POOL_SIZE` point at pool starvation.
+"""
+import logging
+import threading
+import time
+from typing import Dict
+
+from pymongo import monitoring
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Turns connection pool events into gauges.
+
+    pymongo publishes pool events on the thread doing the checkout, so the
+    start of a checkout is tracked per thread to time the wait.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = threading.Condition(self.lock)
+        self.local = threading.local()
+        self.open_connections = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_wait_seconds_total = 0.0
+        self.checkout_wait_seconds_max = 0.0
+        self.checkout_timeouts = 0
+        self.checkout_failures = 0
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Returns the current value of every gauge and counter.
+        """
+        with self.lock:
+            mean_wait = (self.checkout_wait_seconds_total / self.checkouts
+                         if self.checkouts else 0.0)
+            return {
+                "open_connections": self.open_connections,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_wait_seconds_total": self.checkout_wait_seconds_total,
+                "checkout_wait_seconds_mean": mean_wait,
+                "checkout_wait_seconds_max": self.checkout_wait_seconds_max,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_failures": self.checkout_failures,
+            }
+
+    def wait_for_open_connections(self, count: int, timeout: float) -> bool:
+        """
+        Blocks until at least `count` connections are open or `timeout`
+        seconds pass. Returns whether the count was reached.
+        """
+        with self.opened:
+            return self.opened.wait_for(
+                lambda: self.open_connections >= count, timeout=timeout)
+
+    def connection_check_out_started(self, event) -> None:
+        self.local.checkout_started = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event) -> None:
+        waited = self._pop_checkout_wait()
+        with self.lock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.checkouts += 1
+            self.checkout_wait_seconds_total += waited
+            self.checkout_wait_seconds_max = max(
+                self.checkout_wait_seconds_max, waited)
+
+    def connection_check_out_failed(self, event) -> None:
+        waited = self._pop_checkout_wait()
+        timed_out = event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT
+        with self.lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+            if timed_out:
+                self.checkout_timeouts += 1
+            in_use = self.in_use
+        if timed_out:
+            logging.warning(
+                f"timed out after {waited:.3f}s waiting for a mongo connection "
+                f"to {event.address} ({in_use} in use)")
+
+    def connection_checked_in(self, event) -> None:
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event) -> None:
+        with self.opened:
+            self.open_connections += 1
+            self.opened.notify_all()
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        with self.lock:
+            self.open_connections -= 1
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        logging.warning(f"mongo connection pool for {event.address} cleared")
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def _pop_checkout_wait(self) -> float:
+        """
+        Seconds since this thread started its checkout.
+        """
+        started = getattr(self.local, "checkout_started", None)
+        self.local.checkout_started = None
+        if started is None:
+            return 0.0
+        return time.monotonic() - started
+
+
+POOL_METRICS = PoolMetricsListener()
@@ -14,7 +14,11 @@ from datetime import datetime, timedelta
 from typing import Optional, Any, Dict
 import jwt
 
-from config.main import JWT_SECRET_KEY, JWT_EXPIRY_TIME
+from config.main import JWT_SECRET_KEY, JWT_EXPIRY_TIME, JWT_CLAIMS_CACHE_SIZE
+from utils.cache import ExpiringLRUCache
+
+# verified claims keyed by the encoded token string, evicted at `exp`
+VERIFIED_CLAIMS_CACHE = ExpiringLRUCache(max_size=JWT_CLAIMS_CACHE_SIZE)
 
 
 class Token:
@@ -31,16 +35,38 @@ class Token:
         it is both not expired and valid before doing so.
         Returns a dict.
         """
-        valid = Token.check_if_valid(encoded_token_str)
-        is_expired = Token.check_if_expired(encoded_token_str)
-        if valid and not is_expired:
-            payload_dict = jwt.decode(encoded_token_str,
-                                      JWT_SECRET_KEY,
-                                      algorithms=["HS256"])
-        else:
+        payload_dict = Token.get_verified_claims(encoded_token_str)
+        if payload_dict is None:
             payload_dict = {'Error:', 'not valid'}
         return payload_dict
 
+    @staticmethod
+    def get_verified_claims(
+            encoded_token_str: str) -> Optional[Dict[str, Any]]:
+        """
+        Verifies the signature and expiry of the token with a single
+        decode, returning its claims, or None if it is invalid or expired.
+
+        Verified claims are cached by token string until their `exp`,
+        so repeated requests with the same token skip the HMAC check.
+        """
+        cached_claims = VERIFIED_CLAIMS_CACHE.get(encoded_token_str)
+        if cached_claims is not None:
+            return dict(cached_claims)
+
+        try:
+            claims = jwt.decode(encoded_token_str,
+                                JWT_SECRET_KEY,
+                                algorithms=["HS256"])
+        except jwt.exceptions.InvalidTokenError:
+            return None
+
+        expires_at = claims.get('exp')
+        if expires_at is not None:
+            VERIFIED_CLAIMS_CACHE.set(encoded_token_str, dict(claims),
+                                      expires_at=expires_at)
+        return claims
+
     @staticmethod
     def get_enc_token_str_from_dict(
             payload_dict: Dict[Any, Any],
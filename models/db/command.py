@@ -39,3 +39,7 @@ class Command(BaseModelWithId):
     name: CommandNames
     issuer_id: Id
     device_id: Id
+    # seconds since epoch, set when the command is inserted and used to hand
+    # out pending commands oldest-first; unset on commands stored before it
+    # existed, which sort first, by id
+    created_at: Optional[float] = None
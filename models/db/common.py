@@ -1,5 +1,6 @@
-from typing import NoReturn, Optional, Any
+from typing import NoReturn, Optional, Any, TypeVar
 from pydantic import Field, BaseModel, validator
+from pydantic.fields import FieldInfo
 from uuid import uuid4
 from enum import Enum
 
@@ -8,10 +9,47 @@ EmailStr = str
 RaisesException = NoReturn
 
 
+Model = TypeVar("Model", bound="BaseModelWithConfig")
+
+
 class BaseModelWithConfig(BaseModel):
     class Config:
         use_enum_values = True
 
+    @classmethod
+    def from_trusted(cls: type[Model], document: dict[str, Any]) -> Model:
+        """
+        Builds the model from a document this service wrote and read back
+        from its own collections, without validating it again.
+        Missing fields get their defaults, unknown ones are ignored.
+        """
+        return cls.model_construct(**document)
+
+    @classmethod
+    def dump_trusted(cls, document: dict[str, Any]) -> dict[str, Any]:
+        """
+        What `from_trusted(document).to_trusted_dict()` returns, without
+        building the model. Hot path of list responses; nested documents
+        are passed through as they are.
+        """
+        dumped = {}
+        for key, _, field in _get_trusted_fields(cls):
+            if key in document:
+                dumped[key] = document[key]
+            elif not field.is_required():
+                dumped[key] = field.get_default(call_default_factory=True)
+        return dumped
+
+    def to_trusted_dict(self) -> dict[str, Any]:
+        """
+        Dumps the fields by alias without going through pydantic's
+        serializer, ready for `orjson`. Only meant for models built by
+        `from_trusted` (or validated ones), whose values are already plain.
+        Items already dumped with `dump_trusted` are passed through.
+        """
+        return {key: _to_trusted_value(getattr(self, name))
+                for key, name, _ in _get_trusted_fields(type(self))}
+
 
 class BaseModelWithId(BaseModelWithConfig):
     id: Optional[Id] = Field(default="", alias="_id")
@@ -54,6 +92,33 @@ class AutoName(Enum):
         return name
 
 
+# (alias or name, name, field) of every field, per model class
+_TRUSTED_FIELDS: dict[type, list[tuple[str, str, FieldInfo]]] = {}
+
+# values `to_trusted_dict` never needs to look into; checked first since
+# isinstance checks against pydantic models are comparatively slow
+_PLAIN_TYPES = (str, int, float, type(None), dict)
+
+
+def _get_trusted_fields(cls: type) -> list[tuple[str, str, FieldInfo]]:
+    fields = _TRUSTED_FIELDS.get(cls)
+    if fields is None:
+        fields = [(field.alias or name, name, field)
+                  for name, field in cls.model_fields.items()]
+        _TRUSTED_FIELDS[cls] = fields
+    return fields
+
+
+def _to_trusted_value(value: Any) -> Any:
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+    if isinstance(value, BaseModelWithConfig):
+        return value.to_trusted_dict()
+    if isinstance(value, list) and value and isinstance(value[0], BaseModelWithConfig):
+        return [x.to_trusted_dict() for x in value]
+    return value
+
+
 def _generate_uuid4_str() -> str:
     """
     Generates a string representation of a UUID4.
@@ -1,4 +1,4 @@
-from .common import Id, BaseModelWithId
+from .common import Id, BaseModelWithConfig, BaseModelWithId
 from .metadata import Metadata
 from typing import Optional
 
@@ -8,3 +8,15 @@ class Device(BaseModelWithId):
     user_id: Id
     command_ids: list[Id] = []
     metadata: Optional[Metadata] = {}
+    # bumped by every write, backs the ETags of the device reads
+    version: int = 0
+
+
+class AgentPrincipal(BaseModelWithConfig):
+    """
+    Caller of the agent-facing routes. `device_id` is only set when the
+    caller authenticated with a device token, and limits it to that device.
+    """
+    user_id: Id
+    tenant_id: Optional[Id] = None
+    device_id: Optional[Id] = None
@@ -21,6 +21,8 @@ class DbUser(BaseModelWithId):
     device_ids: list[Id]
     role_id: Id
     user_type: UserTypeEnum
+    # bumped by every write, backs the ETag of /users/get
+    version: int = 0
 
 
 class DbUserRedacted(BaseModelWithId):
@@ -32,4 +34,13 @@ class DbUserRedacted(BaseModelWithId):
     role_id: Id
 
 
+class UserPrincipal(BaseModelWithId):
+    """
+    Slim view of a user used to authorize requests.
+    """
+    tenant_id: Id
+    role_id: Id
+    user_type: UserTypeEnum
+
+
 RawUser = dict[str, Any]
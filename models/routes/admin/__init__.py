@@ -0,0 +1 @@
+from .get_slow_queries import GetSlowQueriesResponse, SlowQueryEntry
@@ -0,0 +1,23 @@
+from datetime import datetime
+from typing import Any, List, Optional
+from models.db.common import BaseModelWithConfig
+
+
+class SlowQueryEntry(BaseModelWithConfig):
+    database: str
+    collection: str
+    command: str
+    duration_ms: float
+    # the filter with its values redacted
+    filter_shape: Any = None
+    route: Optional[str] = None
+    request_id: Optional[str] = None
+    failed: bool = False
+    # whether the plan scanned the whole collection, None if not explained
+    collscan: Optional[bool] = None
+    recorded_at: datetime
+
+
+class GetSlowQueriesResponse(BaseModelWithConfig):
+    threshold_ms: float
+    slow_queries: List[SlowQueryEntry]
@@ -5,3 +5,5 @@ from .create_command import CreateCommandRequest, CreateCommandResponse
 from .create_batch import CreateBatchRequest, CreateBatchResponse
 from .get_command import GetCommandResponse
 from .batch_commands_all import BatchAllCommandsResponse
+from .claim_commands import ClaimCommandsRequest, ClaimCommandsResponse
+from .bulk_command_status import BulkCommandStatusRequest, BulkCommandStatusResponse, CommandStatusResult, CommandStatusOutcome
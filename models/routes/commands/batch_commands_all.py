@@ -1,6 +1,9 @@
+from typing import Optional
 from models.db.common import Id, BaseModelWithConfig
 from models.db.command import Command
 
 
 class BatchAllCommandsResponse(BaseModelWithConfig):
     commands: list[Command]
+    # pass as `after` to get the next page, unset on the last page
+    next_cursor: Optional[str] = None
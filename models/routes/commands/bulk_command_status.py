@@ -0,0 +1,43 @@
+from enum import auto
+from typing import Optional
+from pydantic import Field, validator
+from config.main import BULK_STATUS_MAX_UPDATES
+from models.db.common import AutoName, BaseModelWithConfig, Id
+from .command_status import CommandStatusRequest
+
+
+class CommandStatusOutcome(AutoName):
+    Updated = auto()
+    NotFound = auto()
+    Failed = auto()
+
+
+class BulkCommandStatusRequest(BaseModelWithConfig):
+    updates: list[CommandStatusRequest] = Field(
+        min_length=1, max_length=BULK_STATUS_MAX_UPDATES)
+
+    @validator("updates")
+    def check_command_ids_are_unique(cls, updates):
+        """
+        Unordered writes to the same command would leave its final status
+        up to the server, so each command may only appear once.
+        """
+        seen, duplicates = set(), []
+        for update in updates:
+            if update.command_id in seen and update.command_id not in duplicates:
+                duplicates.append(update.command_id)
+            seen.add(update.command_id)
+        if duplicates:
+            raise ValueError(
+                f"Duplicate command ids: {', '.join(duplicates)}")
+        return updates
+
+
+class CommandStatusResult(BaseModelWithConfig):
+    command_id: Id
+    outcome: CommandStatusOutcome
+    detail: Optional[str] = None
+
+
+class BulkCommandStatusResponse(BaseModelWithConfig):
+    results: list[CommandStatusResult]
@@ -0,0 +1,14 @@
+from pydantic import Field
+from config.main import CLAIM_COMMANDS_MAX_LIMIT
+from models.db.common import BaseModelWithConfig, Id
+from models.db.command import Command
+
+
+class ClaimCommandsRequest(BaseModelWithConfig):
+    device_id: Id
+    limit: int = Field(default=1, ge=1, le=CLAIM_COMMANDS_MAX_LIMIT)
+    wait: float = Field(default=0, ge=0)
+
+
+class ClaimCommandsResponse(BaseModelWithConfig):
+    commands: list[Command]
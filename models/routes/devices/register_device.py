@@ -11,3 +11,4 @@ class RegisterDeviceRequest(BaseModelWithConfig):
 
 class RegisterDeviceResponse(BaseModelWithConfig):
     device_id: Id
+    device_token: str
@@ -0,0 +1,27 @@
+from fastapi import APIRouter, Depends
+from models.db.common import Id
+import models.routes.admin as admin_models
+from utils.auth import check_header_token_is_admin
+from utils.server_timing import TimedRoute
+from utils.slow_queries import SLOW_QUERY_LOG
+
+router = APIRouter(route_class=TimedRoute)
+ROUTE_BASE = "/admin"
+TAG = "admin"
+
+
+@router.get(
+    ROUTE_BASE + "/slow-queries",
+    response_model=admin_models.GetSlowQueriesResponse,
+    summary="Get the latest slow database operations of this worker",
+    tags=[TAG],
+    status_code=200,
+)
+async def get_slow_queries(_: Id = Depends(check_header_token_is_admin)):
+    """
+    Latest first. Each worker keeps its own log, of at most
+    `SLOW_QUERY_LOG_SIZE` operations.
+    """
+    return admin_models.GetSlowQueriesResponse(
+        threshold_ms=SLOW_QUERY_LOG.threshold_ms,
+        slow_queries=SLOW_QUERY_LOG.snapshot())
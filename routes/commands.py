@@ -1,12 +1,32 @@
+import asyncio
 import logging
-from fastapi import APIRouter, Depends
-from config.db import get_commands_collection, get_devices_collection
+import time
+from typing import Any, Iterator, Optional
+import orjson
+from fastapi import APIRouter, Depends, Header, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.exceptions import HTTPException
+from config.db import AsyncCollection, get_commands_collection, get_async_devices_collection
+from config.main import (
+    LONG_POLL_MAX_WAIT_SECONDS,
+    COMMAND_STATUS_COALESCE_WINDOW_MS,
+    BATCH_INSERT_CHUNK_SIZE,
+    COMMANDS_PAGE_DEFAULT_LIMIT,
+    COMMANDS_PAGE_MAX_LIMIT,
+)
 from bson.objectid import ObjectId
 from models.db.command import CommandStatus, Command
 import models.routes.users as models
 from models.db.common import Id, EmailStr, RaisesException
+from models.db.device import AgentPrincipal
 from models.db.user import DbUser, RawUser
-from utils.devices import get_device_from_db_or_404
+from utils.devices import (
+    check_device_exists_or_404,
+    check_devices_exist_or_404,
+    get_command_ids_push_update,
+    push_command_ids_to_devices,
+)
 from utils.errors import (
     DatabaseNotModified,
     DefaultDataNotFoundException,
@@ -14,19 +34,48 @@ from utils.errors import (
     check_update_was_successful,
 )
 import utils.commands as utils
+from utils.coalescer import STATUS_COALESCER
+from utils.request_context import mark_as_agent_poll
+from utils.responses import trusted_response
+from utils.server_timing import TimedRoute
+from utils.waiters import notify_command_waiters, register_command_waiter, unregister_command_waiter
+from utils.connections import (
+    WS_CLOSE_GOING_AWAY,
+    WS_CLOSE_POLICY_VIOLATION,
+    DeviceConnection,
+    notify_device_connections,
+    register_device_connection,
+    unregister_device_connection,
+)
 from utils.users import validate_user_id_or_throw, get_db_user_or_throw_if_404, register_user_to_db
-from utils.auth import get_auth_token_from_user_id, get_user_id_from_header_and_check_existence, hash_and_compare
+from utils.auth import (
+    check_agent_can_access_device,
+    get_agent_device_filter,
+    get_agent_from_header,
+    get_auth_token_from_user_id,
+    get_user_id_from_header_and_check_existence,
+    hash_and_compare,
+)
 import utils.errors as exceptions
 import models.routes.commands as cmd_models
-from pymongo import ASCENDING, DESCENDING
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 ROUTE_BASE = "/commands"
 TAG = "commands"
 
 commands_collection = get_commands_collection
 
 
+def async_commands_collection() -> AsyncCollection:
+    """
+    Awaitable handle to the commands collection, going through the
+    module-level `commands_collection` alias.
+    """
+    return AsyncCollection(commands_collection())
+
+
 @router.get(
     ROUTE_BASE + "/get",
     response_model=cmd_models.get_command.GetCommandResponse,
@@ -35,8 +84,8 @@ commands_collection = get_commands_collection
     status_code=200,
 )
 async def get_command(command_id: Id, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
-    return cmd_models.get_command.GetCommandResponse(
-        command=utils.get_command_from_db_or_404(command_id))
+    return trusted_response(cmd_models.get_command.GetCommandResponse.model_construct(
+        command=await utils.get_command_from_db_or_404(command_id)))
 
 
 @router.post(
@@ -47,8 +96,9 @@ async def get_command(command_id: Id, user_id: Id = Depends(get_user_id_from_hea
     status_code=200,
 )
 async def get_batch_cmds(request: cmd_models.batch_commands.BatchCommandsRequest, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
-    commands = utils.get_many_commands_from_db_or_404(request.command_ids)
-    return cmd_models.batch_commands.BatchCommandsResponse(commands=commands)
+    commands = await utils.get_many_commands_from_db_or_404(request.command_ids)
+    return trusted_response(
+        cmd_models.batch_commands.BatchCommandsResponse.model_construct(commands=commands))
 
 
 @router.get(
@@ -58,14 +108,53 @@ async def get_batch_cmds(request: cmd_models.batch_commands.BatchCommandsRequest
     tags=[TAG],
     status_code=200,
 )
-async def get_batch_cmds_all(device_id: Id, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
-    commands_collection_handle = commands_collection()
-    commands = commands_collection_handle.find({'device_id': device_id})
-    if not commands:
+async def get_batch_cmds_all(
+        device_id: Id,
+        limit: Optional[int] = Query(
+            None,
+            ge=1,
+            le=COMMANDS_PAGE_MAX_LIMIT,
+            description="Page size, defaults to "
+            f"{COMMANDS_PAGE_DEFAULT_LIMIT}. Unbounded when streaming."),
+        after: Optional[str] = Query(
+            None, description="`next_cursor` of the previous page"),
+        stream: bool = Query(
+            False, description="Stream the commands as NDJSON instead"),
+        user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+    if stream:
+        cursor = utils.find_device_command_history(device_id, after, limit)
+        return StreamingResponse(_iter_commands_as_ndjson(cursor),
+                                 media_type="application/x-ndjson")
+
+    page_size = limit or COMMANDS_PAGE_DEFAULT_LIMIT
+    # one extra document tells us whether there is a next page
+    commands = await utils.get_device_command_history_page(
+        device_id, after, page_size + 1)
+    if not commands and not after:
         raise DefaultDataNotFoundException(
             detail=f"No commands found for device {device_id}")
-    return cmd_models.batch_commands_all.BatchAllCommandsResponse(
-        commands=commands)
+
+    next_cursor = None
+    if len(commands) > page_size:
+        commands = commands[:page_size]
+        next_cursor = utils.encode_command_history_cursor(commands[-1])
+
+    return trusted_response(
+        cmd_models.batch_commands_all.BatchAllCommandsResponse.model_construct(
+            commands=[Command.dump_trusted(x) for x in commands],
+            next_cursor=next_cursor))
+
+
+def _iter_commands_as_ndjson(cursor) -> Iterator[bytes]:
+    """
+    Encodes commands one per line as they come off the cursor, so the
+    whole history is never held in memory.
+
+    Starlette runs sync iterators in its threadpool, so the blocking
+    cursor reads stay off the event loop.
+    """
+    for command in cursor:
+        yield orjson.dumps(Command.dump_trusted(command)) + b"\n"
 
 
 @router.patch(
@@ -76,24 +165,108 @@ async def get_batch_cmds_all(device_id: Id, user_id: Id = Depends(get_user_id_fr
     status_code=204,
 )
 async def update_command_status(
-        request: cmd_models.command_status.CommandStatusRequest):
-    commands_collection_handle = commands_collection()
-    command_id = request.command_id
-    status = request.status
+        request: cmd_models.command_status.CommandStatusRequest,
+        agent: AgentPrincipal = Depends(get_agent_from_header)):
+    device_id = agent.device_id
+    if device_id is None:
+        # user tokens may only touch the commands of the user's own devices
+        command = await async_commands_collection().find_one(
+            {'_id': request.command_id, **await get_agent_device_filter(agent)},
+            {'device_id': 1})
+        if not command:
+            raise DefaultDataNotFoundException(
+                detail=f"No command found with id {request.command_id}")
+        device_id = command['device_id']
+    await _set_command_status(request.command_id, request.status,
+                              device_id=device_id)
+    return
+
 
-    if not commands_collection_handle.find_one({'_id': command_id}):
+@router.patch(
+    ROUTE_BASE + "/update/status/bulk",
+    response_model=cmd_models.bulk_command_status.BulkCommandStatusResponse,
+    summary="Change the status of many commands",
+    tags=[TAG],
+    status_code=200,
+)
+async def update_command_status_bulk(
+        request: cmd_models.bulk_command_status.BulkCommandStatusRequest,
+        agent: AgentPrincipal = Depends(get_agent_from_header)):
+    commands_collection_handle = async_commands_collection()
+    outcomes = cmd_models.bulk_command_status.CommandStatusOutcome
+    updates = request.updates
+
+    # only commands of the device (device tokens) or of the user's devices
+    device_filter = await get_agent_device_filter(agent)
+
+    # one op per item, in request order (command ids are unique, so the
+    # unordered writes can't race each other)
+    operations = [UpdateOne({'_id': update.command_id, **device_filter},
+                            {'$set': {'status': update.status}})
+                  for update in updates]
+    failures: dict[int, str] = {}
+    try:
+        result = await commands_collection_handle.bulk_write(operations, ordered=False)
+        matched_count = result.matched_count
+    except BulkWriteError as error:
+        matched_count = error.details.get('nMatched', 0)
+        for write_error in error.details.get('writeErrors', []):
+            failures[write_error['index']] = write_error.get('errmsg')
+
+    # the bulk result only counts matches, so when some op matched nothing,
+    # read which of the commands exist to tell which ones
+    written = [update.command_id for i, update in enumerate(updates)
+               if i not in failures]
+    found_ids = set(written)
+    if matched_count < len(written):
+        found_ids = {x['_id'] for x in await commands_collection_handle.find_to_list(
+            {'_id': {'$in': written}, **device_filter}, {'_id': 1})}
+
+    results = []
+    for i, update in enumerate(updates):
+        if i in failures:
+            result = {'outcome': outcomes.Failed, 'detail': failures[i]}
+        elif update.command_id not in found_ids:
+            result = {'outcome': outcomes.NotFound,
+                      'detail': f"No command found with id {update.command_id}"}
+        else:
+            result = {'outcome': outcomes.Updated}
+        results.append(cmd_models.bulk_command_status.CommandStatusResult(
+            command_id=update.command_id, **result))
+
+    return cmd_models.bulk_command_status.BulkCommandStatusResponse(
+        results=results)
+
+
+async def _set_command_status(command_id: Id, status: CommandStatus,
+                              device_id: Optional[Id] = None) -> None:
+    """
+    Sets the status of a single command, raising a 404 if it doesn't
+    exist (or doesn't belong to `device_id`, when given).
+
+    Shared by the PATCH route and the device channel. Goes through the
+    write-behind coalescer when it is enabled.
+    """
+    if COMMAND_STATUS_COALESCE_WINDOW_MS:
+        await STATUS_COALESCER.submit(command_id, status, device_id=device_id)
+        return
+
+    commands_collection_handle = async_commands_collection()
+    command_filter = {'_id': command_id}
+    if device_id is not None:
+        command_filter['device_id'] = device_id
+
+    if not await commands_collection_handle.find_one(command_filter):
         raise DefaultDataNotFoundException(
             detail=f"No command found with id {command_id}")
 
-    updated = commands_collection_handle.update_one({'_id': command_id},
-                                                    {'$set': {
-                                                        'status': status
-                                                    }})
+    updated = await commands_collection_handle.update_one(command_filter,
+                                                          {'$set': {
+                                                              'status': status
+                                                          }})
     if updated.modified_count == 0:
         raise DatabaseNotModified(detail=f"Failed to update command status")
 
-    return
-
 
 @router.get(
     ROUTE_BASE + "/recent",
@@ -101,25 +274,93 @@ async def update_command_status(
     summary="Get most recent command for a device",
     tags=[TAG],
     status_code=200,
+    dependencies=[Depends(mark_as_agent_poll)],
 )
 async def get_most_recent_command(
-        device_id: Id):
-    commands_collection_handle = commands_collection()
+        device_id: Id,
+        wait: float = Query(
+            0,
+            ge=0,
+            description="Seconds to hold the request open waiting for a "
+            "pending command before answering with a 404. "
+            f"Capped at {LONG_POLL_MAX_WAIT_SECONDS}."),
+        agent: AgentPrincipal = Depends(get_agent_from_header)):
+    commands_collection_handle = async_commands_collection()
+
+    await check_agent_can_access_device(agent, device_id)
+
+    def find_oldest_pending_command():
+        return commands_collection_handle.find_one(
+            {
+                'device_id': device_id,
+                'status': CommandStatus.Pending.value
+            },
+            sort=utils.OLDEST_FIRST_SORT)
 
-    get_device_from_db_or_404(device_id)
-    command = commands_collection_handle.find_one(
-        {
-            'device_id': device_id,
-            'status': CommandStatus.Pending.value
-        },
-        sort=[('$natural', ASCENDING)])
+    command = await _wait_for_pending_commands(
+        device_id, wait, find_oldest_pending_command)
 
     if not command:
         raise DefaultDataNotFoundException(
             detail=f"No commands found for device {device_id}")
 
-    return cmd_models.get_recent_command.GetRecentCommandResponse(
-        command=Command(**command))
+    return trusted_response(
+        cmd_models.get_recent_command.GetRecentCommandResponse.model_construct(
+            command=Command.from_trusted(command)))
+
+
+async def _wait_for_pending_commands(device_id: Id, wait: float, fetch):
+    """
+    Long-poll helper: awaits `fetch` and, while it comes back empty, parks
+    the request until a command is enqueued for the device or `wait`
+    seconds (capped by config) run out.
+
+    The waiter is registered before the first fetch so that a command
+    created in between can't be missed.
+    """
+    wait = min(wait, LONG_POLL_MAX_WAIT_SECONDS)
+    if not wait:
+        return await fetch()
+
+    deadline = time.monotonic() + wait
+    waiter = register_command_waiter(device_id)
+    try:
+        result = await fetch()
+        while not result:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await waiter.wait(remaining):
+                break
+            result = await fetch()
+        return result
+    finally:
+        unregister_command_waiter(waiter)
+
+
+@router.post(
+    ROUTE_BASE + "/claim",
+    response_model=cmd_models.claim_commands.ClaimCommandsResponse,
+    summary="Claim the oldest pending commands for a device",
+    tags=[TAG],
+    status_code=200,
+    dependencies=[Depends(mark_as_agent_poll)],
+)
+async def claim_commands(
+        request: cmd_models.claim_commands.ClaimCommandsRequest,
+        agent: AgentPrincipal = Depends(get_agent_from_header)):
+    device_id = request.device_id
+    await check_agent_can_access_device(agent, device_id)
+
+    commands = await _wait_for_pending_commands(
+        device_id, request.wait,
+        lambda: utils.claim_pending_commands_for_device(
+            device_id, request.limit))
+
+    if not commands:
+        raise DefaultDataNotFoundException(
+            detail=f"No commands found for device {device_id}")
+
+    return trusted_response(
+        cmd_models.claim_commands.ClaimCommandsResponse.model_construct(commands=commands))
 
 
 @router.post(
@@ -130,27 +371,30 @@ async def get_most_recent_command(
     status_code=201,
 )
 async def create_command(request: cmd_models.create_command.CreateCommandRequest, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
-    devices_collection = get_devices_collection()
-    commands_collection_handle = commands_collection()
-    get_device_from_db_or_404(request.device_id)
+    devices_collection = get_async_devices_collection()
+    commands_collection_handle = async_commands_collection()
+    await check_device_exists_or_404(request.device_id)
     command_data = {
         "status": CommandStatus.Pending,  # default status
         "args": request.args,
         "name": request.name,
         "device_id": request.device_id,
-        "issuer_id": request.issuer_id
+        "issuer_id": request.issuer_id,
+        "created_at": time.time()
     }
     command = Command(**command_data)
 
-    result = commands_collection_handle.insert_one(command.dict())
+    result = await commands_collection_handle.insert_one(command.dict())
     check_insert_was_successful(result, "Failed to create command")
     command_id = result.inserted_id
 
-    result = devices_collection.update_one({'_id': request.device_id}, {
-                                           "$push": {"command_ids": command_id}})
+    result = await devices_collection.update_one(
+        {'_id': request.device_id}, get_command_ids_push_update([command_id]))
     check_update_was_successful(
         result, "Failed to update device with new command id")
 
+    _dispatch_new_commands([command])
+
     return cmd_models.create_command.CreateCommandResponse(
         command_id=command_id)
 
@@ -163,22 +407,131 @@ async def create_command(request: cmd_models.create_command.CreateCommandRequest
     status_code=201,
 )
 async def create_commands_for_multiple_devices(request: cmd_models.create_batch.CreateBatchRequest, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
-    commands_collection_handle = commands_collection()
-    [get_device_from_db_or_404(device_id) for device_id in request.device_ids]
+    commands_collection_handle = async_commands_collection()
+    await check_devices_exist_or_404(request.device_ids)
 
     devices = request.device_ids
+    created_at = time.time()
     commands = [Command(**{"name": request.name,
                            "args": request.args,
                            "device_id": device_id,
                            "issuer_id": request.issuer_id,
-                           "status": CommandStatus.Pending  # default status
+                           "status": CommandStatus.Pending,  # default status
+                           "created_at": created_at
                            }) for device_id in devices]
 
-    response = commands_collection_handle.insert_many(
-        [x.dict() for x in commands])
+    command_ids = []
+    for start in range(0, len(commands), BATCH_INSERT_CHUNK_SIZE):
+        chunk = commands[start:start + BATCH_INSERT_CHUNK_SIZE]
+        response = await commands_collection_handle.insert_many(
+            [x.dict() for x in chunk])
+        if not response.inserted_ids or len(
+                response.inserted_ids) != len(chunk):
+            raise DatabaseNotModified(
+                detail="Failed to create batch commands")
+        command_ids.extend(response.inserted_ids)
 
-    if not response.inserted_ids or len(response.inserted_ids) != len(devices):
-        raise DatabaseNotModified(detail="Failed to create batch commands")
+    command_ids_by_device: dict[Id, list[Id]] = {}
+    for command in commands:
+        command_ids_by_device.setdefault(
+            command.device_id, []).append(command.get_id())
+    await push_command_ids_to_devices(command_ids_by_device)
+
+    _dispatch_new_commands(commands)
 
     return cmd_models.create_batch.CreateBatchResponse(
-        command_ids=response.inserted_ids)
+        command_ids=command_ids)
+
+
+def _dispatch_new_commands(commands: list[Command]) -> None:
+    """
+    Lets agents know about freshly created commands: wakes long-polling
+    requests and open device channels.
+    """
+    device_ids = [command.device_id for command in commands]
+    notify_command_waiters(device_ids)
+    notify_device_connections(device_ids)
+
+
+@router.websocket(ROUTE_BASE + "/ws")
+async def device_command_channel(websocket: WebSocket, device_id: Id,
+                                 token: Optional[str] = Header(None)):
+    """
+    Persistent channel for a device agent.
+
+    On connect, the device's Pending commands are sent, followed by new
+    commands as they are created. Sent commands are claimed like `/claim`
+    does, moving them to Sent. The agent reports transitions with
+    `{"type": "status", "command_id": ..., "status": ...}` messages and
+    must answer `{"type": "ping"}` messages with `{"type": "pong"}`.
+
+    Accepts the device's own token, or a token of the user owning it.
+    """
+    try:
+        agent = await get_agent_from_header(token)
+        await check_agent_can_access_device(agent, device_id)
+    except HTTPException as error:
+        await websocket.close(code=WS_CLOSE_POLICY_VIOLATION,
+                              reason=str(error.detail))
+        return
+
+    await websocket.accept()
+    connection = DeviceConnection(websocket, device_id)
+    register_device_connection(connection)
+
+    tasks = [asyncio.create_task(connection.run_sender()),
+             asyncio.create_task(connection.run_pinger()),
+             asyncio.create_task(connection.run_dispatcher(
+                 lambda limit: utils.claim_pending_commands_for_device(
+                     device_id, limit)))]
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except ValueError:
+                connection.push({"type": "error", "detail": "Invalid JSON"})
+                continue
+            await _handle_channel_message(connection, message)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        unregister_device_connection(connection)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await connection.close(WS_CLOSE_GOING_AWAY)
+
+
+async def _handle_channel_message(connection: DeviceConnection,
+                                  message: Any) -> None:
+    """
+    Handles a single message received on a device channel, queueing the
+    reply (if any) on the connection.
+    """
+    connection.mark_alive()
+    message_type = message.get("type") if isinstance(message, dict) else None
+
+    if message_type == "pong":
+        return
+
+    if message_type != "status":
+        connection.push(
+            {"type": "error", "detail": f"Unknown message type: {message_type}"})
+        return
+
+    try:
+        request = cmd_models.command_status.CommandStatusRequest(**message)
+    except ValidationError as error:
+        connection.push({"type": "error", "detail": str(error)})
+        return
+
+    try:
+        await _set_command_status(request.command_id, request.status,
+                                  device_id=connection.device_id)
+    except HTTPException as error:
+        connection.push({"type": "error", "command_id": request.command_id,
+                         "detail": error.detail})
+        return
+
+    connection.push({"type": "status_ack", "command_id": request.command_id,
+                     "status": request.status})
@@ -1,16 +1,25 @@
-from fastapi import APIRouter, Depends
-from config.db import get_users_collection, get_devices_collection
+from typing import Optional
+from fastapi import APIRouter, Depends, Header
+from config.db import AsyncCollection, get_users_collection, get_devices_collection
 from models.db.auth import Token
 from models.db.common import Id
 from models.db.device import Device
 import models.routes.devices as device_models
-from utils.auth import get_user_id_from_header_and_check_existence, hash_and_compare
-from utils.devices import get_device_from_db_or_404, get_many_devices_from_db_or_404_by_user_id
+from utils.auth import get_auth_token_for_device, get_user_id_from_header_and_check_existence, hash_and_compare_in_executor
+from utils.devices import (
+    get_device_from_db_or_404,
+    get_device_version_from_db_or_404,
+    get_device_versions_from_db_or_404_by_user_id,
+    get_many_devices_from_db_or_404_by_user_id,
+)
 from utils.errors import DatabaseNotModified, InvalidPasswordException
-from utils.users import get_db_user_or_throw_if_404
+from utils.etags import VERSION_BUMP, compute_etag, etag_matches, not_modified_response
+from utils.responses import trusted_response
+from utils.server_timing import TimedRoute
+from utils.users import get_db_user_or_throw_if_404, get_principal_or_throw_if_404
 import uuid
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 ROUTE_BASE = "/devices"
 TAG = "devices"
 
@@ -27,10 +36,10 @@ users_collection = get_users_collection
 )
 async def register_device(
         request: device_models.register_device.RegisterDeviceRequest):
-    devices_collection_handle = devices_collection()
-    users_collection_handle = users_collection()
+    devices_collection_handle = AsyncCollection(devices_collection())
+    users_collection_handle = AsyncCollection(users_collection())
     user_id = request.user_id
-    user = get_db_user_or_throw_if_404(user_id)
+    user = await get_db_user_or_throw_if_404(user_id)
 
     # for now (TODO @felipearce) only the user can register a device for itself
     # eventually admins should be able to
@@ -41,8 +50,8 @@ async def register_device(
         secret_data.get('user_id'), secret_data.get('secret'))
 
     # TODO @felipearce: make the jwt data typed
-    if not all([user_id_from_secret is not None, user_id_from_secret == user_id, raw_secret is not None,
-                hash_and_compare(raw_secret, secret)]):
+    if not all([user_id_from_secret is not None, user_id_from_secret == user_id, raw_secret is not None]) \
+            or not await hash_and_compare_in_executor(raw_secret, secret):
         msg = f"invalid secret for user_id: {user_id}"
         raise InvalidPasswordException(detail=msg)
 
@@ -50,22 +59,24 @@ async def register_device(
     device_id = device.get_id()
 
     user.device_ids.append(device_id)
-    response = users_collection_handle.update_one({"_id": user_id},
-                                                  {"$set": {
-                                                      "device_ids": user.device_ids
-                                                  }})
+    response = await users_collection_handle.update_one({"_id": user_id},
+                                                        {"$set": {
+                                                            "device_ids": user.device_ids
+                                                        }, "$inc": VERSION_BUMP})
 
     if response.modified_count == 0:
         raise DatabaseNotModified(detail="Failed update user with device")
 
-    response = devices_collection_handle.insert_one(device.dict())
+    response = await devices_collection_handle.insert_one(device.dict())
     if not response.inserted_id:
         raise DatabaseNotModified(
             detail="Failed to create device with name " +
             request.device_name)
 
+    device_token = await get_auth_token_for_device(
+        device_id, user_id, user.tenant_id)
     return device_models.register_device.RegisterDeviceResponse(
-        device_id=response.inserted_id)
+        device_id=response.inserted_id, device_token=device_token)
 
 
 @router.get(
@@ -75,10 +86,23 @@ async def register_device(
     tags=[TAG],
     status_code=200,
 )
-async def fetch_device(device_id: Id, user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+async def fetch_device(device_id: Id,
+                       if_none_match: Optional[str] = Header(None),
+                       user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+    """
+    Answers with a 304 when `If-None-Match` holds the device's current
+    ETag, after reading only its version.
+    """
     # TODO @felipearce: add check if user is allowed to see this device
-    device = get_device_from_db_or_404(device_id)
-    return device_models.get_device.GetDeviceResponse(device=device)
+    if if_none_match:
+        etag = compute_etag([await get_device_version_from_db_or_404(device_id)])
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+
+    device = await get_device_from_db_or_404(device_id)
+    return trusted_response(
+        device_models.get_device.GetDeviceResponse.model_construct(device=device),
+        headers={"ETag": compute_etag([device.to_trusted_dict()])})
 
 
 @router.get(
@@ -88,8 +112,21 @@ async def fetch_device(device_id: Id, user_id: Id = Depends(get_user_id_from_hea
     tags=[TAG],
     status_code=200,
 )
-async def fetch_devices(user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+async def fetch_devices(if_none_match: Optional[str] = Header(None),
+                        user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+    """
+    Answers with a 304 when `If-None-Match` holds the current ETag of the
+    user's devices, after reading only their ids and versions.
+    """
     # TODO @felipearce: add check if user is allowed to see this
-    get_db_user_or_throw_if_404(user_id)
-    devices = get_many_devices_from_db_or_404_by_user_id(user_id)
-    return device_models.get_devices.GetDevicesResponse(devices=devices)
+    await get_principal_or_throw_if_404(user_id)
+    if if_none_match:
+        etag = compute_etag(
+            await get_device_versions_from_db_or_404_by_user_id(user_id))
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+
+    devices = await get_many_devices_from_db_or_404_by_user_id(user_id)
+    return trusted_response(
+        device_models.get_devices.GetDevicesResponse.model_construct(devices=devices),
+        headers={"ETag": compute_etag(devices)})
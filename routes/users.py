@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends
+from typing import Optional
+from fastapi import APIRouter, Depends, Header
 from config.db import get_users_collection
 from models.db.auth import Token
 import models.routes.users as models
@@ -6,10 +7,13 @@ from models.db.common import Id
 from utils.errors import (
     InvalidPasswordException,
 )
-from utils.users import register_user_to_db_and_get_secrets, validate_user_id_or_throw, get_db_user_or_throw_if_404, register_user_to_db
-from utils.auth import get_auth_token_from_user_id, get_user_id_from_header_and_check_existence, hash_and_compare
+from utils.users import register_user_to_db_and_get_secrets, validate_user_id_or_throw, get_db_user_or_throw_if_404, get_user_version_from_db_or_404, register_user_to_db
+from utils.etags import compute_etag, etag_matches, not_modified_response
+from utils.responses import trusted_response
+from utils.server_timing import TimedRoute
+from utils.auth import get_auth_token_from_user_id, get_user_id_from_header_and_check_existence, hash_and_compare_in_executor
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 ROUTE_BASE = "/users"
 TAG = "users"
 
@@ -21,11 +25,24 @@ TAG = "users"
     tags=[TAG],
     status_code=200,
 )
-async def get_user(user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+async def get_user(if_none_match: Optional[str] = Header(None),
+                   user_id: Id = Depends(get_user_id_from_header_and_check_existence)):
+    """
+    Answers with a 304 when `If-None-Match` holds the user's current ETag,
+    after reading only its version.
+    """
     validate_user_id_or_throw(user_id)
 
-    user = get_db_user_or_throw_if_404(user_id)
-    return models.get_user.GetUserResponse(**user.dict())
+    if if_none_match:
+        etag = compute_etag([await get_user_version_from_db_or_404(user_id)])
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+
+    user = await get_db_user_or_throw_if_404(user_id)
+    user_dict = user.to_trusted_dict()
+    return trusted_response(
+        models.get_user.GetUserResponse.from_trusted(user_dict),
+        headers={"ETag": compute_etag([user_dict])})
 
 
 @router.post(
@@ -36,7 +53,7 @@ async def get_user(user_id: Id = Depends(get_user_id_from_header_and_check_exist
     status_code=201,
 )
 async def register_user(user_register_form: models.RegisterUserRequest):
-    (_, user_id, secret) = register_user_to_db_and_get_secrets(user_register_form)
+    (_, user_id, secret) = await register_user_to_db_and_get_secrets(user_register_form)
 
     auth_token_str = await get_auth_token_from_user_id(user_id)
     device_secret = Token.get_enc_token_str_from_dict(
@@ -60,8 +77,8 @@ async def login_user(login_form: models.LoginUserRequest):
     user_id = login_form.user_id
     validate_user_id_or_throw(user_id)
 
-    user = get_db_user_or_throw_if_404(user_id)
-    if hash_and_compare(login_form.password, user.password_hash):
+    user = await get_db_user_or_throw_if_404(user_id)
+    if await hash_and_compare_in_executor(login_form.password, user.password_hash):
         auth_token_str = await get_auth_token_from_user_id(user_id)
         return models.LoginUserResponse(jwt=auth_token_str)
     else:
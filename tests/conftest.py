@@ -8,6 +8,7 @@
 pytest `conftest.py` file that holds global fixtures for tests
 """
 import os
+import time
 import logging
 from typing import Callable, Dict, Any, Optional
 import uuid
@@ -28,6 +29,7 @@ from models.db.device import Device
 import models.routes.users as user_models
 import models.db.common as common_models
 import models.db as db_models
+from utils.auth import get_auth_token_for_device
 from utils.commands import get_command_from_db_or_404
 import utils.users as user_utils
 import utils.devices as device_utils
@@ -87,6 +89,7 @@ def run_around_tests():
     yield
     global_database_instance = get_db_instance()
     global_database_instance.clear_test_collections()
+    user_utils.PRINCIPAL_CACHE.clear()
 
 
 @pytest.fixture(scope='function')
@@ -233,7 +236,7 @@ def register_user_reg_form_to_db(
     user_data = get_user_from_user_reg_form(reg_form)
 
     # user ID auto-instanciates so we reassign it to the actual ID
-    user_id = user_utils.register_user_to_db(reg_form)
+    user_id = async_to_sync(user_utils.register_user_to_db)(reg_form)
     user_data.id = user_id
 
     return user_data
@@ -315,7 +318,8 @@ def generate_random_register_user_request(
 @pytest.fixture(autouse=True)
 def get_user_from_db():
     def _get_user_from_db(identifier: str | common_models.Id):
-        user = user_utils.get_db_user_or_throw_if_404(identifier)
+        user = async_to_sync(
+            user_utils.get_db_user_or_throw_if_404)(identifier)
         return user
 
     return _get_user_from_db
@@ -324,7 +328,8 @@ def get_user_from_db():
 @pytest.fixture(autouse=True)
 def get_device_from_db():
     def _get_device_from_db(identifier: common_models.Id):
-        device = device_utils.get_device_from_db_or_404(identifier)
+        device = async_to_sync(
+            device_utils.get_device_from_db_or_404)(identifier)
         return device
 
     return _get_device_from_db
@@ -337,7 +342,8 @@ def unregistered_command_factory():
             "status": CommandStatus.Pending,  # default status
             "name": CommandNames.Update,
             "device_id": str(uuid.uuid4()),
-            "issuer_id": str(uuid.uuid4())
+            "issuer_id": str(uuid.uuid4()),
+            "created_at": time.time()
         }
         command = Command(**command_data)
         return command
@@ -370,7 +376,7 @@ def registered_command(registered_command_factory):
 @pytest.fixture(scope='function')
 def get_command_from_db():
     def _factory(command_id: common_models.Id):
-        return get_command_from_db_or_404(command_id)
+        return async_to_sync(get_command_from_db_or_404)(command_id)
     return _factory
 
 
@@ -430,3 +436,18 @@ def get_header_dict_from_user_id(
         return headers_dict
 
     return _generate_header_for_user_id
+
+
+@pytest.fixture(scope="function")
+def get_header_dict_from_device(
+) -> Callable[[Device], Dict[str, Any]]:
+    """
+    Returns an inner function that creates a valid device token header
+    dict for the given device, as minted at device registration
+    """
+    def _generate_header_for_device(device: Device) -> Dict[str, Any]:
+        encoded_token_str = async_to_sync(get_auth_token_for_device)(
+            device.get_id(), device.user_id, str(uuid.uuid4()))
+        return {"Token": encoded_token_str}
+
+    return _generate_header_for_device
@@ -0,0 +1,40 @@
+import time
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from pymongo.errors import ServerSelectionTimeoutError
+
+from app import app
+
+
+def wait_until_ready(client: TestClient, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    response = client.get("/ready")
+    while response.status_code != 200 and time.monotonic() < deadline:
+        time.sleep(0.01)
+        response = client.get("/ready")
+    return response
+
+
+class TestReadiness:
+    def test_not_ready_before_initialization(self):
+        with patch('app.initialize_database', side_effect=lambda: time.sleep(0.2)):
+            with TestClient(app) as client:
+                response = client.get("/ready")
+                assert response.status_code == 503
+                assert "initialization" in response.json().get("detail")
+
+    def test_ready_after_initialization(self):
+        with TestClient(app) as client:
+            response = wait_until_ready(client)
+        assert response.status_code == 200
+        assert response.json() == {"ready": True}
+
+    def test_initialization_retried_until_database_reachable(self):
+        init = patch('app.initialize_database',
+                     side_effect=[ServerSelectionTimeoutError("down"), {}])
+        with init as mock_init, patch('app.DB_INIT_RETRY_SECONDS', 0):
+            with TestClient(app) as client:
+                response = wait_until_ready(client)
+        assert response.status_code == 200
+        assert mock_init.call_count == 2
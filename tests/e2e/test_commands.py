@@ -1,7 +1,9 @@
+import json
 import logging
 from typing import Dict, Callable, Any
 import pytest
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 from requests.models import Response as HTTPResponse
 from icecream import ic
 from models.db.command import Command, CommandNames, CommandStatus
@@ -10,6 +12,7 @@ import models.db.user as user_models
 from models.db.auth import Token
 
 from app import app
+from config.db import get_commands_collection
 from models.routes.commands.command_status import CommandStatusRequest
 from models.routes.commands.create_batch import CreateBatchRequest
 from models.routes.commands.create_command import CreateCommandRequest
@@ -77,6 +80,68 @@ class TestGetBatchCommands:
         assert not check_get_batch_commands_response_valid(response, cmds)
 
 
+class TestGetAllCommandsForDevice:
+    def test_get_all_commands_paginated(
+            self, registered_command_factory, registered_device, get_header_dict_from_user_id, registered_user):
+        cmds = [
+            registered_command_factory(
+                device_id=registered_device.get_id()) for _ in range(5)]
+        endpoint_url = get_command_endpoint_str() + "/batch/get/all"
+        headers = get_header_dict_from_user_id(registered_user.get_id())
+
+        seen_ids = []
+        params = {"device_id": registered_device.get_id(), "limit": 2}
+        for expected_page_size in [2, 2, 1]:
+            response = client.get(
+                endpoint_url, params=params, headers=headers)
+            assert response.status_code == 200
+            page = response.json().get("commands")
+            assert len(page) == expected_page_size
+            seen_ids.extend(x.get("_id") for x in page)
+            params["after"] = response.json().get("next_cursor")
+
+        assert params["after"] is None
+        assert seen_ids == [cmd.get_id() for cmd in cmds]
+
+    def test_get_all_commands_stream(
+            self, registered_command_factory, registered_device, get_header_dict_from_user_id, registered_user):
+        cmds = [
+            registered_command_factory(
+                device_id=registered_device.get_id()) for _ in range(3)]
+        endpoint_url = get_command_endpoint_str() + "/batch/get/all"
+        response = client.get(
+            endpoint_url,
+            params={"device_id": registered_device.get_id(), "stream": True},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(x) for x in response.text.splitlines()]
+        assert len(lines) == len(cmds)
+        for cmd, line in zip(cmds, lines):
+            assert check_command_dicts_same(cmd, line)
+
+    def test_get_all_commands_no_commands_fail(
+            self, registered_device, get_header_dict_from_user_id, registered_user):
+        endpoint_url = get_command_endpoint_str() + "/batch/get/all"
+        response = client.get(
+            endpoint_url,
+            params={"device_id": registered_device.get_id()},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+        assert response.status_code == 404
+        assert "No commands found" in response.json().get("detail")
+
+    def test_get_all_commands_bad_cursor_fail(
+            self, registered_device, get_header_dict_from_user_id, registered_user):
+        endpoint_url = get_command_endpoint_str() + "/batch/get/all"
+        response = client.get(
+            endpoint_url,
+            params={"device_id": registered_device.get_id(),
+                    "after": "not-a-cursor"},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+        assert response.status_code == 422
+
+
 class TestCreateCommand:
     def test_create_command_success(
             self, registered_device, registered_user, get_register_command_req, get_device_from_db, get_header_dict_from_user_id):
@@ -135,6 +200,7 @@ class TestCreateBatchCommand:
         expected_ids = len(ids)
         for device in devices:
             db_device = get_device_from_db(device.get_id())
+            assert len(db_device.command_ids) == 1
             [ids.add(x) for x in db_device.command_ids]
         assert len(ids) == expected_ids
 
@@ -156,9 +222,31 @@ class TestCreateBatchCommand:
         assert unregistered_device.get_id() in response.json().get("detail")
 
 
+    def test_create_batch_command_fail_reports_all_missing(
+            self, registered_device, unregistered_device_factory, registered_user, get_header_dict_from_user_id):
+        missing = [unregistered_device_factory() for _ in range(2)]
+        json_dict = CreateBatchRequest(**{
+            "device_ids": [registered_device.get_id()] + [device.get_id() for device in missing],
+            "name": CommandNames.Update,
+            "issuer_id": registered_user.get_id()
+        }).model_dump()
+        endpoint_url = get_command_endpoint_str() + "/batch/create"
+        response = client.post(
+            endpoint_url,
+            json=json_dict,
+            headers=get_header_dict_from_user_id(
+                registered_user.get_id()))
+        assert response.status_code == 404
+        detail = response.json().get("detail")
+        assert all(device.get_id() in detail for device in missing)
+        assert registered_device.get_id() not in detail
+
+
 class TestUpdateCommandStatus:
     def test_update_command_status_success(
-            self, registered_command, get_update_status_request_factory, get_command_from_db, get_header_dict_from_user_id, registered_user):
+            self, registered_command_factory, registered_device_factory, get_update_status_request_factory, get_command_from_db, get_header_dict_from_user_id, registered_user):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        registered_command = registered_command_factory(device_id=device.get_id())
         status = get_command_from_db(registered_command.get_id()).status
         assert status == CommandStatus.Pending.value
 
@@ -189,6 +277,154 @@ class TestUpdateCommandStatus:
         assert unregistered_command.get_id() in response.json().get("detail")
 
 
+class TestUpdateCommandStatusBulk:
+    def test_update_command_status_bulk_success(
+            self, registered_command_factory, registered_device_factory, unregistered_command, get_update_status_request_factory, get_command_from_db, get_header_dict_from_user_id, registered_user):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        cmds = [registered_command_factory(device_id=device.get_id()) for _ in range(2)]
+        updates = [
+            get_update_status_request_factory(
+                cmds[0].get_id(), CommandStatus.Running),
+            get_update_status_request_factory(
+                cmds[1].get_id(), CommandStatus.Terminated),
+            get_update_status_request_factory(
+                unregistered_command.get_id(), CommandStatus.Running),
+        ]
+
+        endpoint_url = get_command_endpoint_str() + "/update/status/bulk"
+        response = client.patch(
+            endpoint_url,
+            json={"updates": updates},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+
+        assert response.status_code == 200
+        results = response.json().get("results")
+        assert [x.get("command_id") for x in results] == [
+            x.get("command_id") for x in updates]
+        assert [x.get("outcome") for x in results] == [
+            "Updated", "Updated", "NotFound"]
+        assert unregistered_command.get_id() in results[2].get("detail")
+        status = get_command_from_db(cmds[0].get_id()).status
+        assert status == CommandStatus.Running.value
+        status = get_command_from_db(cmds[1].get_id()).status
+        assert status == CommandStatus.Terminated.value
+
+    def test_update_command_status_bulk_empty_fail(
+            self, get_header_dict_from_user_id, registered_user):
+        endpoint_url = get_command_endpoint_str() + "/update/status/bulk"
+        response = client.patch(
+            endpoint_url,
+            json={"updates": []},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+        assert response.status_code == 422
+
+    def test_update_command_status_bulk_duplicate_ids_fail(
+            self, registered_command, get_update_status_request_factory, get_command_from_db, get_header_dict_from_user_id, registered_user):
+        updates = [
+            get_update_status_request_factory(
+                registered_command.get_id(), CommandStatus.Running),
+            get_update_status_request_factory(
+                registered_command.get_id(), CommandStatus.Terminated),
+        ]
+
+        endpoint_url = get_command_endpoint_str() + "/update/status/bulk"
+        response = client.patch(
+            endpoint_url,
+            json={"updates": updates},
+            headers=get_header_dict_from_user_id(registered_user.get_id()))
+
+        assert response.status_code == 422
+        assert "Duplicate command ids" in response.text
+        status = get_command_from_db(registered_command.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+    def test_update_command_status_bulk_device_token_scoped(
+            self, registered_command_factory, registered_device, get_update_status_request_factory, get_command_from_db, get_header_dict_from_device):
+        own = registered_command_factory(device_id=registered_device.get_id())
+        other = registered_command_factory()
+        updates = [
+            get_update_status_request_factory(
+                own.get_id(), CommandStatus.Running),
+            get_update_status_request_factory(
+                other.get_id(), CommandStatus.Running),
+        ]
+
+        endpoint_url = get_command_endpoint_str() + "/update/status/bulk"
+        response = client.patch(
+            endpoint_url,
+            json={"updates": updates},
+            headers=get_header_dict_from_device(registered_device))
+
+        assert response.status_code == 200
+        results = response.json().get("results")
+        assert [x.get("outcome") for x in results] == ["Updated", "NotFound"]
+        status = get_command_from_db(other.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+
+class TestAgentRoutesDeviceOwnership:
+    """
+    User tokens reach the agent routes only for the user's own devices.
+    """
+    @pytest.fixture
+    def other_users_command(self, registered_user, registered_device_factory, registered_command_factory):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        return device, registered_command_factory(device_id=device.get_id())
+
+    @pytest.fixture
+    def intruder_headers(self, registered_user_factory, get_header_dict_from_user_id):
+        intruder, _ = registered_user_factory()
+        return get_header_dict_from_user_id(intruder.get_id())
+
+    def test_claim_other_users_device_fail(
+            self, other_users_command, intruder_headers, get_command_from_db):
+        device, command = other_users_command
+        response = client.post(
+            get_command_endpoint_str() + "/claim",
+            json={"device_id": device.get_id()},
+            headers=intruder_headers)
+        assert response.status_code == 401
+        assert "does not belong" in response.json().get("detail")
+        status = get_command_from_db(command.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+    def test_poll_other_users_device_fail(
+            self, other_users_command, intruder_headers):
+        device, _ = other_users_command
+        response = client.get(
+            get_command_endpoint_str() + "/recent",
+            params={"device_id": device.get_id()},
+            headers=intruder_headers)
+        assert response.status_code == 401
+        assert "does not belong" in response.json().get("detail")
+
+    def test_update_status_other_users_command_fail(
+            self, other_users_command, intruder_headers, get_update_status_request_factory, get_command_from_db):
+        _, command = other_users_command
+        response = client.patch(
+            get_command_endpoint_str() + "/update/status",
+            json=get_update_status_request_factory(
+                command.get_id(), CommandStatus.Running),
+            headers=intruder_headers)
+        assert response.status_code == 404
+        status = get_command_from_db(command.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+    def test_bulk_update_status_other_users_command_fail(
+            self, other_users_command, intruder_headers, get_update_status_request_factory, get_command_from_db):
+        _, command = other_users_command
+        response = client.patch(
+            get_command_endpoint_str() + "/update/status/bulk",
+            json={"updates": [get_update_status_request_factory(
+                command.get_id(), CommandStatus.Running)]},
+            headers=intruder_headers)
+        assert response.status_code == 200
+        results = response.json().get("results")
+        assert [x.get("outcome") for x in results] == ["NotFound"]
+        status = get_command_from_db(command.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+
 @pytest.fixture
 def get_recent_command_request_factory():
     def __get_recent_command_request(device_id: Id) -> Dict[str, Any]:
@@ -198,7 +434,7 @@ def get_recent_command_request_factory():
 
 class TestGetRecentCommand:
     def test_get_recent_command_success(
-            self, registered_command_factory, registered_device, get_recent_command_request_factory, get_header_dict_from_user_id):
+            self, registered_command_factory, registered_device, get_recent_command_request_factory, get_header_dict_from_device):
         cmds = [
             registered_command_factory(
                 device_id=registered_device.get_id()) for _ in range(3)]
@@ -208,8 +444,7 @@ class TestGetRecentCommand:
         response = client.get(
             endpoint_url,
             params=json,
-            headers=get_header_dict_from_user_id(
-                registered_device.user_id))
+            headers=get_header_dict_from_device(registered_device))
         assert check_get_command_response_valid(response, cmds[0])
 
     def test_get_recent_command_no_device_fail(
@@ -226,18 +461,225 @@ class TestGetRecentCommand:
         assert unregistered_device.get_id() in response.json().get("detail")
 
     def test_get_recent_command_no_commands_fail(
-            self, registered_device, get_recent_command_request_factory, get_header_dict_from_user_id):
+            self, registered_device, get_recent_command_request_factory, get_header_dict_from_device):
         endpoint_url = get_command_endpoint_str() + "/recent"
         json = get_recent_command_request_factory(registered_device.get_id())
         response = client.get(
             endpoint_url,
             params=json,
-            headers=get_header_dict_from_user_id(
-                registered_device.user_id))
+            headers=get_header_dict_from_device(registered_device))
         assert response.status_code == 404
         assert "No commands found" in response.json().get("detail")
         assert registered_device.get_id() in response.json().get("detail")
 
+    def test_get_recent_command_other_device_token_fail(
+            self, registered_device_factory, get_recent_command_request_factory, get_header_dict_from_device):
+        device, other_device = registered_device_factory(), registered_device_factory()
+        endpoint_url = get_command_endpoint_str() + "/recent"
+        response = client.get(
+            endpoint_url,
+            params=get_recent_command_request_factory(device.get_id()),
+            headers=get_header_dict_from_device(other_device))
+        assert response.status_code == 401
+
+    def test_get_recent_command_no_token_fail(
+            self, registered_device, get_recent_command_request_factory):
+        endpoint_url = get_command_endpoint_str() + "/recent"
+        response = client.get(
+            endpoint_url,
+            params=get_recent_command_request_factory(registered_device.get_id()))
+        assert response.status_code == 422
+        assert "Missing header token" in response.json().get("detail")
+
+
+class TestClaimCommands:
+    def test_claim_single_command_success(
+            self, registered_command_factory, registered_device, get_command_from_db, get_header_dict_from_device):
+        cmds = [
+            registered_command_factory(
+                device_id=registered_device.get_id()) for _ in range(3)]
+
+        endpoint_url = get_command_endpoint_str() + "/claim"
+        response = client.post(
+            endpoint_url,
+            json={"device_id": registered_device.get_id()},
+            headers=get_header_dict_from_device(registered_device))
+
+        assert response.status_code == 200
+        claimed = response.json().get("commands")
+        assert len(claimed) == 1
+        assert claimed[0].get("_id") == cmds[0].get_id()
+        assert claimed[0].get("status") == CommandStatus.Sent.value
+        status = get_command_from_db(cmds[0].get_id()).status
+        assert status == CommandStatus.Sent.value
+        status = get_command_from_db(cmds[1].get_id()).status
+        assert status == CommandStatus.Pending.value
+
+    def test_claim_legacy_command_without_created_at_first(
+            self, registered_command_factory, unregistered_command, registered_device,
+            get_header_dict_from_device):
+        registered_command_factory(device_id=registered_device.get_id())
+        legacy = unregistered_command.dict()
+        legacy["device_id"] = registered_device.get_id()
+        del legacy["created_at"]
+        get_commands_collection().insert_one(legacy)
+
+        endpoint_url = get_command_endpoint_str() + "/claim"
+        response = client.post(
+            endpoint_url,
+            json={"device_id": registered_device.get_id()},
+            headers=get_header_dict_from_device(registered_device))
+
+        assert response.status_code == 200
+        [claimed] = response.json().get("commands")
+        assert claimed.get("_id") == unregistered_command.get_id()
+        # not made up from the time it was read
+        assert claimed.get("created_at") is None
+
+    def test_claim_batch_never_repeats(
+            self, registered_command_factory, registered_device, get_header_dict_from_device):
+        cmds = [
+            registered_command_factory(
+                device_id=registered_device.get_id()) for _ in range(3)]
+
+        endpoint_url = get_command_endpoint_str() + "/claim"
+        json = {"device_id": registered_device.get_id(), "limit": 2}
+        headers = get_header_dict_from_device(registered_device)
+        first = client.post(endpoint_url, json=json, headers=headers)
+        second = client.post(endpoint_url, json=json, headers=headers)
+        third = client.post(endpoint_url, json=json, headers=headers)
+
+        assert first.status_code == 200
+        assert second.status_code == 200
+        first_ids = [x.get("_id") for x in first.json().get("commands")]
+        second_ids = [x.get("_id") for x in second.json().get("commands")]
+        assert first_ids == [cmd.get_id() for cmd in cmds[:2]]
+        assert second_ids == [cmds[2].get_id()]
+        assert third.status_code == 404
+        assert "No commands found" in third.json().get("detail")
+
+    def test_claim_no_device_fail(self, unregistered_device, get_header_dict_from_device):
+        endpoint_url = get_command_endpoint_str() + "/claim"
+        response = client.post(
+            endpoint_url,
+            json={"device_id": unregistered_device.get_id()},
+            headers=get_header_dict_from_device(unregistered_device))
+        assert response.status_code == 404
+        assert "No device found" in response.json().get("detail")
+
+
+class TestDeviceCommandChannel:
+    def test_channel_sends_pending_and_new_commands(
+            self, registered_device_factory, registered_user, registered_command_factory, get_register_command_req, get_header_dict_from_user_id):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        pending = registered_command_factory(device_id=device.get_id())
+        headers = get_header_dict_from_user_id(registered_user.get_id())
+        endpoint_url = get_command_endpoint_str() + "/ws"
+
+        with client.websocket_connect(
+                endpoint_url + f"?device_id={device.get_id()}",
+                headers=headers) as websocket:
+            message = websocket.receive_json()
+            assert message.get("type") == "command"
+            pending.status = CommandStatus.Sent.value
+            assert check_command_dicts_same(pending, message.get("command"))
+
+            json_dict = get_register_command_req(
+                device.get_id(), CommandNames.Update, registered_user.get_id())
+            response = client.post(
+                get_command_endpoint_str() + "/create",
+                json=json_dict,
+                headers=headers)
+            assert check_create_command_response_valid(response)
+
+            message = websocket.receive_json()
+            assert message.get("type") == "command"
+            assert message.get("command").get(
+                "_id") == response.json().get("command_id")
+
+    def test_channel_claims_sent_commands(
+            self, registered_device_factory, registered_user, registered_command_factory, get_register_command_req, get_command_from_db, get_header_dict_from_user_id):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        pending = registered_command_factory(device_id=device.get_id())
+        headers = get_header_dict_from_user_id(registered_user.get_id())
+        endpoint_url = get_command_endpoint_str() + "/ws"
+
+        with client.websocket_connect(
+                endpoint_url + f"?device_id={device.get_id()}",
+                headers=headers) as websocket:
+            message = websocket.receive_json()
+            assert message.get("command").get("_id") == pending.get_id()
+
+            json_dict = get_register_command_req(
+                device.get_id(), CommandNames.Update, registered_user.get_id())
+            response = client.post(
+                get_command_endpoint_str() + "/create",
+                json=json_dict,
+                headers=headers)
+            assert check_create_command_response_valid(response)
+            created_id = response.json().get("command_id")
+
+            # the backlog command isn't sent again along with the new one
+            message = websocket.receive_json()
+            assert message.get("command").get("_id") == created_id
+
+            response = client.post(
+                get_command_endpoint_str() + "/claim",
+                json={"device_id": device.get_id()},
+                headers=headers)
+            assert response.status_code == 404
+
+        for command_id in (pending.get_id(), created_id):
+            status = get_command_from_db(command_id).status
+            assert status == CommandStatus.Sent.value
+
+    def test_channel_status_update_success(
+            self, registered_device_factory, registered_user, registered_command_factory, get_command_from_db, get_header_dict_from_user_id):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        command = registered_command_factory(device_id=device.get_id())
+        endpoint_url = get_command_endpoint_str() + "/ws"
+
+        with client.websocket_connect(
+                endpoint_url + f"?device_id={device.get_id()}",
+                headers=get_header_dict_from_user_id(registered_user.get_id())) as websocket:
+            websocket.receive_json()
+            websocket.send_json({"type": "status",
+                                 "command_id": command.get_id(),
+                                 "status": CommandStatus.Running.value})
+            message = websocket.receive_json()
+            assert message.get("type") == "status_ack"
+            assert message.get("command_id") == command.get_id()
+
+        status = get_command_from_db(command.get_id()).status
+        assert status == CommandStatus.Running.value
+
+    def test_channel_status_update_other_device_fail(
+            self, registered_device_factory, registered_user, registered_command, get_command_from_db, get_header_dict_from_user_id):
+        device = registered_device_factory(user_id=registered_user.get_id())
+        endpoint_url = get_command_endpoint_str() + "/ws"
+
+        with client.websocket_connect(
+                endpoint_url + f"?device_id={device.get_id()}",
+                headers=get_header_dict_from_user_id(registered_user.get_id())) as websocket:
+            websocket.send_json({"type": "status",
+                                 "command_id": registered_command.get_id(),
+                                 "status": CommandStatus.Running.value})
+            message = websocket.receive_json()
+            assert message.get("type") == "error"
+            assert "No command found" in message.get("detail")
+
+        status = get_command_from_db(registered_command.get_id()).status
+        assert status == CommandStatus.Pending.value
+
+    def test_channel_wrong_user_fail(
+            self, registered_device, registered_user, get_header_dict_from_user_id):
+        endpoint_url = get_command_endpoint_str() + "/ws"
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(
+                    endpoint_url + f"?device_id={registered_device.get_id()}",
+                    headers=get_header_dict_from_user_id(registered_user.get_id())) as websocket:
+                websocket.receive_json()
+
 
 @pytest.fixture
 def get_get_command_req():
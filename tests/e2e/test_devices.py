@@ -6,6 +6,8 @@ from requests.models import Response as HTTPResponse
 from icecream import ic
 import models.db.user as user_models
 from models.db.auth import Token
+from config.db import get_devices_collection
+from utils.devices import get_command_ids_push_update
 
 from app import app
 
@@ -68,6 +70,39 @@ class TestRegisterDevice:
         device = get_device_from_db(response.json().get("device_id"))
         assert device.user_id == registered_user.get_id()
 
+    def test_register_device_token_scoped_to_device(self, get_register_device_req: Callable[[
+            str, str, str], Dict[str, Any]], registered_user_orig) -> None:
+        """
+        The minted device token authenticates agent routes for its own
+        device only, and is refused by user routes
+        """
+        registered_user, registered_user_form = registered_user_orig
+        device_secret = Token.get_enc_token_str_from_dict(
+            {"secret": registered_user_form.raw_user_secret, "user_id": registered_user.get_id()})
+        json_dict = get_register_device_req(
+            "test_device",
+            registered_user.get_id(),
+            registered_user.get_id(),
+            device_secret)
+        response = client.post(
+            get_device_register_endpoint_string(),
+            json=json_dict)
+        device_id = response.json().get("device_id")
+        headers = {"Token": response.json().get("device_token")}
+
+        claims = Token.get_verified_claims(headers["Token"])
+        assert claims.get("device_id") == device_id
+        assert claims.get("user_id") == registered_user.get_id()
+        assert claims.get("tenant_id") == registered_user.tenant_id
+
+        response = client.get("/commands/recent",
+                              params={"device_id": device_id}, headers=headers)
+        assert response.status_code == 404
+        assert "No commands found" in response.json().get("detail")
+
+        response = client.get("/devices/get/all", headers=headers)
+        assert response.status_code == 401
+
     def test_register_device_fail_no_user(self, unregistered_user: user_models.DbUser, get_register_device_req: Callable[[
             str, str, str], Dict[str, Any]], get_header_dict_from_user_id, registered_user) -> None:
         """
@@ -120,6 +155,35 @@ class TestGetDevice:
         assert response.json().get(
             "detail") == f"No device found with id {unregistered_device.get_id()}"
 
+    def test_get_device_not_modified_until_written(
+            self, registered_device_factory, get_header_dict_from_user_id, registered_user):
+        """
+        Repeats the query with the ETag of the first response, expecting a
+        304 until a command is pushed to the device.
+        """
+        registered_device = registered_device_factory(registered_user.get_id())
+        endpoint_url = "/devices/get"
+        params = {"device_id": registered_device.get_id()}
+        headers = get_header_dict_from_user_id(registered_user.get_id())
+
+        etag = client.get(endpoint_url, params=params, headers=headers).headers["etag"]
+        response = client.get(endpoint_url, params=params,
+                              headers={**headers, "If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert response.content == b""
+
+        get_devices_collection().update_one(
+            {"_id": registered_device.get_id()},
+            get_command_ids_push_update(["command-id"]))
+        response = client.get(endpoint_url, params=params,
+                              headers={**headers, "If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert response.json()["device"]["command_ids"] == ["command-id"]
+
 
 class TestGetDevices:
     def test_get_devices_by_user_id_successful(
@@ -140,6 +204,30 @@ class TestGetDevices:
         assert response.json().get("devices")[0].get(
             "_id") == registered_device.get_id()
 
+    def test_get_devices_not_modified_until_device_added(
+            self, registered_user, registered_device_factory, get_header_dict_from_user_id):
+        """
+        Repeats the query with the ETag of the first response, expecting a
+        304 until the user gets another device.
+        """
+        registered_device_factory(registered_user.get_id())
+        endpoint_url = "/devices/get/all"
+        headers = get_header_dict_from_user_id(registered_user.get_id())
+
+        etag = client.get(endpoint_url, headers=headers).headers["etag"]
+        response = client.get(endpoint_url,
+                              headers={**headers, "If-None-Match": etag})
+
+        assert response.status_code == 304
+
+        registered_device_factory(registered_user.get_id())
+        response = client.get(endpoint_url,
+                              headers={**headers, "If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert len(response.json()["devices"]) == 2
+
     def test_get_devices_by_user_id_404_no_user_fail(
             self, unregistered_user, get_header_dict_from_user_id):
         """
@@ -96,6 +96,24 @@ class TestGetRegularUser:
         assert check_get_user_response_valid(response)
         assert check_user_matches_response(response, registered_user_redacted)
 
+    def test_get_user_not_modified(
+            self, registered_user_redacted: db_user_models.DbUserRedacted,
+            get_header_dict_from_user_id):
+        """
+        Repeats the query with the ETag of the first response, expecting a
+        304 with no body.
+        """
+        endpoint_url = get_user_query_endpoint_string()
+        headers = get_header_dict_from_user_id(registered_user_redacted.get_id())
+
+        etag = client.get(endpoint_url, headers=headers).headers["etag"]
+        response = client.get(endpoint_url,
+                              headers={**headers, "If-None-Match": f'"other", {etag}'})
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert response.content == b""
+
     def test_get_nonexistent_user_fail(
         self, unregistered_user: db_user_models.DbUserRedacted,
         get_identifier_dict_from_user: Callable[
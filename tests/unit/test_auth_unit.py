@@ -0,0 +1,178 @@
+from datetime import timedelta
+import time
+from unittest.mock import patch
+
+import bcrypt
+import jwt
+import pytest
+
+from config.db import get_users_collection
+
+from models.db.auth import Token, VERIFIED_CLAIMS_CACHE
+from utils.cache import ExpiringLRUCache
+from utils.auth import hash_and_compare_in_executor
+from utils.errors import DefaultDataNotFoundException, ServiceUnavailableException
+import utils.hashing as hashing
+import utils.users as user_utils
+
+
+class TestVerifiedClaimsUnit:
+    def test_valid_token_decoded_once(self):
+        # Arrange
+        token = Token.get_enc_token_str_from_dict({"user_id": "some-id"})
+
+        # Act
+        with patch("models.db.auth.jwt.decode", wraps=jwt.decode) as decode:
+            first = Token.get_verified_claims(token)
+            second = Token.get_verified_claims(token)
+
+        # Assert
+        assert first.get("user_id") == "some-id"
+        assert second == first
+        assert decode.call_count == 1
+
+    def test_expired_token_rejected(self):
+        # Arrange
+        token = Token.get_enc_token_str_from_dict(
+            {"user_id": "some-id"}, expiry_time=timedelta(seconds=-1))
+
+        # Act
+        claims = Token.get_verified_claims(token)
+
+        # Assert
+        assert claims is None
+        assert VERIFIED_CLAIMS_CACHE.get(token) is None
+
+    def test_tampered_token_rejected(self):
+        # Arrange
+        token = Token.get_enc_token_str_from_dict({"user_id": "some-id"})
+        tampered = token[:-2] + ("AA" if token[-2:] != "AA" else "BB")
+
+        # Act
+        claims = Token.get_verified_claims(tampered)
+
+        # Assert
+        assert claims is None
+
+
+class TestExpiringLRUCacheUnit:
+    def test_evicts_least_recently_used(self):
+        # Arrange
+        cache = ExpiringLRUCache(max_size=2)
+        expires_at = time.time() + 60
+        cache.set("a", 1, expires_at)
+        cache.set("b", 2, expires_at)
+
+        # Act
+        cache.get("a")
+        cache.set("c", 3, expires_at)
+
+        # Assert
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_expired_entries_are_dropped(self):
+        # Arrange
+        cache = ExpiringLRUCache(max_size=2)
+        cache.set("a", 1, time.time() - 1)
+
+        # Act
+        value = cache.get("a")
+
+        # Assert
+        assert value is None
+        assert len(cache) == 0
+
+
+class TestPrincipalCacheUnit:
+    @pytest.mark.asyncio
+    async def test_principal_served_from_cache(self, registered_user):
+        # Arrange
+        user_id = registered_user.get_id()
+        principal = await user_utils.get_principal_or_throw_if_404(user_id)
+        get_users_collection().delete_one({"_id": user_id})
+
+        # Act
+        cached = await user_utils.get_principal_or_throw_if_404(user_id)
+
+        # Assert
+        assert cached == principal
+        assert cached.tenant_id == registered_user.tenant_id
+        assert cached.user_type == registered_user.user_type
+
+    @pytest.mark.asyncio
+    async def test_invalidated_principal_is_refetched(self, registered_user):
+        # Arrange
+        user_id = registered_user.get_id()
+        await user_utils.get_principal_or_throw_if_404(user_id)
+        get_users_collection().delete_one({"_id": user_id})
+
+        # Act
+        user_utils.invalidate_principal(user_id)
+        with pytest.raises(DefaultDataNotFoundException):
+            await user_utils.get_principal_or_throw_if_404(user_id)
+
+    @pytest.mark.asyncio
+    async def test_principal_cached_under_id_only(self, registered_user):
+        # Arrange
+        user_id = registered_user.get_id()
+
+        # Act
+        await user_utils.get_principal_or_throw_if_404(user_id)
+        with pytest.raises(DefaultDataNotFoundException):
+            await user_utils.get_principal_or_throw_if_404(registered_user.email)
+
+        # Assert
+        assert user_utils.PRINCIPAL_CACHE.get(user_id) is not None
+        assert len(user_utils.PRINCIPAL_CACHE) == 1
+
+
+class TestHashingExecutorUnit:
+    @pytest.mark.asyncio
+    async def test_hash_and_compare_in_executor(self):
+        # Arrange
+        hashed = await hashing.hash_secret(b"password")
+
+        # Act
+        matches = await hash_and_compare_in_executor("password", hashed)
+        mismatches = await hash_and_compare_in_executor("wrong", hashed)
+
+        # Assert
+        assert matches
+        assert not mismatches
+
+    @pytest.mark.asyncio
+    async def test_rejects_when_no_slot_is_free(self):
+        # Arrange
+        slots = hashing.threading.BoundedSemaphore(1)
+        slots.acquire()
+
+        # Act
+        with patch('utils.hashing.HASHING_SLOTS', slots):
+            with pytest.raises(ServiceUnavailableException) as exc_info:
+                await hashing.run_in_hashing_executor(bcrypt.gensalt)
+
+        # Assert
+        assert exc_info.value.status_code == 503
+
+    @pytest.mark.asyncio
+    async def test_rejects_when_queued_too_long(self):
+        # Arrange
+        release = hashing.threading.Event()
+        blocker = hashing.ThreadPoolExecutor(max_workers=1)
+        blocker.submit(release.wait)
+
+        # Act
+        try:
+            with patch('utils.hashing.HASHING_EXECUTOR', blocker), \
+                    patch('utils.hashing.HASH_QUEUE_TIMEOUT_SECONDS', 0.05):
+                with pytest.raises(ServiceUnavailableException):
+                    await hashing.run_in_hashing_executor(bcrypt.gensalt)
+        finally:
+            release.set()
+            blocker.shutdown()
+
+        # Assert
+        assert hashing.HASHING_SLOTS._value == \
+            hashing.HASH_WORKERS + hashing.HASH_QUEUE_LIMIT
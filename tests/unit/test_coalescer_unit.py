@@ -0,0 +1,119 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from config.db import get_commands_collection
+from models.db.command import CommandStatus
+from utils.coalescer import CommandStatusCoalescer
+from utils.errors import DatabaseError, DefaultDataNotFoundException
+
+
+@pytest.fixture
+def coalescer_factory():
+    coalescers = []
+
+    def _factory(window_seconds=0.05, max_batch=100):
+        collection = MagicMock(wraps=get_commands_collection())
+        coalescer = CommandStatusCoalescer(window_seconds, max_batch,
+                                           collection=lambda: collection)
+        coalescers.append(coalescer)
+        return coalescer, collection
+
+    yield _factory
+    for coalescer in coalescers:
+        coalescer.stop()
+
+
+class TestCommandStatusCoalescerUnit:
+    @pytest.mark.asyncio
+    async def test_latest_transition_wins_in_one_bulk_write(
+            self, registered_command_factory, coalescer_factory):
+        # Arrange
+        coalescer, collection = coalescer_factory()
+        first, second = registered_command_factory(), registered_command_factory()
+
+        # Act
+        await asyncio.gather(
+            coalescer.submit(first.get_id(), CommandStatus.Running.value),
+            coalescer.submit(second.get_id(), CommandStatus.Running.value),
+            coalescer.submit(first.get_id(), CommandStatus.Terminated.value))
+
+        # Assert
+        assert collection.bulk_write.call_count == 1
+        operations = collection.bulk_write.call_args.args[0]
+        assert len(operations) == 2
+        commands = get_commands_collection()
+        status = commands.find_one({"_id": first.get_id()})["status"]
+        assert status == CommandStatus.Terminated.value
+        status = commands.find_one({"_id": second.get_id()})["status"]
+        assert status == CommandStatus.Running.value
+
+    @pytest.mark.asyncio
+    async def test_missing_command_fails_only_its_callers(
+            self, registered_command, unregistered_command, coalescer_factory):
+        # Arrange
+        coalescer, _ = coalescer_factory()
+
+        # Act
+        results = await asyncio.gather(
+            coalescer.submit(registered_command.get_id(), CommandStatus.Running.value),
+            coalescer.submit(unregistered_command.get_id(), CommandStatus.Running.value),
+            return_exceptions=True)
+
+        # Assert
+        assert results[0] is None
+        assert isinstance(results[1], DefaultDataNotFoundException)
+        assert unregistered_command.get_id() in results[1].detail
+        status = get_commands_collection().find_one(
+            {"_id": registered_command.get_id()})["status"]
+        assert status == CommandStatus.Running.value
+
+    @pytest.mark.asyncio
+    async def test_device_scoped_update_of_other_device_not_found(
+            self, registered_command, coalescer_factory):
+        # Arrange
+        coalescer, collection = coalescer_factory()
+
+        # Act
+        with pytest.raises(DefaultDataNotFoundException):
+            await coalescer.submit(registered_command.get_id(),
+                                   CommandStatus.Running.value,
+                                   device_id="another-device")
+
+        # Assert
+        collection.bulk_write.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_full_batch_flushes_before_window(
+            self, registered_command_factory, coalescer_factory):
+        # Arrange
+        coalescer, collection = coalescer_factory(window_seconds=30, max_batch=2)
+        cmds = [registered_command_factory() for _ in range(2)]
+
+        # Act
+        await asyncio.wait_for(asyncio.gather(
+            *[coalescer.submit(cmd.get_id(), CommandStatus.Running.value) for cmd in cmds]),
+            timeout=5)
+
+        # Assert
+        assert collection.bulk_write.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_unexpected_error_fails_callers_instead_of_hanging(
+            self, registered_command_factory, coalescer_factory):
+        # Arrange
+        coalescer, collection = coalescer_factory()
+        collection.bulk_write.side_effect = RuntimeError("executor closed")
+        cmds = [registered_command_factory() for _ in range(2)]
+
+        # Act
+        results = await asyncio.wait_for(asyncio.gather(
+            *[coalescer.submit(cmd.get_id(), CommandStatus.Running.value) for cmd in cmds],
+            return_exceptions=True), timeout=5)
+
+        # Assert
+        assert all(isinstance(x, DatabaseError) for x in results)
+        collection.bulk_write.side_effect = None
+        await asyncio.wait_for(
+            coalescer.submit(cmds[0].get_id(), CommandStatus.Running.value), timeout=5)
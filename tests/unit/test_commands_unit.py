@@ -1,14 +1,22 @@
+import asyncio
 import logging
+import time
 from typing import Any
+import orjson
 from models.db.command import CommandNames, CommandStatus
 from models.db.common import Id
+from models.db.device import AgentPrincipal
 from models.routes.commands.command_status import CommandStatusRequest
 from models.routes.commands.create_batch import CreateBatchRequest
-from routes.commands import create_commands_for_multiple_devices, update_command_status
+from routes.commands import create_commands_for_multiple_devices, get_most_recent_command, update_command_status, update_command_status_bulk
+from models.routes.commands.bulk_command_status import BulkCommandStatusRequest
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
 from unittest.mock import MagicMock, patch
 import pytest
 
-from utils.errors import DatabaseNotModified
+from utils.errors import DatabaseNotModified, DefaultDataNotFoundException
+from utils.waiters import WAITERS, notify_command_waiters
 
 
 @pytest.fixture
@@ -22,6 +30,18 @@ def get_register_request_factory():
     return __get_register_request
 
 
+@pytest.fixture
+def device_agent(registered_device):
+    return AgentPrincipal(user_id=registered_device.user_id,
+                          device_id=registered_device.get_id())
+
+
+@pytest.fixture
+def user_agent(registered_user):
+    return AgentPrincipal(user_id=registered_user.get_id(),
+                          tenant_id=registered_user.tenant_id)
+
+
 class TestRegisterCommandBatchUnit:
     @pytest.mark.asyncio
     async def test_register_command_device_update_fails(
@@ -67,7 +87,7 @@ def get_update_status_request_factory():
 
 class TestUpdateStatusUnit:
     @pytest.mark.asyncio
-    async def test_update_command_status_fails(self, registered_command, get_update_status_request_factory):
+    async def test_update_command_status_fails(self, registered_command, get_update_status_request_factory, user_agent):
         # Arrange
         request = get_update_status_request_factory(
             registered_command.get_id(), CommandStatus.Running)
@@ -82,7 +102,7 @@ class TestUpdateStatusUnit:
 
             # Act
             try:
-                await update_command_status(request)
+                await update_command_status(request, user_agent)
                 assert False
             except DatabaseNotModified as e:
                 return e
@@ -94,3 +114,108 @@ class TestUpdateStatusUnit:
         # Assert
         assert exception.status_code == 500
         assert exception.detail == "Failed to update command status"
+
+
+class TestUpdateStatusBulkUnit:
+    @pytest.mark.asyncio
+    async def test_update_command_status_bulk_partial_failure(
+            self, registered_command_factory, get_update_status_request_factory, user_agent):
+        # Arrange
+        cmds = [registered_command_factory() for _ in range(2)]
+        request = BulkCommandStatusRequest(updates=[
+            get_update_status_request_factory(cmd.get_id(), CommandStatus.Running) for cmd in cmds])
+
+        @patch('routes.commands.commands_collection')
+        async def inner(mock_collection):
+            nested_mock = MagicMock()
+            nested_mock.find.return_value = [
+                {"_id": cmd.get_id()} for cmd in cmds]
+            nested_mock.bulk_write.side_effect = BulkWriteError({
+                "nMatched": 1,
+                "writeErrors": [{"index": 1, "errmsg": "write failed"}]})
+            mock_collection.return_value = nested_mock
+
+            # Act
+            return await update_command_status_bulk(request, user_agent)
+
+        response = await inner()
+        # Assert
+        outcomes = [result.outcome for result in response.results]
+        assert outcomes == ["Updated", "Failed"]
+        assert response.results[1].detail == "write failed"
+
+    @pytest.mark.asyncio
+    async def test_update_command_status_bulk_unmatched_is_not_found(
+            self, registered_command_factory, get_update_status_request_factory, user_agent):
+        # Arrange
+        cmds = [registered_command_factory() for _ in range(2)]
+        request = BulkCommandStatusRequest(updates=[
+            get_update_status_request_factory(cmd.get_id(), CommandStatus.Running) for cmd in cmds])
+
+        @patch('routes.commands.commands_collection')
+        async def inner(mock_collection):
+            nested_mock = MagicMock()
+            # the second command was deleted before the write reached it
+            nested_mock.bulk_write.return_value = MagicMock(matched_count=1)
+            nested_mock.find.return_value = [{"_id": cmds[0].get_id()}]
+            mock_collection.return_value = nested_mock
+
+            # Act
+            return await update_command_status_bulk(request, user_agent)
+
+        response = await inner()
+        # Assert
+        outcomes = [result.outcome for result in response.results]
+        assert outcomes == ["Updated", "NotFound"]
+
+    def test_bulk_request_rejects_duplicate_command_ids(
+            self, registered_command, get_update_status_request_factory):
+        # Arrange
+        updates = [get_update_status_request_factory(registered_command.get_id(), status)
+                   for status in (CommandStatus.Running, CommandStatus.Terminated)]
+
+        # Act
+        with pytest.raises(ValidationError) as error:
+            BulkCommandStatusRequest(updates=updates)
+
+        # Assert
+        assert registered_command.get_id() in str(error.value)
+
+
+class TestLongPollUnit:
+    @pytest.mark.asyncio
+    async def test_recent_command_wakes_on_notify(
+            self, registered_device, registered_command_factory, device_agent):
+        # Arrange
+        device_id = registered_device.get_id()
+        poll = asyncio.create_task(
+            get_most_recent_command(device_id, wait=5, agent=device_agent))
+        await asyncio.sleep(0.05)
+        assert not poll.done()
+
+        # Act
+        start = time.monotonic()
+        command = registered_command_factory(device_id=device_id)
+        notify_command_waiters([device_id])
+        response = await poll
+
+        # Assert
+        assert time.monotonic() - start < 1
+        assert orjson.loads(response.body)["command"]["_id"] == command.get_id()
+        assert device_id not in WAITERS
+
+    @pytest.mark.asyncio
+    async def test_recent_command_times_out(self, registered_device, device_agent):
+        # Arrange
+        device_id = registered_device.get_id()
+
+        # Act
+        try:
+            await get_most_recent_command(device_id, wait=0.1, agent=device_agent)
+            assert False
+        except DefaultDataNotFoundException as e:
+            exception = e
+
+        # Assert
+        assert exception.status_code == 404
+        assert device_id not in WAITERS
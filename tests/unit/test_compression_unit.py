@@ -0,0 +1,85 @@
+import gzip
+import zlib
+
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+import pytest
+
+from utils.compression import COMPRESSION_METRICS, CompressionMiddleware, negotiate_encoding
+
+LINE = b'{"_id": "id", "status": "Pending", "name": "ShellCmd"}\n'
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.get("/large")
+    async def large():
+        return ORJSONResponse([{"name": f"device-{i}"} for i in range(100)])
+
+    @app.get("/small")
+    async def small():
+        return ORJSONResponse({"ok": True})
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(iter([LINE] * 3),
+                                 media_type="application/x-ndjson")
+
+    return TestClient(app)
+
+
+class TestNegotiateEncodingUnit:
+    @pytest.mark.parametrize("accept_encoding, expected", [
+        ("gzip, deflate", "gzip"),
+        ("deflate", None),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("", None),
+    ])
+    def test_negotiate_encoding(self, accept_encoding, expected):
+        assert negotiate_encoding(accept_encoding) == expected
+
+
+class TestCompressionMiddlewareUnit:
+    def test_large_response_is_gzipped(self, client):
+        # Arrange
+        before = COMPRESSION_METRICS.snapshot().get("gzip", {}).get("responses", 0)
+
+        # Act
+        response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+
+        # Assert
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert len(response.json()) == 100
+        gzip_metrics = COMPRESSION_METRICS.snapshot()["gzip"]
+        assert gzip_metrics["responses"] == before + 1
+        assert gzip_metrics["ratio"] > 1
+
+    def test_small_or_unaccepted_responses_are_not_compressed(self, client):
+        # Act
+        small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+        identity = client.get("/large", headers={"Accept-Encoding": "identity"})
+
+        # Assert
+        assert "content-encoding" not in small.headers
+        assert "content-encoding" not in identity.headers
+        assert len(identity.json()) == 100
+
+    def test_stream_is_compressed_chunk_by_chunk(self, client):
+        # Act
+        with client.stream("GET", "/stream",
+                           headers={"Accept-Encoding": "gzip"}) as response:
+            chunks = list(response.iter_raw())
+
+        # Assert
+        assert response.headers["content-encoding"] == "gzip"
+        assert "content-length" not in response.headers
+        # every flushed chunk decodes to whole lines on its own
+        first = zlib.decompressobj(31).decompress(chunks[0])
+        assert first.startswith(LINE) and first.endswith(b"\n")
+        assert gzip.decompress(b"".join(chunks)) == LINE * 3
@@ -1,3 +1,5 @@
+import uuid
+from config.db import get_devices_collection
 from models.db.auth import Token
 from models.db.common import Id
 from routes.devices import register_device
@@ -5,6 +7,7 @@ from unittest.mock import MagicMock, patch
 from models.routes.devices import RegisterDeviceRequest
 import pytest
 
+import utils.devices
 from utils.errors import DatabaseNotModified
 
 
@@ -84,3 +87,47 @@ class TestRegisterDeviceUnit:
         # Assert
         assert exception.status_code == 500
         assert exception.detail == f"Failed to create device with name {request.device_name}"
+
+
+class TestCommandHistoryLimitUnit:
+    @pytest.mark.asyncio
+    async def test_push_keeps_most_recent_ids(
+            self, monkeypatch, registered_device):
+        # Arrange
+        monkeypatch.setattr(utils.devices, "DEVICE_COMMAND_HISTORY_LIMIT", 3)
+        command_ids = [str(uuid.uuid4()) for _ in range(5)]
+
+        # Act
+        await utils.devices.push_command_ids_to_devices(
+            {registered_device.get_id(): command_ids[:2]})
+        await utils.devices.push_command_ids_to_devices(
+            {registered_device.get_id(): command_ids[2:]})
+
+        # Assert
+        device = await utils.devices.get_device_from_db_or_404(
+            registered_device.get_id())
+        assert device.command_ids == command_ids[2:]
+
+    def test_trim_device_command_histories(
+            self, monkeypatch, registered_device_factory, get_device_from_db):
+        # Arrange
+        monkeypatch.setattr(utils.devices, "DEVICE_COMMAND_HISTORY_LIMIT", 2)
+        long_device = registered_device_factory()
+        short_device = registered_device_factory()
+        command_ids = [str(uuid.uuid4()) for _ in range(5)]
+        get_devices_collection().update_one(
+            {"_id": long_device.get_id()},
+            {"$set": {"command_ids": command_ids}})
+        get_devices_collection().update_one(
+            {"_id": short_device.get_id()},
+            {"$set": {"command_ids": command_ids[:1]}})
+
+        # Act
+        trimmed = utils.devices.trim_device_command_histories(batch_size=1)
+
+        # Assert
+        assert trimmed == 1
+        device = get_device_from_db(long_device.get_id())
+        assert device.command_ids == command_ids[-2:]
+        device = get_device_from_db(short_device.get_id())
+        assert device.command_ids == command_ids[:1]
@@ -0,0 +1,52 @@
+from pymongo import ASCENDING, IndexModel
+from config.indexes import get_collection_index_drift
+
+
+def get_index_information(*indexes: tuple[str, dict]) -> dict:
+    information = {"_id_": {"v": 2, "key": [("_id", 1)]}}
+    information.update(dict(indexes))
+    return information
+
+
+class TestIndexDriftUnit:
+    def test_no_drift(self):
+        # Arrange
+        index_models = [IndexModel([("email", ASCENDING)], unique=True)]
+        information = get_index_information(
+            ("email_1", {"v": 2, "unique": True, "key": [("email", 1)]}))
+
+        # Act
+        drift = get_collection_index_drift(index_models, information)
+
+        # Assert
+        assert not drift.has_drift()
+
+    def test_missing_index(self):
+        # Arrange
+        index_models = [
+            IndexModel([("device_id", ASCENDING), ("status", ASCENDING)])]
+        information = get_index_information()
+
+        # Act
+        drift = get_collection_index_drift(index_models, information)
+
+        # Assert
+        assert [x.document["name"]
+                for x in drift.missing] == ["device_id_1_status_1"]
+        assert drift.changed == []
+        assert drift.extra == []
+
+    def test_changed_and_extra_indexes(self):
+        # Arrange
+        index_models = [IndexModel([("email", ASCENDING)], unique=True)]
+        information = get_index_information(
+            ("email_1", {"v": 2, "key": [("email", 1)]}),
+            ("name_1", {"v": 2, "key": [("name", 1)]}))
+
+        # Act
+        drift = get_collection_index_drift(index_models, information)
+
+        # Assert
+        assert drift.missing == []
+        assert drift.changed == ["email_1"]
+        assert drift.extra == ["name_1"]
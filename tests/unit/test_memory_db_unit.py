@@ -0,0 +1,143 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from config.memory_db import MemoryClient
+
+
+@pytest.fixture
+def collection():
+    return MemoryClient()["test"]["things"]
+
+
+class TestMemoryCollectionUnit:
+    def test_find_with_in_sort_and_limit(self, collection):
+        # Arrange
+        collection.insert_many([
+            {"_id": str(i), "group": i % 2, "rank": i} for i in range(6)])
+
+        # Act
+        found = list(collection.find(
+            {"group": {"$in": [0]}}, {"rank": 1},
+            sort=[("rank", DESCENDING)]).limit(2))
+
+        # Assert
+        assert found == [{"_id": "4", "rank": 4}, {"_id": "2", "rank": 2}]
+
+    def test_or_and_range_queries(self, collection):
+        # Arrange
+        collection.insert_many([
+            {"_id": "a", "created_at": 1.0},
+            {"_id": "b", "created_at": 2.0},
+            {"_id": "c", "created_at": 2.0},
+            {"_id": "d"}])
+
+        # Act
+        found = collection.find({"$or": [
+            {"created_at": {"$gt": 2.0}},
+            {"created_at": 2.0, "_id": {"$gt": "b"}}]})
+        missing = collection.find({"created_at": None})
+
+        # Assert
+        assert [x["_id"] for x in found] == ["c"]
+        assert [x["_id"] for x in missing] == ["d"]
+
+    def test_push_each_with_slice(self, collection):
+        # Arrange
+        collection.insert_one({"_id": "a", "ids": ["1", "2"]})
+
+        # Act
+        result = collection.update_one({"_id": "a"}, {
+            "$push": {"ids": {"$each": ["3", "4"], "$slice": -3}},
+            "$set": {"name": "x"}})
+
+        # Assert
+        assert result.matched_count == 1
+        assert result.modified_count == 1
+        assert collection.find_one("a") == {
+            "_id": "a", "ids": ["2", "3", "4"], "name": "x"}
+
+    def test_find_one_and_update_returns_document_after(self, collection):
+        # Arrange
+        collection.insert_many([
+            {"_id": "a", "status": "Pending", "created_at": 2},
+            {"_id": "b", "status": "Pending", "created_at": 1}])
+
+        # Act
+        claimed = collection.find_one_and_update(
+            {"status": "Pending"}, {"$set": {"status": "Sent"}},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+        # Assert
+        assert claimed == {"_id": "b", "status": "Sent", "created_at": 1}
+        assert collection.count_documents({"status": "Pending"}) == 1
+
+    def test_stored_documents_are_isolated(self, collection):
+        # Arrange
+        document = {"_id": "a", "ids": []}
+        collection.insert_one(document)
+
+        # Act
+        document["ids"].append("1")
+        collection.find_one("a")["ids"].append("2")
+
+        # Assert
+        assert collection.find_one("a") == {"_id": "a", "ids": []}
+
+    def test_unique_index_rejects_duplicates(self, collection):
+        # Arrange
+        collection.create_indexes([IndexModel([("email", ASCENDING)], unique=True)])
+        collection.insert_one({"_id": "a", "email": "a@x.com"})
+        collection.insert_one({"_id": "b", "email": "b@x.com"})
+
+        # Act
+        with pytest.raises(DuplicateKeyError):
+            collection.insert_one({"_id": "c", "email": "a@x.com"})
+        with pytest.raises(DuplicateKeyError):
+            collection.update_one({"_id": "b"}, {"$set": {"email": "a@x.com"}})
+
+        # Assert
+        assert collection.find_one("b")["email"] == "b@x.com"
+        assert "email_1" in collection.index_information()
+
+    def test_secondary_index_lookups_stay_in_natural_order(self, collection):
+        # Arrange
+        collection.create_index([("device_id", ASCENDING), ("status", ASCENDING)])
+        collection.insert_many([
+            {"_id": str(i), "device_id": f"d{i % 3}", "status": "Pending"}
+            for i in range(9)])
+        collection.update_one({"_id": "3"}, {"$set": {"device_id": "d1"}})
+
+        # Act
+        found = collection.find({"device_id": "d0", "status": "Pending"})
+
+        # Assert
+        assert [x["_id"] for x in found] == ["0", "6"]
+
+    def test_unordered_bulk_write_reports_failures(self, collection):
+        # Arrange
+        collection.insert_one({"_id": "a", "ids": "not a list"})
+        collection.insert_one({"_id": "b", "ids": []})
+
+        # Act
+        with pytest.raises(BulkWriteError) as exc_info:
+            collection.bulk_write([
+                UpdateOne({"_id": "a"}, {"$push": {"ids": "1"}}),
+                UpdateOne({"_id": "b"}, {"$push": {"ids": "1"}})],
+                ordered=False)
+
+        # Assert
+        details = exc_info.value.details
+        assert [x["index"] for x in details["writeErrors"]] == [0]
+        assert details["nModified"] == 1
+        assert collection.find_one("b")["ids"] == ["1"]
+
+    def test_insert_many_rejects_duplicate_ids(self, collection):
+        # Act
+        with pytest.raises(BulkWriteError) as exc_info:
+            collection.insert_many([{"_id": "a"}, {"_id": "a"}, {"_id": "b"}])
+
+        # Assert
+        assert exc_info.value.details["nInserted"] == 1
+        assert collection.count_documents({}) == 1
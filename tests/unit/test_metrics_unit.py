@@ -0,0 +1,130 @@
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import app
+from utils.metrics import (
+    CommandMetricsListener,
+    Counter,
+    Histogram,
+    MONGO_COMMAND_DURATION,
+    MONGO_COMMAND_FAILURES,
+    REQUEST_DURATION,
+    RequestMetricsMiddleware,
+    get_command_collection,
+)
+
+
+def _command_event(command_name, command, request_id=1, duration_micros=2000):
+    return SimpleNamespace(connection_id=("localhost", 27017),
+                           request_id=request_id, command_name=command_name,
+                           command=command, duration_micros=duration_micros)
+
+
+class TestMetricPrimitivesUnit:
+    def test_histogram_renders_cumulative_buckets(self):
+        # Arrange
+        histogram = Histogram("test_seconds", "Test.", ("route",),
+                              buckets=(0.1, 1.0))
+        child = histogram.labels("/a")
+
+        # Act
+        for value in (0.05, 0.1, 0.5, 3.0):
+            child.observe(value)
+
+        # Assert
+        assert histogram.render() == [
+            'test_seconds_bucket{route="/a",le="0.1"} 2',
+            'test_seconds_bucket{route="/a",le="1"} 3',
+            'test_seconds_bucket{route="/a",le="+Inf"} 4',
+            'test_seconds_sum{route="/a"} 3.65',
+            'test_seconds_count{route="/a"} 4',
+        ]
+
+    def test_labels_returns_the_same_child_and_escapes_values(self):
+        # Arrange
+        counter = Counter("test_total", "Test.", ("name",))
+
+        # Act
+        counter.labels('a"b').inc()
+        counter.labels('a"b').inc(2)
+
+        # Assert
+        assert counter.render() == ['test_total{name="a\\"b"} 3']
+
+
+class TestCommandMetricsListenerUnit:
+    def test_get_command_collection(self):
+        assert get_command_collection("find", {"find": "devices"}) == "devices"
+        assert get_command_collection(
+            "getMore", {"getMore": 123, "collection": "commands"}) == "commands"
+        assert get_command_collection("ping", {"ping": 1}) == ""
+
+    def test_observes_duration_by_collection_and_command(self):
+        # Arrange
+        listener = CommandMetricsListener()
+        child = MONGO_COMMAND_DURATION.labels("test_listener", "find")
+        count_before = sum(child.get()[0])
+
+        # Act
+        listener.started(_command_event("find", {"find": "test_listener"}))
+        listener.succeeded(_command_event("find", None))
+
+        # Assert
+        bucket_counts, _ = child.get()
+        assert sum(bucket_counts) == count_before + 1
+        assert listener.collections == {}
+
+    def test_counts_failures(self):
+        # Arrange
+        listener = CommandMetricsListener()
+        failures = MONGO_COMMAND_FAILURES.labels("test_listener", "insert")
+        failures_before = failures.get()
+
+        # Act
+        listener.started(_command_event("insert", {"insert": "test_listener"}, request_id=2))
+        listener.failed(_command_event("insert", None, request_id=2))
+
+        # Assert
+        assert failures.get() == failures_before + 1
+
+
+class TestRequestMetricsMiddlewareUnit:
+    def test_observes_latency_by_route_template_and_status(self):
+        # Arrange
+        test_app = FastAPI()
+        test_app.add_middleware(RequestMetricsMiddleware)
+
+        @test_app.get("/metrics-test/{item_id}")
+        async def get_item(item_id: str):
+            return {"item_id": item_id}
+
+        client = TestClient(test_app)
+        child = REQUEST_DURATION.labels("/metrics-test/{item_id}", "200")
+        unmatched = REQUEST_DURATION.labels("unmatched", "404")
+        count_before, unmatched_before = sum(child.get()[0]), sum(unmatched.get()[0])
+
+        # Act
+        client.get("/metrics-test/1")
+        client.get("/metrics-test/2")
+        client.get("/metrics-test")
+
+        # Assert
+        assert sum(child.get()[0]) == count_before + 2
+        assert sum(unmatched.get()[0]) == unmatched_before + 1
+
+    def test_metrics_endpoint_lists_preallocated_routes(self):
+        # Arrange
+        client = TestClient(app)
+
+        # Act
+        response = client.get("/metrics")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert 'http_request_duration_seconds_count{route="/commands/recent",status="200"}' \
+            in response.text
+        assert "# TYPE mongo_pool_in_use gauge" in response.text
+        assert "http_requests_in_flight 1" in response.text
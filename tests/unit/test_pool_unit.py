@@ -0,0 +1,85 @@
+import time
+from unittest.mock import patch
+
+from pymongo import monitoring
+
+from config.pool import PoolMetricsListener
+
+ADDRESS = ("localhost", 27017)
+
+
+class TestPoolMetricsUnit:
+    def test_tracks_open_and_in_use_connections(self):
+        # Arrange
+        listener = PoolMetricsListener()
+
+        # Act
+        for connection_id in (1, 2):
+            listener.connection_created(
+                monitoring.ConnectionCreatedEvent(ADDRESS, connection_id))
+            listener.connection_check_out_started(
+                monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+            listener.connection_checked_out(
+                monitoring.ConnectionCheckedOutEvent(ADDRESS, connection_id))
+        listener.connection_checked_in(
+            monitoring.ConnectionCheckedInEvent(ADDRESS, 1))
+        listener.connection_closed(
+            monitoring.ConnectionClosedEvent(ADDRESS, 1, "idle"))
+
+        # Assert
+        stats = listener.snapshot()
+        assert stats["open_connections"] == 1
+        assert stats["in_use"] == 1
+        assert stats["waiting"] == 0
+        assert stats["checkouts"] == 2
+
+    def test_times_checkout_waits(self):
+        # Arrange
+        listener = PoolMetricsListener()
+
+        # Act
+        with patch('config.pool.time.monotonic', side_effect=[10.0, 10.25]):
+            listener.connection_check_out_started(
+                monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+            waiting = listener.snapshot()["waiting"]
+            listener.connection_checked_out(
+                monitoring.ConnectionCheckedOutEvent(ADDRESS, 1))
+
+        # Assert
+        stats = listener.snapshot()
+        assert waiting == 1
+        assert stats["checkout_wait_seconds_max"] == 0.25
+        assert stats["checkout_wait_seconds_mean"] == 0.25
+
+    def test_counts_checkout_timeouts(self):
+        # Arrange
+        listener = PoolMetricsListener()
+
+        # Act
+        listener.connection_check_out_started(
+            monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+        listener.connection_check_out_failed(
+            monitoring.ConnectionCheckOutFailedEvent(
+                ADDRESS, monitoring.ConnectionCheckOutFailedReason.TIMEOUT))
+
+        # Assert
+        stats = listener.snapshot()
+        assert stats["waiting"] == 0
+        assert stats["checkout_timeouts"] == 1
+        assert stats["checkout_failures"] == 1
+
+    def test_wait_for_open_connections(self):
+        # Arrange
+        listener = PoolMetricsListener()
+        listener.connection_created(
+            monitoring.ConnectionCreatedEvent(ADDRESS, 1))
+
+        # Act
+        start = time.monotonic()
+        filled = listener.wait_for_open_connections(1, timeout=1)
+        not_filled = listener.wait_for_open_connections(2, timeout=0.05)
+
+        # Assert
+        assert filled
+        assert not not_filled
+        assert time.monotonic() - start < 1
@@ -0,0 +1,104 @@
+import json
+import logging
+import queue
+import time
+
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+import pytest
+
+from config.db import run_in_db_executor
+from config.logs import DroppingQueueHandler, JsonFormatter
+from utils.request_context import mark_as_agent_poll
+from utils.request_logging import RequestLoggingMiddleware
+
+
+@pytest.fixture
+def client_factory():
+    def _factory(agent_poll_sample_rate=1.0):
+        app = FastAPI()
+        app.add_middleware(RequestLoggingMiddleware,
+                           agent_poll_sample_rate=agent_poll_sample_rate)
+
+        @app.get("/items/{item_id}")
+        async def get_item(item_id: str):
+            await run_in_db_executor(time.sleep, 0.01)
+            return {"item_id": item_id}
+
+        @app.get("/poll", dependencies=[Depends(mark_as_agent_poll)])
+        async def poll(found: bool = True):
+            if not found:
+                raise HTTPException(status_code=404)
+            return {}
+
+        return TestClient(app)
+    return _factory
+
+
+def _get_access_records(caplog) -> list[logging.LogRecord]:
+    return [x for x in caplog.records if x.name == "access"]
+
+
+class TestRequestLoggingMiddlewareUnit:
+    def test_logs_route_template_status_and_db_time(self, client_factory, caplog):
+        # Arrange
+        client = client_factory()
+        caplog.set_level(logging.INFO, logger="access")
+
+        # Act
+        response = client.get("/items/42", headers={"X-Request-ID": "abc"})
+
+        # Assert
+        assert response.headers["x-request-id"] == "abc"
+        [record] = _get_access_records(caplog)
+        assert record.request_id == "abc"
+        assert record.route == "/items/{item_id}"
+        assert record.status == 200
+        assert record.db_round_trips == 1
+        assert record.db_ms >= 10
+        assert record.latency_ms >= record.db_ms
+
+    def test_successful_agent_polls_are_sampled(self, client_factory, caplog):
+        # Arrange
+        client = client_factory(agent_poll_sample_rate=0)
+        caplog.set_level(logging.INFO, logger="access")
+
+        # Act
+        client.get("/poll")
+        client.get("/poll", params={"found": False})
+
+        # Assert
+        [record] = _get_access_records(caplog)
+        assert record.status == 404
+
+
+class TestStructuredLoggingUnit:
+    def test_full_queue_drops_records_instead_of_blocking(self):
+        # Arrange
+        handler = DroppingQueueHandler(queue.Queue(1))
+        logger = logging.getLogger("test_full_queue")
+        logger.propagate = False
+        logger.addHandler(handler)
+
+        # Act
+        logger.warning("first")
+        logger.warning("second")
+
+        # Assert
+        assert handler.dropped == 1
+        assert handler.queue.get_nowait().getMessage() == "first"
+        logger.removeHandler(handler)
+
+    def test_json_formatter_includes_extra_fields(self):
+        # Arrange
+        record = logging.LogRecord("access", logging.INFO, __file__, 1,
+                                   "request %s", ("done",), None)
+        record.status = 200
+
+        # Act
+        line = json.loads(JsonFormatter().format(record))
+
+        # Assert
+        assert line["message"] == "request done"
+        assert line["status"] == 200
+        assert line["level"] == "INFO"
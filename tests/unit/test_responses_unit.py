@@ -0,0 +1,47 @@
+import json
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from models.db.command import Command
+from models.db.device import Device
+from models.routes.commands import BatchAllCommandsResponse
+from models.routes.devices import GetDevicesResponse
+from utils.responses import trusted_response
+
+
+def _validated_json(response) -> dict:
+    return json.loads(json.dumps(jsonable_encoder(response, by_alias=True)))
+
+
+class TestTrustedResponseUnit:
+    def test_trusted_commands_page_matches_validated(self, registered_command_factory):
+        # Arrange
+        documents = [registered_command_factory().dict(by_alias=True)
+                     for _ in range(3)]
+        validated = BatchAllCommandsResponse(
+            commands=[Command(**x) for x in documents], next_cursor="next")
+
+        # Act
+        response = trusted_response(BatchAllCommandsResponse.model_construct(
+            commands=[Command.dump_trusted(x) for x in documents],
+            next_cursor="next"))
+
+        # Assert
+        assert response.status_code == 200
+        assert orjson.loads(response.body) == _validated_json(validated)
+
+    def test_trusted_device_fills_defaults_and_drops_unknown_fields(self):
+        # Arrange
+        document = {"_id": "device-id", "name": "name", "user_id": "user-id",
+                    "unknown": "value"}
+
+        # Act
+        dumped = Device.dump_trusted(document)
+        built = GetDevicesResponse.model_construct(
+            devices=[Device.from_trusted(document)]).to_trusted_dict()
+
+        # Assert
+        expected = _validated_json(Device(**document))
+        assert dumped == expected
+        assert built == {"devices": [expected]}
@@ -0,0 +1,95 @@
+import re
+import time
+
+from fastapi.testclient import TestClient
+
+from app import app
+from utils.request_context import (
+    REQUEST_CONTEXT,
+    RequestContext,
+    time_phase,
+)
+from utils.server_timing import format_server_timing
+
+
+def _parse_server_timing(value: str) -> dict[str, str]:
+    return {part.split(";")[0]: part for part in value.split(", ")}
+
+
+def _get_duration_ms(metric: str) -> float:
+    return float(re.search(r"dur=([\d.]+)", metric).group(1))
+
+
+class TestTimePhaseUnit:
+    def test_nested_phase_isnt_counted_in_outer_one(self):
+        # Arrange
+        context = RequestContext(request_id="abc", server_timing=True)
+        token = REQUEST_CONTEXT.set(context)
+
+        # Act
+        try:
+            with time_phase("outer"):
+                time.sleep(0.01)
+                with time_phase("inner"):
+                    time.sleep(0.02)
+                time.sleep(0.01)
+        finally:
+            REQUEST_CONTEXT.reset(token)
+
+        # Assert
+        assert 0.02 <= context.phase_seconds["outer"] < 0.03
+        assert 0.02 <= context.phase_seconds["inner"] < 0.03
+        assert context.phase_stack == []
+
+    def test_not_timed_unless_requested(self):
+        # Arrange
+        context = RequestContext(request_id="abc")
+        token = REQUEST_CONTEXT.set(context)
+
+        # Act
+        try:
+            with time_phase("outer"):
+                pass
+        finally:
+            REQUEST_CONTEXT.reset(token)
+
+        # Assert
+        assert context.phase_seconds == {}
+
+    def test_format_server_timing(self):
+        # Arrange
+        context = RequestContext(request_id="abc", server_timing=True,
+                                 db_seconds=0.004, db_round_trips=2,
+                                 phase_seconds={"auth": 0.0015})
+
+        # Act
+        metrics = _parse_server_timing(format_server_timing(context))
+
+        # Assert
+        assert list(metrics) == ["auth", "db", "validation", "serialization", "total"]
+        assert metrics["auth"] == "auth;dur=1.500"
+        assert metrics["db"] == 'db;dur=4.000;desc="2 round trips"'
+        assert metrics["validation"] == "validation;dur=0.000"
+
+
+class TestServerTimingMiddlewareUnit:
+    def test_header_only_when_requested(self, registered_user_redacted,
+                                        get_header_dict_from_user_id):
+        # Arrange
+        client = TestClient(app)
+        headers = get_header_dict_from_user_id(registered_user_redacted.get_id())
+
+        # Act
+        plain = client.get("/users/get", headers=headers)
+        timed = client.get("/users/get", headers={**headers, "X-Debug-Timing": "1"})
+
+        # Assert
+        assert plain.status_code == timed.status_code == 200
+        assert "server-timing" not in plain.headers
+        metrics = _parse_server_timing(timed.headers["server-timing"])
+        assert set(metrics) == {"auth", "db", "validation", "serialization", "total"}
+        assert int(re.search(r'desc="(\d+) round trips"', metrics["db"]).group(1)) >= 1
+        assert _get_duration_ms(metrics["auth"]) > 0
+        assert _get_duration_ms(metrics["serialization"]) > 0
+        assert _get_duration_ms(metrics["total"]) >= \
+            _get_duration_ms(metrics["auth"]) + _get_duration_ms(metrics["serialization"])
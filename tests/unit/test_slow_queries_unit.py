@@ -0,0 +1,183 @@
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+from pymongo.errors import OperationFailure
+
+from app import app
+from utils.request_context import REQUEST_CONTEXT, RequestContext
+from utils.slow_queries import (
+    SLOW_QUERY_LOG,
+    SlowQueryLog,
+    build_explain_command,
+    get_filter_shape,
+    is_collscan,
+)
+
+COLLSCAN_PLAN = {"queryPlanner": {
+    "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "COLLSCAN"}},
+    "rejectedPlans": []}}
+IXSCAN_PLAN = {"queryPlanner": {
+    "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+    "rejectedPlans": [{"stage": "COLLSCAN"}]}}
+
+
+def _run_command(log, command_name, command, duration_ms, request_id=1):
+    event = SimpleNamespace(connection_id=("localhost", 27017),
+                            request_id=request_id, database_name="test",
+                            command_name=command_name, command=command,
+                            duration_micros=int(duration_ms * 1000))
+    log.started(event)
+    log.succeeded(event)
+
+
+def _wait_for_explains(log):
+    # explains run one at a time, in order
+    log.explain_executor.submit(lambda: None).result()
+
+
+class TestSlowQueryHelpersUnit:
+    def test_filter_shape_redacts_values(self):
+        # Arrange
+        query_filter = {"device_id": "abc", "status": {"$in": ["a", "b"]},
+                        "$or": [{"x": 1}, {"x": 2}, {"y": {"$gt": 3}}]}
+
+        # Act
+        shape = get_filter_shape(query_filter)
+
+        # Assert
+        assert shape == {"device_id": "?", "status": {"$in": ["?"]},
+                         "$or": [{"x": "?"}, {"y": {"$gt": "?"}}]}
+
+    def test_explain_command_drops_session_fields_and_extra_statements(self):
+        # Arrange
+        command = {"update": "commands", "ordered": False, "lsid": {"id": 1},
+                   "updates": [{"q": {"_id": 1}, "u": {}}, {"q": {"_id": 2}, "u": {}}]}
+
+        # Act
+        explain = build_explain_command("update", command)
+
+        # Assert
+        assert explain == {"explain": {"update": "commands", "ordered": False,
+                                       "updates": [{"q": {"_id": 1}, "u": {}}]},
+                           "verbosity": "queryPlanner"}
+
+    def test_is_collscan_ignores_rejected_plans(self):
+        assert is_collscan(COLLSCAN_PLAN)
+        assert not is_collscan(IXSCAN_PLAN)
+
+
+class TestSlowQueryLogUnit:
+    def test_ignores_fast_operations(self):
+        # Arrange
+        log = SlowQueryLog(threshold_ms=100, size=10, explain=lambda *_: COLLSCAN_PLAN)
+
+        # Act
+        _run_command(log, "find", {"find": "devices", "filter": {}}, duration_ms=5)
+
+        # Assert
+        assert log.snapshot() == []
+        assert log.pending == {}
+
+    def test_records_shape_and_route_and_explains_first_occurrence(self):
+        # Arrange
+        explained = []
+
+        def explain(database, command):
+            explained.append((database, command))
+            return COLLSCAN_PLAN
+
+        log = SlowQueryLog(threshold_ms=100, size=10, explain=explain)
+        scope = {"route": SimpleNamespace(path="/devices/get")}
+        token = REQUEST_CONTEXT.set(RequestContext(request_id="abc", scope=scope))
+
+        # Act
+        try:
+            _run_command(log, "find",
+                         {"find": "devices", "filter": {"user_id": "u1"}}, 150)
+            _wait_for_explains(log)
+            _run_command(log, "find",
+                         {"find": "devices", "filter": {"user_id": "u2"}}, 250)
+            _wait_for_explains(log)
+        finally:
+            REQUEST_CONTEXT.reset(token)
+
+        # Assert
+        assert len(explained) == 1
+        assert explained[0] == ("test", {
+            "explain": {"find": "devices", "filter": {"user_id": "u1"}},
+            "verbosity": "queryPlanner"})
+        latest, first = log.snapshot()
+        assert latest["duration_ms"] == 250
+        assert first["filter_shape"] == {"user_id": "?"}
+        assert first["route"] == "/devices/get"
+        assert first["request_id"] == "abc"
+        assert first["collscan"] is True
+        assert latest["collscan"] is True
+
+    def test_keeps_only_latest_entries(self):
+        # Arrange
+        log = SlowQueryLog(threshold_ms=1, size=2, explain=lambda *_: IXSCAN_PLAN)
+
+        # Act
+        for i in range(3):
+            _run_command(log, "find", {"find": "commands", "filter": {"_id": i}},
+                         duration_ms=10 + i, request_id=i)
+        _wait_for_explains(log)
+
+        # Assert
+        assert [x["duration_ms"] for x in log.snapshot()] == [12, 11]
+        assert log.snapshot()[0]["collscan"] is False
+
+    def test_failed_explain_leaves_plan_unknown(self):
+        # Arrange
+        def explain(database, command):
+            raise OperationFailure("not authorized")
+
+        log = SlowQueryLog(threshold_ms=1, size=2, explain=explain)
+
+        # Act
+        _run_command(log, "delete", {"delete": "commands",
+                                     "deletes": [{"q": {"_id": 1}, "limit": 1}]}, 10)
+        _wait_for_explains(log)
+
+        # Assert
+        [entry] = log.snapshot()
+        assert entry["filter_shape"] == {"_id": "?"}
+        assert entry["collscan"] is None
+
+
+class TestSlowQueriesEndpointUnit:
+    def test_requires_token(self):
+        # Arrange
+        client = TestClient(app)
+
+        # Act
+        response = client.get("/admin/slow-queries")
+
+        # Assert
+        assert response.status_code != 200
+
+    def test_lists_slow_queries(self, registered_user_redacted,
+                                get_header_dict_from_user_id):
+        # Arrange
+        client = TestClient(app)
+        explain_before = SLOW_QUERY_LOG.explain
+        SLOW_QUERY_LOG.explain = lambda *_: IXSCAN_PLAN
+        try:
+            _run_command(SLOW_QUERY_LOG, "count",
+                         {"count": "users", "query": {"email": "x"}},
+                         SLOW_QUERY_LOG.threshold_ms + 1)
+            _wait_for_explains(SLOW_QUERY_LOG)
+        finally:
+            SLOW_QUERY_LOG.explain = explain_before
+
+        # Act
+        response = client.get("/admin/slow-queries", headers=get_header_dict_from_user_id(
+            registered_user_redacted.get_id()))
+
+        # Assert
+        assert response.status_code == 200
+        body = response.json()
+        assert body["threshold_ms"] == SLOW_QUERY_LOG.threshold_ms
+        assert body["slow_queries"][0]["command"] == "count"
+        assert body["slow_queries"][0]["filter_shape"] == {"email": "?"}
@@ -7,17 +7,27 @@ Additional functionality to validate and decode the
 incoming JWT.
 """
 
+from datetime import timedelta
 from typing import Dict, Any, Optional
 
 from fastapi import Header
 import bcrypt
 
+from config.main import DEVICE_TOKEN_EXPIRY_DAYS
 from models.db.auth import Token
+from models.db.device import AgentPrincipal
+from utils.hashing import run_in_hashing_executor
+from utils.request_context import AUTH_PHASE, timed_phase
 import utils.errors as exceptions
+import utils.devices as device_utils
 import utils.users as user_utils
 import models.db.common as common_models
 
+# `scope` claim of tokens that identify a single device rather than a user
+DEVICE_TOKEN_SCOPE = "device"
 
+
+@timed_phase(AUTH_PHASE)
 async def check_header_token_is_admin(token: str = Header(
         None)) -> common_models.Id:
     """
@@ -36,6 +46,7 @@ async def check_header_token_is_admin(token: str = Header(
     raise exceptions.UnauthorizedIdentifierData(detail=detail)
 
 
+@timed_phase(AUTH_PHASE)
 async def get_user_id_from_header_and_check_existence(  # pylint: disable=invalid-name
         token: str = Header(None)) -> common_models.Id:
     """
@@ -45,14 +56,72 @@ async def get_user_id_from_header_and_check_existence(  # pylint: disable=invali
     If valid and existent, returns the value of the Id.
     """
     payload_dict = await get_payload_from_token_header(token)
+    if payload_dict.get("scope") == DEVICE_TOKEN_SCOPE:
+        detail = "Device tokens can't be used on this route."
+        raise exceptions.UnauthorizedIdentifierData(detail=detail)
     user_id = payload_dict.get("user_id")
     if not user_id:
         detail = "User ID not in JWT header payload dict."
         raise exceptions.InvalidDataException(detail=detail)
-    user_utils.get_db_user_or_throw_if_404(user_id)
+    await user_utils.get_principal_or_throw_if_404(user_id)
     return user_id
 
 
+@timed_phase(AUTH_PHASE)
+async def get_agent_from_header(token: str = Header(None)) -> AgentPrincipal:
+    """
+    Authenticates a caller of the agent-facing routes.
+
+    Device tokens are trusted on their signature alone, with no database
+    lookup. User tokens go through the usual user existence check.
+    """
+    payload_dict = await get_payload_from_token_header(token)
+    if payload_dict.get("scope") != DEVICE_TOKEN_SCOPE:
+        user_id = await get_user_id_from_header_and_check_existence(token)
+        principal = await user_utils.get_principal_or_throw_if_404(user_id)
+        return AgentPrincipal(user_id=user_id, tenant_id=principal.tenant_id)
+
+    if not all(payload_dict.get(x) for x in ("device_id", "user_id")):
+        detail = "Device ID or User ID not in device token payload dict."
+        raise exceptions.InvalidDataException(detail=detail)
+    return AgentPrincipal(device_id=payload_dict["device_id"],
+                          user_id=payload_dict["user_id"],
+                          tenant_id=payload_dict.get("tenant_id"))
+
+
+@timed_phase(AUTH_PHASE)
+async def check_agent_can_access_device(agent: AgentPrincipal,
+                                        device_id: common_models.Id) -> None:
+    """
+    Raises a 404 if the device doesn't exist, and an authorization error
+    unless the agent holds that device's token or a token of the user
+    owning it.
+    """
+    if agent.device_id is not None:
+        if agent.device_id != device_id:
+            detail = f"Device token is not valid for device {device_id}"
+            raise exceptions.UnauthorizedIdentifierData(detail=detail)
+        await device_utils.check_device_exists_or_404(device_id)
+        return
+
+    owner_id = await device_utils.get_device_owner_from_db_or_404(device_id)
+    if owner_id != agent.user_id:
+        detail = f"Device {device_id} does not belong to user {agent.user_id}"
+        raise exceptions.UnauthorizedIdentifierData(detail=detail)
+
+
+@timed_phase(AUTH_PHASE)
+async def get_agent_device_filter(agent: AgentPrincipal) -> Dict[str, Any]:
+    """
+    Filter limiting a commands query to the devices the agent may access:
+    its own device for device tokens, the user's devices for user tokens.
+    """
+    if agent.device_id is not None:
+        return {'device_id': agent.device_id}
+    device_ids = await device_utils.get_device_ids_by_user_id(agent.user_id)
+    return {'device_id': {'$in': device_ids}}
+
+
 async def get_auth_token_from_header(token: str = Header(None)) -> str:
     """
     Attempts to get the auth token string from the request header,
@@ -94,8 +163,9 @@ async def get_payload_from_optional_token_header(  # pylint: disable=invalid-nam
     if not header is passed in, returns None.
     """
     if token:
-        await check_token_str_is_decodable(token)
-        token_payload = Token.get_dict_from_enc_token_str(token)
+        token_payload = Token.get_verified_claims(token)
+        if token_payload is None:
+            raise exceptions.InvalidAuthHeaderException
         return token_payload
 
 
@@ -127,11 +197,12 @@ async def check_token_str_is_decodable(token_str: str) -> None:
 
     If not, raises an authentication error.
     """
-    invalid_token_data = not Token.check_if_valid(token_str)
+    invalid_token_data = Token.get_verified_claims(token_str) is None
     if invalid_token_data:
         raise exceptions.InvalidAuthHeaderException
 
 
+@timed_phase(AUTH_PHASE)
 async def get_auth_token_from_user_id(user_id: common_models.Id) -> str:
     """
     Returns an encoded token string with the given user_id in it's payload.
@@ -141,6 +212,31 @@ async def get_auth_token_from_user_id(user_id: common_models.Id) -> str:
     return encoded_jwt_str
 
 
+@timed_phase(AUTH_PHASE)
+async def get_auth_token_for_device(device_id: common_models.Id,
+                                    user_id: common_models.Id,
+                                    tenant_id: common_models.Id) -> str:
+    """
+    Returns a long-lived encoded token string scoped to a single device.
+    """
+    payload_dict = {'scope': DEVICE_TOKEN_SCOPE, 'device_id': device_id,
+                    'user_id': user_id, 'tenant_id': tenant_id}
+    encoded_jwt_str = Token.get_enc_token_str_from_dict(
+        payload_dict, expiry_time=timedelta(days=DEVICE_TOKEN_EXPIRY_DAYS))
+    return encoded_jwt_str
+
+
+@timed_phase(AUTH_PHASE)
+async def hash_and_compare_in_executor(raw: str,
+                                      hash_to_compare: str) -> bool:
+    """
+    Runs `hash_and_compare` on the bounded hashing executor, so request
+    handlers never block the event loop on bcrypt.
+    """
+    return await run_in_hashing_executor(hash_and_compare, raw,
+                                         hash_to_compare)
+
+
 def hash_and_compare(raw: str, hash_to_compare: str) -> bool:
     pass_to_check = raw.encode('utf-8')
     user_pass = hash_to_compare.encode('utf-8')
@@ -0,0 +1,207 @@
+"""
+Optional write-behind coalescing of command status updates.
+
+When `COMMAND_STATUS_COALESCE_WINDOW_MS` is set, status updates are buffered
+for that long. Only the latest transition per command is kept, and the
+buffer is flushed as one unordered `bulk_write`. Each caller is answered
+only once the flush that carries its update has finished, so an
+acknowledged update is always persisted. Flushes run one at a time on a
+dedicated thread, so a later transition can never be overwritten by an
+earlier one.
+"""
+import asyncio
+from concurrent.futures import Future
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from config.db import get_commands_collection
+from config.main import COMMAND_STATUS_COALESCE_WINDOW_MS, COMMAND_STATUS_COALESCE_MAX_BATCH
+from models.db.command import CommandStatus
+from models.db.common import Id
+from utils.errors import DatabaseError, DatabaseNotModified, DefaultDataNotFoundException
+
+
+@dataclass
+class PendingStatusUpdate:
+    """
+    Latest buffered transition for a command, and the callers waiting on it.
+    """
+    command_id: Id
+    device_id: Optional[Id]
+    status: CommandStatus
+    futures: list[Future] = field(default_factory=list)
+
+    def get_filter(self) -> dict:
+        command_filter = {'_id': self.command_id}
+        if self.device_id is not None:
+            command_filter['device_id'] = self.device_id
+        return command_filter
+
+
+class CommandStatusCoalescer:
+    """
+    Buffers status updates and writes them in batches.
+
+    Not tied to an event loop: callers wait on thread-safe futures, so
+    requests served by any loop can share a batch.
+    """
+
+    def __init__(self, window_seconds: float, max_batch: int,
+                 collection: Callable[[], Collection] = get_commands_collection):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.collection = collection
+        self.condition = threading.Condition()
+        self.pending: dict[tuple[Id, Optional[Id]], PendingStatusUpdate] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = False
+
+    async def submit(self, command_id: Id, status: CommandStatus,
+                     device_id: Optional[Id] = None) -> None:
+        """
+        Buffers the transition and waits until it has been written.
+
+        Raises a 404 if the command doesn't exist (or doesn't belong to
+        `device_id`, when given), and a 500 if its write failed.
+        """
+        await asyncio.wrap_future(self.enqueue(command_id, status, device_id))
+
+    def enqueue(self, command_id: Id, status: CommandStatus,
+                device_id: Optional[Id] = None) -> Future:
+        """
+        Thread-safe part of `submit`, returning the future resolved by
+        the flush that writes the transition.
+        """
+        future: Future = Future()
+        with self.condition:
+            key = (command_id, device_id)
+            update = self.pending.get(key)
+            if update is None:
+                update = PendingStatusUpdate(command_id, device_id, status)
+                self.pending[key] = update
+            else:
+                update.status = status
+            update.futures.append(future)
+
+            self._ensure_flusher_started()
+            self.condition.notify()
+        return future
+
+    def stop(self) -> None:
+        """
+        Flushes whatever is buffered and stops the flusher thread. The
+        next `submit` starts it again.
+        """
+        with self.condition:
+            thread = self.thread
+            self.stopping = True
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+
+    def flush(self) -> int:
+        """
+        Writes every buffered transition, answering their callers.
+        Returns the number of commands written.
+        """
+        with self.condition:
+            updates = list(self.pending.values())
+            self.pending = {}
+        if updates:
+            try:
+                self._write(updates)
+            except Exception as error:  # pylint: disable=broad-except
+                # whatever went wrong, no caller may be left waiting
+                logging.exception(f"failed to flush command status updates: {error}")
+                for update in updates:
+                    _resolve(update, DatabaseError(
+                        detail="Failed to update command status"))
+        return len(updates)
+
+    def _ensure_flusher_started(self) -> None:
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run_flusher,
+                                           name="status-coalescer",
+                                           daemon=True)
+            self.thread.start()
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.pending or self.stopping)
+                if not self.pending and self.stopping:
+                    self.thread = None
+                    return
+                # let the window fill up, unless the batch is already full
+                self.condition.wait_for(
+                    lambda: len(self.pending) >= self.max_batch or self.stopping,
+                    timeout=self.window_seconds)
+            self.flush()
+
+    def _write(self, updates: list[PendingStatusUpdate]) -> None:
+        collection = self.collection()
+        try:
+            found = {(x['_id'], x.get('device_id')) for x in collection.find(
+                {'_id': {'$in': list({u.command_id for u in updates})}},
+                {'_id': 1, 'device_id': 1})}
+            found_ids = {command_id for command_id, _ in found}
+
+            to_write = []
+            for update in updates:
+                if update.device_id is None:
+                    exists = update.command_id in found_ids
+                else:
+                    exists = (update.command_id, update.device_id) in found
+                if exists:
+                    to_write.append(update)
+                else:
+                    _resolve(update, DefaultDataNotFoundException(
+                        detail=f"No command found with id {update.command_id}"))
+
+            failures: dict[int, str] = {}
+            if to_write:
+                operations = [UpdateOne(u.get_filter(),
+                                        {'$set': {'status': u.status}})
+                              for u in to_write]
+                try:
+                    collection.bulk_write(operations, ordered=False)
+                except BulkWriteError as error:
+                    for write_error in error.details.get('writeErrors', []):
+                        failures[write_error['index']] = write_error.get('errmsg')
+        except PyMongoError as error:
+            logging.error(f"failed to flush command status updates: {error}")
+            for update in updates:
+                _resolve(update, DatabaseError(
+                    detail="Failed to update command status"))
+            return
+
+        for i, update in enumerate(to_write):
+            if i in failures:
+                _resolve(update, DatabaseNotModified(
+                    detail=f"Failed to update command status: {failures[i]}"))
+            else:
+                _resolve(update)
+
+
+def _resolve(update: PendingStatusUpdate,
+             error: Optional[Exception] = None) -> None:
+    for future in update.futures:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+
+STATUS_COALESCER = CommandStatusCoalescer(
+    window_seconds=COMMAND_STATUS_COALESCE_WINDOW_MS / 1000,
+    max_batch=COMMAND_STATUS_COALESCE_MAX_BATCH)
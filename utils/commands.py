@@ -1,34 +1,149 @@
-from config.db import get_commands_collection
+import base64
+import json
+from typing import Optional
+from uuid import uuid4
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.cursor import Cursor
+from config.db import get_commands_collection, get_async_commands_collection, run_in_db_executor
 from models.db.common import Id, RaisesException
-from models.db.command import Command
-from utils.errors import DefaultDataNotFoundException
+from models.db.command import Command, CommandStatus
+from utils.errors import DefaultDataNotFoundException, InvalidDataException
 
+# oldest first; ties, and commands without `created_at`, are ordered by id
+OLDEST_FIRST_SORT = [('created_at', ASCENDING), ('_id', ASCENDING)]
 
-def get_command_from_db(command_id: Id) -> dict | None:
-    commands_collection = get_commands_collection()
-    command = commands_collection.find_one({'_id': command_id})
+
+async def get_command_from_db(command_id: Id) -> dict | None:
+    commands_collection = get_async_commands_collection()
+    command = await commands_collection.find_one({'_id': command_id})
     return command
 
 
-def get_command_from_db_or_404(command_id: Id) -> Command | RaisesException:
-    command = get_command_from_db(command_id)
+async def get_command_from_db_or_404(
+        command_id: Id) -> Command | RaisesException:
+    command = await get_command_from_db(command_id)
     if not command:
         raise DefaultDataNotFoundException(
             detail=f"No command found with id {command_id}")
-    return Command(**command)
+    return Command.from_trusted(command)
 
 
-def get_many_commands_from_db(command_ids: list[Id]) -> list[dict | None]:
-    commands_collection = get_commands_collection()
+async def get_many_commands_from_db(
+        command_ids: list[Id]) -> list[dict | None]:
+    commands_collection = get_async_commands_collection()
     filter = {"_id": {"$in": command_ids}}
-    response = [x for x in commands_collection.find(filter)]
+    response = await commands_collection.find_to_list(filter)
     return response
 
 
-def get_many_commands_from_db_or_404(
+async def get_many_commands_from_db_or_404(
         command_ids: list[Id]) -> list[Command] | RaisesException:
-    commands = get_many_commands_from_db(command_ids)
+    commands = await get_many_commands_from_db(command_ids)
     if len(commands) == 0:
         raise DefaultDataNotFoundException(
             detail=f"No commands found with ids {command_ids}")
-    return [Command(**x) for x in commands]
+    return [Command.from_trusted(x) for x in commands]
+
+
+async def claim_pending_commands_for_device(device_id: Id,
+                                            limit: int = 1) -> list[Command]:
+    """
+    Atomically moves up to `limit` of the device's oldest Pending commands
+    to Sent and returns them, so concurrent or retried polls never receive
+    the same command twice.
+
+    A single command is claimed with one `find_one_and_update`; batches
+    pick candidates, flip the ones that are still Pending under a fresh
+    claim id, and read back only the ones this call won.
+    """
+    commands_collection = get_async_commands_collection()
+    pending_filter = {
+        'device_id': device_id,
+        'status': CommandStatus.Pending.value
+    }
+    claim_sort = OLDEST_FIRST_SORT
+    sent_update = {'status': CommandStatus.Sent.value}
+
+    if limit == 1:
+        command = await commands_collection.find_one_and_update(
+            pending_filter, {'$set': sent_update},
+            sort=claim_sort,
+            return_document=ReturnDocument.AFTER)
+        return [Command.from_trusted(command)] if command else []
+
+    candidates = await commands_collection.find_to_list(
+        pending_filter, {'_id': 1}, sort=claim_sort, limit=limit)
+    candidate_ids = [x['_id'] for x in candidates]
+    if not candidate_ids:
+        return []
+
+    claim_id = str(uuid4())
+    await commands_collection.update_many(
+        {'_id': {'$in': candidate_ids}, **pending_filter},
+        {'$set': {**sent_update, 'claim_id': claim_id}})
+
+    claimed = await commands_collection.find_to_list(
+        {'_id': {'$in': candidate_ids}, 'claim_id': claim_id},
+        sort=claim_sort)
+    return [Command.from_trusted(x) for x in claimed]
+
+
+# stable order for paging through a device's command history
+COMMAND_HISTORY_SORT = OLDEST_FIRST_SORT
+
+
+def encode_command_history_cursor(command: dict) -> str:
+    """
+    Encodes the sort key of the raw command document into an opaque
+    cursor pointing right after it.
+    """
+    sort_key = [command.get('created_at'), command['_id']]
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+
+def decode_command_history_cursor(
+        cursor: str) -> tuple[Optional[float], Id] | RaisesException:
+    try:
+        created_at, command_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError) as error:
+        raise InvalidDataException(
+            detail=f"Invalid cursor: {cursor}") from error
+    return created_at, command_id
+
+
+def find_device_command_history(device_id: Id, after: Optional[str] = None,
+                                limit: Optional[int] = None) -> Cursor:
+    """
+    Returns a cursor over the device's commands in `COMMAND_HISTORY_SORT`
+    order, starting right after the `after` cursor if one is given.
+
+    Commands created before `created_at` existed have it unset and sort
+    first, ordered by id.
+    """
+    commands_collection = get_commands_collection()
+    history_filter = {'device_id': device_id}
+
+    if after:
+        created_at, command_id = decode_command_history_cursor(after)
+        if created_at is None:
+            history_filter['$or'] = [
+                {'created_at': None, '_id': {'$gt': command_id}},
+                {'created_at': {'$ne': None}}]
+        else:
+            history_filter['$or'] = [
+                {'created_at': {'$gt': created_at}},
+                {'created_at': created_at, '_id': {'$gt': command_id}}]
+
+    cursor = commands_collection.find(history_filter, sort=COMMAND_HISTORY_SORT)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+async def get_device_command_history_page(
+        device_id: Id, after: Optional[str], limit: int) -> list[dict]:
+    """
+    Reads one page of `find_device_command_history` off the event loop.
+    """
+    cursor = find_device_command_history(device_id, after, limit)
+    return await run_in_db_executor(list, cursor)
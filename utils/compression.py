@@ -0,0 +1,253 @@
+"""
+Negotiated compression of large responses.
+
+`CompressionMiddleware` compresses JSON and text responses with brotli (when
+the `brotli` package is installed) or gzip, whichever the client prefers in
+`Accept-Encoding`. Bodies under `COMPRESSION_MINIMUM_SIZE` are sent as they
+are. Streaming responses (the NDJSON command history) are compressed chunk
+by chunk and flushed after every chunk, so the client keeps receiving lines
+as they are produced.
+
+`COMPRESSION_METRICS` keeps per-encoding counters of what went in, what came
+out and the CPU time spent compressing.
+"""
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.main import (
+    COMPRESSION_MINIMUM_SIZE,
+    COMPRESSION_OFFLOAD_SIZE,
+    GZIP_COMPRESS_LEVEL,
+    BROTLI_QUALITY,
+)
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+GZIP = "gzip"
+BROTLI = "br"
+
+# content types worth compressing; images and the like already are
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "application/x-ndjson",
+                              "text/")
+
+
+def get_supported_encodings() -> list[str]:
+    """
+    Encodings this process can produce, most preferred first.
+    """
+    return [BROTLI, GZIP] if brotli is not None else [GZIP]
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the supported encoding with the highest quality in an
+    `Accept-Encoding` header, preferring brotli on ties. Returns None when
+    the client accepts none of them.
+    """
+    qualities: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in get_supported_encodings():
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressionMetrics:
+    """
+    Per-encoding counters of compressed responses, in the same spirit as
+    the connection pool gauges.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.encodings: Dict[str, Dict[str, float]] = {}
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int,
+               cpu_seconds: float, responses: int = 0) -> None:
+        with self.lock:
+            counters = self.encodings.setdefault(encoding, {
+                "responses": 0, "bytes_in": 0, "bytes_out": 0,
+                "cpu_seconds": 0.0})
+            counters["responses"] += responses
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+            counters["cpu_seconds"] += cpu_seconds
+
+    def record_skipped(self) -> None:
+        with self.lock:
+            self.skipped += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        """
+        Returns the counters, with the overall compression ratio
+        (bytes in / bytes out) of each encoding.
+        """
+        with self.lock:
+            snapshot: Dict[str, object] = {"skipped": self.skipped}
+            for encoding, counters in self.encodings.items():
+                ratio = (counters["bytes_in"] / counters["bytes_out"]
+                         if counters["bytes_out"] else 0.0)
+                snapshot[encoding] = {**counters, "ratio": ratio}
+            return snapshot
+
+
+COMPRESSION_METRICS = CompressionMetrics()
+
+
+class _Compressor:
+    """
+    Incremental compressor for one response body.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == BROTLI:
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            # wbits 31: gzip container
+            self.compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL,
+                                               zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, finish: bool) -> bytes:
+        """
+        Compresses the next chunk. Unless `finish`, the output is flushed
+        so that the client can decode everything sent so far.
+        """
+        started = time.thread_time()
+        if self.encoding == BROTLI:
+            output = self.compressor.process(data)
+            output += self.compressor.finish() if finish else self.compressor.flush()
+        else:
+            output = self.compressor.compress(data)
+            output += self.compressor.flush(
+                zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+        COMPRESSION_METRICS.record(self.encoding, len(data), len(output),
+                                   time.thread_time() - started,
+                                   responses=int(finish))
+        return output
+
+    async def compress_off_loop(self, data: bytes, finish: bool) -> bytes:
+        """
+        `compress`, run in the threadpool for large chunks so that
+        compressing megabytes of JSON doesn't stall the event loop.
+        """
+        if len(data) < COMPRESSION_OFFLOAD_SIZE:
+            return self.compress(data, finish)
+        return await run_in_threadpool(self.compress, data, finish)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing eligible responses with the negotiated
+    encoding.
+    """
+
+    def __init__(self, app: ASGIApp,
+                 minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(
+            Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(self.app, encoding, self.minimum_size)
+        await responder(scope, receive, send)
+
+
+class _CompressionResponder:
+    """
+    Compresses one response, holding back its start message until the
+    first body chunk tells whether it is worth it.
+    """
+
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Optional[Send] = None
+        self.start_message: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = "content-encoding" in headers or \
+                not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send_start()
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressor is None:
+            if not more_body and len(body) < self.minimum_size:
+                COMPRESSION_METRICS.record_skipped()
+                self.passthrough = True
+                await self._send_start()
+                await self.send(message)
+                return
+
+            self.compressor = _Compressor(self.encoding)
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                # streamed: the compressed length isn't known upfront
+                del headers["Content-Length"]
+
+        compressed = await self.compressor.compress_off_loop(
+            body, finish=not more_body)
+        if self.start_message is not None and not more_body:
+            # whole body in one message: its compressed length is known
+            MutableHeaders(raw=self.start_message["headers"])[
+                "Content-Length"] = str(len(compressed))
+        await self._send_start()
+        await self.send({"type": "http.response.body", "body": compressed,
+                         "more_body": more_body})
+
+    async def _send_start(self) -> None:
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            await self.send(start_message)
@@ -0,0 +1,185 @@
+"""
+Holds the per-process registry of open device WebSocket channels.
+
+Each device holds at most one connection. Commands are never pushed as
+they are created: creating a command wakes the device's connection, which
+claims its Pending commands the same way `/claim` does, so a command goes
+down a channel at most once and is never handed out again by `/recent` or
+`/claim`.
+
+Outgoing messages go through a bounded queue drained by a dedicated sender
+task, so a slow agent can only ever hold `WS_SEND_QUEUE_SIZE` messages in
+memory before it is disconnected; commands it had no room for stay Pending
+in the database and are sent when it reconnects. Liveness is checked with
+application-level ping messages.
+"""
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, Iterable
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+from config.main import WS_SEND_QUEUE_SIZE, WS_PING_INTERVAL_SECONDS, WS_PING_TIMEOUT_SECONDS
+from models.db.common import Id
+from models.db.command import Command
+
+# close codes from RFC 6455
+WS_CLOSE_POLICY_VIOLATION = 1008
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+WS_CLOSE_GOING_AWAY = 1001
+
+
+class DeviceConnection:
+    """
+    Single open channel to a device agent.
+    """
+
+    def __init__(self, websocket: WebSocket, device_id: Id):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.last_pong = time.monotonic()
+        self.closing = False
+        self.wakeup = asyncio.Event()
+
+    def push(self, message: dict[str, Any]) -> None:
+        """
+        Thread-safe way of queueing a message for the device.
+        """
+        if self.closing or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._enqueue, message)
+
+    def notify(self) -> None:
+        """
+        Thread-safe way of telling the connection the device has new
+        Pending commands.
+        """
+        if self.closing or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def mark_alive(self) -> None:
+        """
+        Records that the agent answered a ping.
+        """
+        self.last_pong = time.monotonic()
+
+    def request_close(self, code: int) -> None:
+        """
+        Thread-safe way of closing the connection.
+        """
+        if self.closing or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(
+            lambda: self.loop.create_task(self.close(code)))
+
+    async def close(self, code: int) -> None:
+        """
+        Closes the underlying socket once; later calls are no-ops.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        if self.websocket.application_state != WebSocketState.DISCONNECTED:
+            try:
+                await self.websocket.close(code=code)
+            except RuntimeError:
+                # the socket was closed by the peer in the meantime
+                pass
+
+    async def run_sender(self) -> None:
+        """
+        Drains the send queue into the socket until cancelled.
+        """
+        while True:
+            message = await self.queue.get()
+            await self.websocket.send_json(message)
+
+    async def run_dispatcher(
+            self, claim_commands: Callable[[int], Awaitable[list[Command]]]) -> None:
+        """
+        Sends the commands returned by `claim_commands(limit)` on connect
+        and after every `notify`, until cancelled. Only claims as many
+        commands as the send queue has room for.
+        """
+        while True:
+            self.wakeup.clear()
+            free_slots = self.queue.maxsize - self.queue.qsize()
+            if free_slots > 0:
+                for command in await claim_commands(free_slots):
+                    self._enqueue(get_command_message(command))
+            await self.wakeup.wait()
+
+    async def run_pinger(self) -> None:
+        """
+        Pings the agent every `WS_PING_INTERVAL_SECONDS` and closes the
+        connection if the previous ping was not answered in time.
+        """
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL_SECONDS)
+            silent_for = time.monotonic() - self.last_pong
+            if silent_for > WS_PING_INTERVAL_SECONDS + WS_PING_TIMEOUT_SECONDS:
+                logging.info(
+                    f"closing unresponsive channel for device {self.device_id}")
+                await self.close(WS_CLOSE_GOING_AWAY)
+                return
+            self._enqueue({"type": "ping"})
+
+    def _enqueue(self, message: dict[str, Any]) -> None:
+        """
+        Must run on the connection's loop. Disconnects the agent instead
+        of growing the queue past its bound.
+        """
+        if self.closing:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logging.info(
+                f"send queue full for device {self.device_id}, disconnecting")
+            self.request_close(WS_CLOSE_TRY_AGAIN_LATER)
+
+
+CONNECTIONS: dict[Id, DeviceConnection] = {}
+
+
+def register_device_connection(connection: DeviceConnection) -> None:
+    """
+    Registers the connection as the device's channel, closing any
+    previous connection the device still had open.
+    """
+    previous = CONNECTIONS.get(connection.device_id)
+    CONNECTIONS[connection.device_id] = connection
+    if previous is not None and previous is not connection:
+        previous.request_close(WS_CLOSE_POLICY_VIOLATION)
+
+
+def unregister_device_connection(connection: DeviceConnection) -> None:
+    """
+    Removes the connection from the registry if it is still the
+    device's current channel.
+    """
+    if CONNECTIONS.get(connection.device_id) is connection:
+        del CONNECTIONS[connection.device_id]
+
+
+def get_command_message(command: Command) -> dict[str, Any]:
+    """
+    Returns the message pushed to agents for a newly created command.
+    """
+    return {"type": "command", "command": command.to_trusted_dict()}
+
+
+def notify_device_connections(device_ids: Iterable[Id]) -> None:
+    """
+    Wakes the channel of every given device connected to this worker.
+    """
+    for device_id in set(device_ids):
+        connection = CONNECTIONS.get(device_id)
+        if connection is not None:
+            connection.notify()
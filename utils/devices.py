@@ -1,29 +1,187 @@
 import logging
-from config.db import get_devices_collection
+from typing import Optional
+from pymongo import UpdateOne
+from config.db import get_devices_collection, get_async_devices_collection
+from config.main import DEVICE_COMMAND_HISTORY_LIMIT
 from models.db.common import Id, RaisesException
 from models.db.device import Device
-from utils.errors import DefaultDataNotFoundException
+from utils.errors import DatabaseNotModified, DefaultDataNotFoundException
+from utils.etags import VERSION_BUMP, VERSION_PROJECTION
 
 
-def get_device_from_db(device_id: Id) -> dict | None:
-    devices_collection = get_devices_collection()
-    device = devices_collection.find_one({'_id': device_id})
+# projection leaving out the (bounded, but still largest) device field
+WITHOUT_COMMAND_IDS = {'command_ids': 0}
+
+
+async def get_device_from_db(device_id: Id,
+                             projection: Optional[dict] = None) -> dict | None:
+    devices_collection = get_async_devices_collection()
+    device = await devices_collection.find_one({'_id': device_id}, projection)
     return device
 
 
-def get_device_from_db_or_404(device_id: Id) -> Device | RaisesException:
-    device = get_device_from_db(device_id)
+async def get_device_from_db_or_404(
+        device_id: Id,
+        projection: Optional[dict] = None) -> Device | RaisesException:
+    device = await get_device_from_db(device_id, projection)
     if not device:
         raise DefaultDataNotFoundException(
             detail=f"No device found with id {device_id}")
-    return Device(**device)
+    return Device.from_trusted(device)
 
 
-def get_many_devices_from_db_or_404_by_user_id(
-        user_id: Id) -> list[Device] | RaisesException:
-    devices_collection = get_devices_collection()
-    devices = [x for x in devices_collection.find({'user_id': user_id})]
+async def get_device_version_from_db_or_404(
+        device_id: Id) -> dict | RaisesException:
+    """
+    Reads only the id and version of the device, for conditional GETs.
+    """
+    device = await get_device_from_db(device_id, VERSION_PROJECTION)
+    if not device:
+        raise DefaultDataNotFoundException(
+            detail=f"No device found with id {device_id}")
+    return device
+
+
+async def check_device_exists_or_404(
+        device_id: Id) -> None | RaisesException:
+    """
+    Existence check for hot paths (agent polls), which only reads the id.
+    """
+    if not await get_device_from_db(device_id, {'_id': 1}):
+        raise DefaultDataNotFoundException(
+            detail=f"No device found with id {device_id}")
+
+
+async def get_missing_device_ids(device_ids: list[Id]) -> list[Id]:
+    """
+    Returns the ids (in request order, without repeats) that don't match
+    any device, using a single `$in` query.
+    """
+    devices_collection = get_async_devices_collection()
+    unique_ids = list(dict.fromkeys(device_ids))
+    found_ids = {x['_id'] for x in await devices_collection.find_to_list(
+        {'_id': {'$in': unique_ids}}, {'_id': 1})}
+    return [x for x in unique_ids if x not in found_ids]
+
+
+async def check_devices_exist_or_404(
+        device_ids: list[Id]) -> None | RaisesException:
+    missing_ids = await get_missing_device_ids(device_ids)
+    if missing_ids:
+        raise DefaultDataNotFoundException(
+            detail=f"No device found with id(s) {', '.join(missing_ids)}")
+
+
+def get_command_ids_push_update(command_ids: list[Id]) -> dict:
+    """
+    Returns the update appending the ids to a device's `command_ids`,
+    keeping only the most recent `DEVICE_COMMAND_HISTORY_LIMIT` of them,
+    and bumping the device's version.
+    The full history stays queryable through the commands collection.
+    """
+    push_spec = {'$each': command_ids}
+    if DEVICE_COMMAND_HISTORY_LIMIT:
+        push_spec['$slice'] = -DEVICE_COMMAND_HISTORY_LIMIT
+    return {'$push': {'command_ids': push_spec}, '$inc': VERSION_BUMP}
+
+
+async def push_command_ids_to_devices(
+        command_ids_by_device: dict[Id, list[Id]]) -> None | RaisesException:
+    """
+    Appends the new command ids to each device's `command_ids` with a
+    single unordered `bulk_write`.
+    """
+    devices_collection = get_async_devices_collection()
+    operations = [UpdateOne({'_id': device_id},
+                            get_command_ids_push_update(command_ids))
+                  for device_id, command_ids in command_ids_by_device.items()]
+    if not operations:
+        return
+
+    result = await devices_collection.bulk_write(operations, ordered=False)
+    if result.modified_count != len(operations):
+        raise DatabaseNotModified(
+            detail="Failed to update devices with new command ids")
+
+
+async def get_many_devices_from_db_or_404_by_user_id(
+        user_id: Id) -> list[dict] | RaisesException:
+    """
+    Returns the user's devices dumped with `Device.dump_trusted`, ready
+    to be encoded without building a model per device.
+    """
+    devices_collection = get_async_devices_collection()
+    devices = await devices_collection.find_to_list({'user_id': user_id})
     if len(devices) == 0:
         raise DefaultDataNotFoundException(
             detail=f"No devices found with user id {user_id}")
-    return [Device(**x) for x in devices]
+    return [Device.dump_trusted(x) for x in devices]
+
+
+async def get_device_ids_by_user_id(user_id: Id) -> list[Id]:
+    """
+    Reads only the ids of the user's devices, none if the user has no
+    device. Covered by the `user_id` index.
+    """
+    devices_collection = get_async_devices_collection()
+    devices = await devices_collection.find_to_list({'user_id': user_id},
+                                                    {'_id': 1})
+    return [x['_id'] for x in devices]
+
+
+async def get_device_owner_from_db_or_404(
+        device_id: Id) -> Id | RaisesException:
+    """
+    Reads only the id of the user owning the device.
+    """
+    device = await get_device_from_db(device_id, {'user_id': 1})
+    if not device:
+        raise DefaultDataNotFoundException(
+            detail=f"No device found with id {device_id}")
+    return device['user_id']
+
+
+async def get_device_versions_from_db_or_404_by_user_id(
+        user_id: Id) -> list[dict] | RaisesException:
+    """
+    Reads only the ids and versions of the user's devices, for
+    conditional GETs. Covered by the `user_id` index.
+    """
+    devices_collection = get_async_devices_collection()
+    devices = await devices_collection.find_to_list(
+        {'user_id': user_id}, VERSION_PROJECTION)
+    if len(devices) == 0:
+        raise DefaultDataNotFoundException(
+            detail=f"No devices found with user id {user_id}")
+    return devices
+
+
+def trim_device_command_histories(batch_size: int = 500) -> int:
+    """
+    Migration for devices written before the history limit: trims every
+    `command_ids` array longer than `DEVICE_COMMAND_HISTORY_LIMIT` down
+    to its most recent ids, `batch_size` devices per `bulk_write`.
+
+    Returns the number of devices trimmed. Blocking, meant for `x.py`.
+    """
+    if not DEVICE_COMMAND_HISTORY_LIMIT:
+        return 0
+
+    devices_collection = get_devices_collection()
+    # an element at index `limit` exists only if the array is too long
+    oversized_filter = {
+        f'command_ids.{DEVICE_COMMAND_HISTORY_LIMIT}': {'$exists': True}}
+    trim_update = get_command_ids_push_update([])
+
+    trimmed = 0
+    while True:
+        device_ids = [x['_id'] for x in devices_collection.find(
+            oversized_filter, {'_id': 1}).limit(batch_size)]
+        if not device_ids:
+            return trimmed
+        result = devices_collection.bulk_write(
+            [UpdateOne({'_id': device_id}, trim_update)
+             for device_id in device_ids], ordered=False)
+        trimmed += result.modified_count
+        if result.modified_count == 0:
+            return trimmed
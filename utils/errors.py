@@ -110,6 +110,17 @@ class DatabaseNotModified(HTTPException):
         super().__init__(status_code=500, detail=detail)
 
 
+class ServiceUnavailableException(HTTPException):
+    """
+    Raised when the server is too busy to take on the request right now
+    """
+
+    def __init__(self, detail: Optional[str] = None):
+        if not detail:
+            detail = "Service temporarily unavailable, retry shortly"
+        super().__init__(status_code=503, detail=detail)
+
+
 def check_insert_was_successful(result, detail: str) -> None:
     """
     Checks if the result of an insert operation was successful,
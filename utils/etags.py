@@ -0,0 +1,55 @@
+"""
+Entity tags for the device and user reads.
+
+Users and devices carry a `version` that every write to them bumps with
+`VERSION_BUMP`. ETags are derived from the ids and versions of the
+documents behind a response, so a conditional GET can be answered with a
+304 after reading only those two fields.
+"""
+import hashlib
+from collections.abc import Iterable, Mapping
+from typing import Any, Optional
+from fastapi import Response
+
+# `$inc` spec that every write to a user or device document must include
+VERSION_BUMP = {'version': 1}
+
+# projection of a conditional GET's check
+VERSION_PROJECTION = {'_id': 1, 'version': 1}
+
+# bump to invalidate every ETag handed out, e.g. when a response changes shape
+ETAG_FORMAT_VERSION = 1
+
+
+def compute_etag(documents: Iterable[Mapping[str, Any]]) -> str:
+    """
+    Returns a weak ETag over the `_id` and `version` of the documents, in id order.
+    Weak because the same body may go out compressed or not.
+
+    Documents written before versions existed count as version 0.
+    """
+    digest = hashlib.blake2b(str(ETAG_FORMAT_VERSION).encode(), digest_size=16)
+    for document in sorted(documents, key=lambda x: x['_id']):
+        digest.update(f"|{document['_id']}:{document.get('version', 0)}".encode())
+    return f'W/"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of the ETag against an `If-None-Match` header.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = _strip_weak_prefix(etag)
+    return any(_strip_weak_prefix(x.strip()) == opaque_tag
+               for x in if_none_match.split(","))
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def _strip_weak_prefix(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
@@ -0,0 +1,67 @@
+"""
+Holds the bounded executor every bcrypt call made by a request handler
+runs on.
+
+bcrypt releases the GIL, so a small thread pool keeps hashing off the event
+loop without a process pool. At most `HASH_WORKERS + HASH_QUEUE_LIMIT`
+jobs are admitted at once; further requests are rejected right away, and
+jobs still queued after `HASH_QUEUE_TIMEOUT_SECONDS` are dropped, both with
+a 503.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Any, Callable
+
+import bcrypt
+
+from config.main import HASH_WORKERS, HASH_QUEUE_LIMIT, HASH_QUEUE_TIMEOUT_SECONDS
+import utils.errors as exceptions
+
+HASHING_EXECUTOR = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                                      thread_name_prefix="bcrypt")
+HASHING_SLOTS = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_LIMIT)
+
+
+async def run_in_hashing_executor(func: Callable, *args) -> Any:
+    """
+    Runs a blocking hashing call on the hashing executor and awaits it.
+
+    Raises a 503 if no slot is free, or if the job hasn't started after
+    `HASH_QUEUE_TIMEOUT_SECONDS`. Jobs that have started always finish.
+    """
+    if not HASHING_SLOTS.acquire(blocking=False):
+        raise exceptions.ServiceUnavailableException(
+            detail="Too many concurrent password checks, retry shortly")
+
+    started = threading.Event()
+
+    def _run():
+        started.set()
+        return func(*args)
+
+    try:
+        future = HASHING_EXECUTOR.submit(_run)
+    except RuntimeError:
+        HASHING_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: HASHING_SLOTS.release())
+
+    result = asyncio.wrap_future(future)
+    try:
+        return await asyncio.wait_for(asyncio.shield(result),
+                                      timeout=HASH_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        if started.is_set():
+            return await result
+        future.cancel()
+        raise exceptions.ServiceUnavailableException(
+            detail="Timed out waiting to check password, retry shortly")
+
+
+async def hash_secret(raw: bytes) -> str:
+    """
+    Hashes the raw secret with a fresh salt, in the stored string format.
+    """
+    return await run_in_hashing_executor(
+        lambda: str(bcrypt.hashpw(raw, bcrypt.gensalt())))
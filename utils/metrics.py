@@ -0,0 +1,402 @@
+"""
+Runtime metrics in the Prometheus text format, served on `/metrics`.
+
+The hot paths only touch metric children allocated once per label set
+(route templates are allocated up front by `preallocate_route_metrics`).
+An observation is a bucket lookup and two increments under the child's own
+lock, so a scrape never holds a lock that requests wait on for long. The
+gauges kept elsewhere (connection pool, compression, dropped log records)
+are read by collectors only when scraped.
+
+- `http_request_duration_seconds{route,status}`: latency by route template.
+- `http_requests_in_flight`: requests being served by this worker.
+- `mongo_command_duration_seconds{collection,command}` and
+  `mongo_command_failures_total{collection,command}`: from
+  `MONGO_COMMAND_METRICS`, a pymongo `CommandListener` on the client.
+- `event_loop_lag_seconds`: how late the loop woke the lag monitor.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.logs import get_dropped_log_records
+from config.main import EVENT_LOOP_LAG_INTERVAL_SECONDS
+from config.pool import POOL_METRICS
+from utils.compression import COMPRESSION_METRICS
+
+# starlette appends the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                            2.5, 5.0, 10.0, 30.0)
+MONGO_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                          0.1, 0.25, 0.5, 1.0, 2.5)
+
+# route label of requests that didn't match any route
+UNMATCHED_ROUTE = "unmatched"
+
+# (labels, value) pairs of one metric family
+Samples = Iterable[tuple[dict[str, str], float]]
+
+
+class _CounterChild:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        with self.lock:
+            self.value = value
+
+    def get(self) -> float:
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ("lock", "upper_bounds", "bucket_counts", "sum")
+
+    def __init__(self, upper_bounds: tuple[float, ...]):
+        self.lock = threading.Lock()
+        self.upper_bounds = upper_bounds
+        # per bucket, not cumulative; the last one is +Inf
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+
+    def get(self) -> tuple[list[int], float]:
+        with self.lock:
+            return list(self.bucket_counts), self.sum
+
+
+class Metric:
+    """
+    A metric family: one child per set of label values, created on first
+    use and kept for the life of the process.
+    """
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.children: dict[tuple[str, ...], Any] = {}
+        self.children_lock = threading.Lock()
+
+    def labels(self, *values: str) -> Any:
+        child = self.children.get(values)
+        if child is None:
+            with self.children_lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self.children[values] = child
+        return child
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def render(self) -> list[str]:
+        return [_format_sample(self.name, dict(zip(self.label_names, values)),
+                               child.get())
+                for values, child in list(self.children.items())]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = REQUEST_DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self) -> list[str]:
+        lines = []
+        for values, child in list(self.children.items()):
+            labels = dict(zip(self.label_names, values))
+            bucket_counts, total = child.get()
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),),
+                                          bucket_counts):
+                cumulative += count
+                lines.append(_format_sample(
+                    f"{self.name}_bucket",
+                    {**labels, "le": _format_value(upper_bound)}, cumulative))
+            lines.append(_format_sample(f"{self.name}_sum", labels, total))
+            lines.append(_format_sample(f"{self.name}_count", labels, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The metrics of this process, plus collectors turning gauges kept
+    elsewhere into samples at scrape time.
+    """
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        self.collectors: list[Callable[[], Iterable[tuple[str, str, str, Samples]]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(
+            self, collector: Callable[[], Iterable[tuple[str, str, str, Samples]]]) -> None:
+        """
+        `collector` returns (name, type, help, samples) per metric family.
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += _format_header(metric.name, metric.type_name,
+                                    metric.documentation)
+            lines += metric.render()
+        for collector in self.collectors:
+            for name, type_name, documentation, samples in collector():
+                lines += _format_header(name, type_name, documentation)
+                lines += [_format_sample(name, labels, value)
+                          for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+METRICS_REGISTRY = MetricsRegistry()
+
+REQUEST_DURATION = METRICS_REGISTRY.register(Histogram(
+    "http_request_duration_seconds",
+    "Time to serve HTTP requests, by route template and status.",
+    ("route", "status")))
+REQUESTS_IN_FLIGHT = METRICS_REGISTRY.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being served."))
+MONGO_COMMAND_DURATION = METRICS_REGISTRY.register(Histogram(
+    "mongo_command_duration_seconds",
+    "Duration of Mongo commands as seen by the driver, by collection and command.",
+    ("collection", "command"), buckets=MONGO_DURATION_BUCKETS))
+MONGO_COMMAND_FAILURES = METRICS_REGISTRY.register(Counter(
+    "mongo_command_failures_total",
+    "Mongo commands that failed, by collection and command.",
+    ("collection", "command")))
+EVENT_LOOP_LAG = METRICS_REGISTRY.register(Gauge(
+    "event_loop_lag_seconds",
+    "How late the event loop last ran a timer scheduled by the lag monitor."))
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Times every Mongo command by collection and command name.
+
+    Only the started event names the collection, so it is remembered until
+    the matching succeeded or failed event.
+    """
+
+    def __init__(self):
+        self.collections: dict[tuple[Any, int], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.collections[(event.connection_id, event.request_id)] = \
+            get_command_collection(event.command_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._observe(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._observe(event)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+    def _observe(self, event) -> str:
+        collection = self.collections.pop(
+            (event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(
+            event.duration_micros / 1e6)
+        return collection
+
+
+def get_command_collection(command_name: str, command: dict) -> str:
+    """
+    Collection a command runs against, or "" for database and admin commands.
+    """
+    if command_name == "getMore":
+        value = command.get("collection")
+    else:
+        value = command.get(command_name)
+    return value if isinstance(value, str) else ""
+
+
+MONGO_COMMAND_METRICS = CommandMetricsListener()
+
+
+class RequestMetricsMiddleware:
+    """
+    Tracks in-flight requests and observes their latency by route template
+    and status.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or UNMATCHED_ROUTE
+            REQUEST_DURATION.labels(route_path, str(status)).observe(
+                time.perf_counter() - started)
+
+
+def preallocate_route_metrics(routes: Iterable[Any]) -> None:
+    """
+    Creates the latency series of every route with its success status, so
+    they exist (at zero) before the first request.
+    """
+    for route in routes:
+        if isinstance(route, APIRoute):
+            REQUEST_DURATION.labels(route.path, str(route.status_code or 200))
+
+
+async def monitor_event_loop_lag(
+        interval: float = EVENT_LOOP_LAG_INTERVAL_SECONDS) -> None:
+    """
+    Sleeps `interval` seconds in a loop and records how much later than
+    that the loop woke it up. Runs until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - started - interval))
+
+
+def _collect_pool_metrics() -> Iterable[tuple[str, str, str, Samples]]:
+    stats = POOL_METRICS.snapshot()
+    gauges = ("open_connections", "in_use", "waiting",
+              "checkout_wait_seconds_max")
+    counters = ("checkouts", "checkout_wait_seconds_total",
+                "checkout_timeouts", "checkout_failures")
+    for key in gauges:
+        yield (f"mongo_pool_{key}", "gauge", f"Connection pool {key}.",
+               [({}, stats[key])])
+    for key in counters:
+        name = key if key.endswith("_total") else f"{key}_total"
+        yield (f"mongo_pool_{name}", "counter", f"Connection pool {key}.",
+               [({}, stats[key])])
+
+
+def _collect_compression_metrics() -> Iterable[tuple[str, str, str, Samples]]:
+    stats = COMPRESSION_METRICS.snapshot()
+    encodings = [(encoding, counters) for encoding, counters in stats.items()
+                 if isinstance(counters, dict)]
+    for key, type_name, name in (
+            ("responses", "counter", "http_compressed_responses_total"),
+            ("bytes_in", "counter", "http_compression_bytes_in_total"),
+            ("bytes_out", "counter", "http_compression_bytes_out_total"),
+            ("cpu_seconds", "counter", "http_compression_cpu_seconds_total"),
+            ("ratio", "gauge", "http_compression_ratio")):
+        yield (name, type_name, f"Response compression {key}, by encoding.",
+               [({"encoding": encoding}, counters[key])
+                for encoding, counters in encodings])
+    yield ("http_compression_skipped_total", "counter",
+           "Responses too small to be compressed.", [({}, stats["skipped"])])
+
+
+def _collect_log_metrics() -> Iterable[tuple[str, str, str, Samples]]:
+    yield ("log_records_dropped_total", "counter",
+           "Log records dropped because the writer fell behind.",
+           [({}, get_dropped_log_records())])
+
+
+METRICS_REGISTRY.register_collector(_collect_pool_metrics)
+METRICS_REGISTRY.register_collector(_collect_compression_metrics)
+METRICS_REGISTRY.register_collector(_collect_log_metrics)
+
+
+def _format_header(name: str, type_name: str, documentation: str) -> list[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {type_name}"]
+
+
+def _format_sample(name: str, labels: dict[str, str], value: float) -> str:
+    if not labels:
+        return f"{name} {_format_value(value)}"
+    label_str = ",".join(f'{key}="{_escape_label_value(str(x))}"'
+                         for key, x in labels.items())
+    return f"{name}{{{label_str}}} {_format_value(value)}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,141 @@
+"""
+Per-request counters shared by the request logging middleware and
+whatever runs on behalf of the request.
+
+`RequestLoggingMiddleware` opens a `RequestContext` for every HTTP request
+and stores it in a context variable, which the handlers, dependencies and
+`run_in_db_executor` calls of that request all see (including the pymongo
+event listeners, which run on the executor thread). Code outside a request
+(startup, CLI, tests calling utils directly) finds no context, and the
+recording helpers do nothing.
+
+Requests asking for a `Server-Timing` header (see `utils/server_timing.py`)
+also have their auth, validation and serialization timed, with
+`time_phase`. Phases nest: time spent in an inner phase isn't counted in
+the outer one, so e.g. the encoding of a response model isn't counted
+twice, as validation and as serialization.
+"""
+import functools
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+# phases timed for the Server-Timing header; the endpoint's own code is a
+# phase too, so that it isn't counted as the validation around it
+AUTH_PHASE = "auth"
+VALIDATION_PHASE = "validation"
+SERIALIZATION_PHASE = "serialization"
+ENDPOINT_PHASE = "endpoint"
+
+
+@dataclass
+class RequestContext:
+    request_id: str
+    # the ASGI scope, which gets the matched route once routing is done
+    scope: dict[str, Any] = field(default_factory=dict, repr=False)
+    started: float = field(default_factory=time.perf_counter)
+    # wall time spent awaiting database calls, and how many were made
+    db_seconds: float = 0.0
+    db_round_trips: int = 0
+    # set by the agent polling routes, whose successful requests are sampled
+    agent_poll: bool = False
+    # whether the caller asked for a Server-Timing header; phases are only
+    # timed then
+    server_timing: bool = False
+    # seconds spent in each phase, not counting the phases nested in it
+    phase_seconds: dict[str, float] = field(default_factory=dict)
+    # entered phases, innermost last, with the time they were last resumed
+    phase_stack: list[list] = field(default_factory=list, repr=False)
+
+    def get_elapsed_seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+    def get_route(self) -> Optional[str]:
+        """
+        Template of the matched route, so that ids in the path don't blow
+        up cardinality. None until routing is done, or if nothing matched.
+        """
+        return getattr(self.scope.get("route"), "path", None)
+
+
+REQUEST_CONTEXT: ContextVar[Optional[RequestContext]] = ContextVar(
+    "request_context", default=None)
+
+
+def get_request_context() -> Optional[RequestContext]:
+    return REQUEST_CONTEXT.get()
+
+
+def record_db_call(seconds: float) -> None:
+    """
+    Adds one database round trip to the current request, if any.
+    """
+    context = REQUEST_CONTEXT.get()
+    if context is not None:
+        context.db_seconds += seconds
+        context.db_round_trips += 1
+
+
+@contextmanager
+def time_phase(phase: str) -> Iterator[None]:
+    """
+    Adds the time spent in the block to `phase` of the current request,
+    pausing the phase it is nested in. Does nothing unless the request
+    asked for a Server-Timing header.
+    """
+    context = REQUEST_CONTEXT.get()
+    if context is None or not context.server_timing:
+        yield
+        return
+
+    stack = context.phase_stack
+    now = time.perf_counter()
+    if stack:
+        _charge_phase(context, stack[-1], now)
+    entry = [phase, now]
+    stack.append(entry)
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _charge_phase(context, entry, now)
+        # by identity: tasks of the same request may interleave their phases
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is entry:
+                del stack[i]
+                break
+        if stack:
+            stack[-1][1] = now
+
+
+def timed_phase(phase: str) -> Callable:
+    """
+    Decorator running a coroutine function under `time_phase`. The wrapper
+    keeps the signature, so it works on route dependencies.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with time_phase(phase):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _charge_phase(context: RequestContext, entry: list, now: float) -> None:
+    phase, resumed = entry
+    context.phase_seconds[phase] = context.phase_seconds.get(phase, 0.0) + now - resumed
+    entry[1] = now
+
+
+async def mark_as_agent_poll() -> None:
+    """
+    Route dependency flagging the request as an agent poll, so that its
+    successful responses are logged at `AGENT_POLL_LOG_SAMPLE_RATE`.
+    """
+    context = REQUEST_CONTEXT.get()
+    if context is not None:
+        context.agent_poll = True
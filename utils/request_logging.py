@@ -0,0 +1,84 @@
+"""
+One structured log line per HTTP request.
+
+`RequestLoggingMiddleware` gives every request an id (the caller's
+`X-Request-ID` when it sends one), echoes it back in the response headers,
+and logs the method, route template, status, latency and time spent
+awaiting the database once the response is sent. Successful agent polls
+are sampled at `AGENT_POLL_LOG_SAMPLE_RATE`, errors are always logged.
+
+Logging only enqueues the record (see `config/logs.py`), so nothing here
+waits on the disk.
+"""
+import logging
+import random
+from typing import Optional
+from uuid import uuid4
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.main import AGENT_POLL_LOG_SAMPLE_RATE
+from utils.request_context import REQUEST_CONTEXT, RequestContext
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# longest caller-provided request id kept, longer ones are replaced
+MAX_REQUEST_ID_LENGTH = 128
+
+logger = logging.getLogger("access")
+
+
+class RequestLoggingMiddleware:
+    def __init__(self, app: ASGIApp,
+                 agent_poll_sample_rate: float = AGENT_POLL_LOG_SAMPLE_RATE):
+        self.app = app
+        self.agent_poll_sample_rate = agent_poll_sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        context = RequestContext(request_id=_get_request_id(scope), scope=scope)
+        token = REQUEST_CONTEXT.set(context)
+        status: Optional[int] = None
+
+        async def send_with_request_id(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = context.request_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            REQUEST_CONTEXT.reset(token)
+            # an exception escaping the app turns into a 500 further out
+            self._log(scope, context, status or 500)
+
+    def _log(self, scope: Scope, context: RequestContext, status: int) -> None:
+        sample_rate = 1.0
+        if context.agent_poll and 200 <= status < 300:
+            sample_rate = self.agent_poll_sample_rate
+            if random.random() >= sample_rate:
+                return
+
+        logger.info("request", extra={
+            "request_id": context.request_id,
+            "method": scope["method"],
+            "route": context.get_route(),
+            "status": status,
+            "latency_ms": round(context.get_elapsed_seconds() * 1000, 3),
+            "db_ms": round(context.db_seconds * 1000, 3),
+            "db_round_trips": context.db_round_trips,
+            "sample_rate": sample_rate,
+        })
+
+
+def _get_request_id(scope: Scope) -> str:
+    request_id = Headers(scope=scope).get(REQUEST_ID_HEADER)
+    if request_id and len(request_id) <= MAX_REQUEST_ID_LENGTH:
+        return request_id
+    return uuid4().hex
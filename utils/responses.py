@@ -0,0 +1,34 @@
+"""
+Fast path for serializing trusted read results.
+
+Routes declare a `response_model`, so FastAPI dumps whatever they return,
+validates it against the model again and encodes it. For documents read
+back from our own collections that is pure overhead: they were validated
+when written. `trusted_response` encodes such models with `orjson`
+directly, and the `response_model` is only left to document the route.
+
+`TimedORJSONResponse` is the app's default response class; it counts the
+encoding of the body as serialization in the Server-Timing header.
+"""
+from typing import Any, Optional
+from fastapi.responses import ORJSONResponse
+from models.db.common import BaseModelWithConfig
+from utils.request_context import SERIALIZATION_PHASE, time_phase
+
+
+class TimedORJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        with time_phase(SERIALIZATION_PHASE):
+            return super().render(content)
+
+
+def trusted_response(model: BaseModelWithConfig, status_code: int = 200,
+                     headers: Optional[dict[str, str]] = None) -> ORJSONResponse:
+    """
+    Encodes a model built with `from_trusted` (or `model_construct`)
+    without validating it again.
+    """
+    with time_phase(SERIALIZATION_PHASE):
+        content = model.to_trusted_dict()
+    return TimedORJSONResponse(content, status_code=status_code,
+                               headers=headers)
@@ -0,0 +1,107 @@
+"""
+`Server-Timing` header breaking a request's latency down, for callers who
+ask for it with `X-Debug-Timing: 1`. Normal traffic gets no header, and
+its phases aren't timed.
+
+- `auth`: token checks, user lookups for them and password hashing.
+- `db`: time awaiting database calls, with their number.
+- `validation`: what FastAPI does around the endpoint (reading and
+  validating the request, validating and encoding a returned model).
+- `serialization`: encoding the response body.
+- `total`: everything up to the response headers.
+
+Phases are fed by the helpers in `utils/*` (see `utils/request_context.py`)
+and by `TimedRoute`, the route class of every router. A streamed body is
+encoded after its headers are sent, so it isn't included.
+"""
+import asyncio
+import functools
+from collections.abc import Callable
+
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.request_context import (
+    AUTH_PHASE,
+    ENDPOINT_PHASE,
+    SERIALIZATION_PHASE,
+    VALIDATION_PHASE,
+    RequestContext,
+    get_request_context,
+    time_phase,
+)
+
+DEBUG_TIMING_HEADER = "X-Debug-Timing"
+SERVER_TIMING_HEADER = "Server-Timing"
+
+# phases in the header, in order; the endpoint's own time is left out
+REPORTED_PHASES = (AUTH_PHASE, VALIDATION_PHASE, SERIALIZATION_PHASE)
+
+
+class TimedRoute(APIRoute):
+    """
+    Route timing FastAPI's request handling as validation, and the
+    endpoint as its own phase.
+    """
+
+    def get_route_handler(self) -> Callable:
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            self.dependant.call = _time_endpoint(endpoint)
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            with time_phase(VALIDATION_PHASE):
+                return await handler(request)
+        return timed_handler
+
+
+def _time_endpoint(endpoint: Callable) -> Callable:
+    @functools.wraps(endpoint)
+    async def timed_endpoint(*args, **kwargs):
+        with time_phase(ENDPOINT_PHASE):
+            return await endpoint(*args, **kwargs)
+    return timed_endpoint
+
+
+def format_server_timing(context: RequestContext) -> str:
+    """
+    `Server-Timing` value of the request so far, durations in milliseconds.
+    """
+    metrics = [f"{phase};dur={context.phase_seconds.get(phase, 0.0) * 1000:.3f}"
+               for phase in REPORTED_PHASES]
+    metrics.insert(1, f'db;dur={context.db_seconds * 1000:.3f};'
+                      f'desc="{context.db_round_trips} round trips"')
+    metrics.append(f"total;dur={context.get_elapsed_seconds() * 1000:.3f}")
+    return ", ".join(metrics)
+
+
+class ServerTimingMiddleware:
+    """
+    Turns on phase timing for requests with `X-Debug-Timing: 1`, and adds
+    the `Server-Timing` header to their response. Has to run inside
+    `RequestLoggingMiddleware`, which opens the request context.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        context = get_request_context()
+        if scope["type"] != "http" or context is None or \
+                Headers(scope=scope).get(DEBUG_TIMING_HEADER) != "1":
+            await self.app(scope, receive, send)
+            return
+
+        context.server_timing = True
+
+        async def send_with_server_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)[SERVER_TIMING_HEADER] = \
+                    format_server_timing(context)
+            await send(message)
+
+        await self.app(scope, receive, send_with_server_timing)
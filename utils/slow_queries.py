@@ -0,0 +1,225 @@
+"""
+Log of the Mongo operations slower than `SLOW_QUERY_THRESHOLD_MS`.
+
+`SLOW_QUERY_LOG` is a pymongo `CommandListener` registered on the client.
+It keeps the latest `SLOW_QUERY_LOG_SIZE` slow operations in memory, served
+on `/admin/slow-queries`. Each one has the shape of its filter, with
+values redacted so that no user data ends up in the log, and the route of
+the request that issued it.
+
+The first time a filter shape turns up slow on a collection, the operation
+is explained on a background thread, and the entry records whether the
+winning plan scans the whole collection. Later occurrences reuse that
+answer.
+"""
+import logging
+from collections import deque
+from collections.abc import Callable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+import threading
+from typing import Any, Optional
+
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from config.main import SLOW_QUERY_LOG_SIZE, SLOW_QUERY_THRESHOLD_MS
+from utils.metrics import get_command_collection
+from utils.request_context import get_request_context
+
+# placeholder of every redacted value
+REDACTED = "?"
+
+# field holding the filter of each command that has one; the write
+# commands keep theirs in every statement
+FILTER_FIELDS = {
+    "find": "filter",
+    "aggregate": "pipeline",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+}
+STATEMENT_FIELDS = {"update": "updates", "delete": "deletes"}
+
+# fields the driver adds to a command that can't go inside an explain
+NON_EXPLAINABLE_FIELDS = ("lsid", "$db", "$clusterTime", "$readPreference",
+                          "txnNumber", "autocommit", "startTransaction",
+                          "readConcern", "writeConcern")
+
+# filter shapes whose plan is remembered before the memory is reset
+MAX_EXPLAINED_SHAPES = 1000
+
+
+@dataclass
+class SlowQuery:
+    database: str
+    collection: str
+    command: str
+    duration_ms: float
+    filter_shape: Any
+    route: Optional[str]
+    request_id: Optional[str]
+    failed: bool
+    # None until explained, or if the command can't be
+    collscan: Optional[bool] = None
+    recorded_at: datetime = field(
+        default_factory=lambda: datetime.now(timezone.utc))
+
+
+def get_filter_shape(value: Any) -> Any:
+    """
+    Copy of a filter with every value replaced by `REDACTED`, keeping the
+    field names and operators. Lists collapse to their distinct shapes, so
+    `{"$in": [1, 2, 3]}` becomes `{"$in": ["?"]}`.
+    """
+    if isinstance(value, Mapping):
+        return {key: get_filter_shape(x) for key, x in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for x in value:
+            shape = get_filter_shape(x)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return REDACTED
+
+
+def get_command_filter(command_name: str, command: Mapping) -> Optional[Any]:
+    """
+    Filter of a command (of its first statement, for updates and deletes),
+    or None if it has none.
+    """
+    if command_name in STATEMENT_FIELDS:
+        statements = command.get(STATEMENT_FIELDS[command_name])
+        return statements[0].get("q") if statements else None
+    key = FILTER_FIELDS.get(command_name)
+    return command.get(key) if key else None
+
+
+def build_explain_command(command_name: str, command: Mapping) -> dict:
+    """
+    `explain` of a command as the driver sent it, minus the session and
+    concern fields explain rejects, and only its first statement.
+    """
+    explained = {key: x for key, x in command.items()
+                 if key not in NON_EXPLAINABLE_FIELDS}
+    if command_name in STATEMENT_FIELDS:
+        statements_field = STATEMENT_FIELDS[command_name]
+        explained[statements_field] = explained[statements_field][:1]
+    return {"explain": explained, "verbosity": "queryPlanner"}
+
+
+def is_collscan(plan: Any) -> bool:
+    """
+    Whether an explain output has a collection scan in a winning plan.
+    """
+    if isinstance(plan, Mapping):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(is_collscan(x) for key, x in plan.items()
+                   if key != "rejectedPlans")
+    if isinstance(plan, (list, tuple)):
+        return any(is_collscan(x) for x in plan)
+    return False
+
+
+def _run_explain(database: str, command: dict) -> Mapping:
+    # imported here: config.db registers this module's listener on the client
+    from config.db import get_database
+    return get_database()[database].command(command)
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    """
+    Ring of the latest slow operations, fed by command monitoring.
+
+    Listener callbacks run on the thread issuing the command, so they only
+    remember the command and check the duration. Explains run on their own
+    thread, one at a time.
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+                 size: int = SLOW_QUERY_LOG_SIZE,
+                 explain: Callable[[str, dict], Mapping] = _run_explain):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.lock = threading.Lock()
+        self.entries: deque[SlowQuery] = deque(maxlen=size)
+        # collscan per (database, collection, command, filter shape),
+        # None while the explain is running or if it failed
+        self.plans: dict[tuple[str, str, str, str], Optional[bool]] = {}
+        self.pending: dict[tuple[Any, int], tuple] = {}
+        self.explain_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="slow-query-explain")
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = get_command_collection(event.command_name, event.command)
+        if not collection:
+            return
+        self.pending[(event.connection_id, event.request_id)] = (
+            event.database_name, collection, event.command,
+            get_request_context())
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failed=True)
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        """
+        Returns the logged operations, latest first.
+        """
+        with self.lock:
+            return [asdict(x) for x in reversed(self.entries)]
+
+    def _finish(self, event, failed: bool) -> None:
+        pending = self.pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if pending is None or duration_ms < self.threshold_ms:
+            return
+
+        database, collection, command, context = pending
+        command_filter = get_command_filter(event.command_name, command)
+        filter_shape = (get_filter_shape(command_filter)
+                        if command_filter is not None else None)
+        entry = SlowQuery(
+            database=database, collection=collection,
+            command=event.command_name, duration_ms=duration_ms,
+            filter_shape=filter_shape,
+            route=context.get_route() if context is not None else None,
+            request_id=context.request_id if context is not None else None,
+            failed=failed)
+
+        explainable = event.command_name in FILTER_FIELDS or \
+            event.command_name in STATEMENT_FIELDS
+        key = (database, collection, event.command_name, repr(filter_shape))
+        with self.lock:
+            first_occurrence = key not in self.plans
+            if first_occurrence and explainable:
+                if len(self.plans) >= MAX_EXPLAINED_SHAPES:
+                    self.plans.clear()
+                self.plans[key] = None
+            entry.collscan = self.plans.get(key)
+            self.entries.append(entry)
+
+        if first_occurrence and explainable:
+            self.explain_executor.submit(self._explain, key, entry,
+                                         build_explain_command(event.command_name, command))
+
+    def _explain(self, key: tuple[str, str, str, str], entry: SlowQuery,
+                 explain_command: dict) -> None:
+        try:
+            plan = self.explain(entry.database, explain_command)
+        except PyMongoError as error:
+            logging.warning(f"failed to explain slow {entry.command} on "
+                            f"{entry.collection}: {error}")
+            return
+        collscan = is_collscan(plan)
+        with self.lock:
+            self.plans[key] = collscan
+            entry.collscan = collscan
+
+
+SLOW_QUERY_LOG = SlowQueryLog()
@@ -1,11 +1,16 @@
+import asyncio
+import time
 from typing import Optional
 from uuid import uuid4
 from utils.errors import DefaultDataNotFoundException, InvalidDataException, InvalidPasswordException
-from models.db.user import DbUser, RawUser
+from models.db.user import DbUser, RawUser, UserPrincipal
 from models.routes.users.register_user import RegisterUserRequest
 from models.db.common import Id, EmailStr, RaisesException
-from config.db import get_users_collection
-import bcrypt
+from config.db import get_async_users_collection
+from config.main import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS
+from utils.cache import ExpiringLRUCache
+from utils.etags import VERSION_PROJECTION
+from utils.hashing import hash_secret
 import pymongo.errors as pymongo_exceptions
 import pymongo.results as pymongo_results
 from icecream import ic
@@ -19,44 +24,96 @@ def validate_user_id_or_throw(user_id: Id):
         raise InvalidDataException(detail=msg)
 
 
-def get_db_user_or_throw_if_404(
+async def get_db_user_or_throw_if_404(
         user_identifier: Id | EmailStr) -> DbUser | RaisesException:
-    user = _get_raw_user_or_throw_if_404(user_identifier)
-    return DbUser(**user)
+    user = await _get_raw_user_or_throw_if_404(user_identifier)
+    return DbUser.from_trusted(user)
+
+
+# principals keyed by the user's `_id`
+PRINCIPAL_CACHE = ExpiringLRUCache(max_size=PRINCIPAL_CACHE_SIZE)
+PRINCIPAL_PROJECTION = {"tenant_id": 1, "role_id": 1, "user_type": 1}
+
+
+async def get_principal_or_throw_if_404(
+        user_id: Id) -> UserPrincipal | RaisesException:
+    """
+    Returns the slim principal for the user, serving it from the
+    per-process cache when possible and otherwise fetching only the
+    principal fields.
+
+    Only ids are accepted, so that a user has a single cache entry.
+    Entries live for `PRINCIPAL_CACHE_TTL_SECONDS`; writes to the
+    principal fields must call `invalidate_principal` so this worker
+    sees them right away.
+    """
+    principal = PRINCIPAL_CACHE.get(user_id)
+    if principal is not None:
+        return principal
+
+    users_collection = get_async_users_collection()
+    user = await users_collection.find_one({"_id": user_id},
+                                           PRINCIPAL_PROJECTION)
+    if not user:
+        msg = f"no user found with user identifier: {user_id}"
+        raise DefaultDataNotFoundException(detail=msg)
+
+    principal = UserPrincipal(**user)
+    PRINCIPAL_CACHE.set(principal.get_id(), principal,
+                        expires_at=time.time() + PRINCIPAL_CACHE_TTL_SECONDS)
+    return principal
+
+
+def invalidate_principal(user_id: Id) -> None:
+    PRINCIPAL_CACHE.pop(user_id)
+
+
+async def get_user_version_from_db_or_404(
+        user_identifier: Id | EmailStr) -> RawUser | RaisesException:
+    """
+    Reads only the id and version of the user, for conditional GETs.
+    """
+    user = await _get_raw_user_from_db(user_identifier, VERSION_PROJECTION)
+    if not user:
+        msg = f"no user found with user identifier: {user_identifier}"
+        raise DefaultDataNotFoundException(detail=msg)
+    return user
 
 
-def _get_raw_user_from_db(user_identifier: Id | EmailStr) -> Optional[RawUser]:
-    users_collection = get_users_collection()
+async def _get_raw_user_from_db(
+        user_identifier: Id | EmailStr,
+        projection: Optional[dict] = None) -> Optional[RawUser]:
+    users_collection = get_async_users_collection()
     if "@" in user_identifier:
         filter = {"email": user_identifier}
     else:
         filter = {"_id": user_identifier}
-    user = users_collection.find_one(filter)
+    user = await users_collection.find_one(filter, projection)
     return user
 
 
-def _get_raw_user_or_throw_if_404(
+async def _get_raw_user_or_throw_if_404(
         user_identifier: Id | EmailStr) -> RawUser | RaisesException:
-    user_result = _get_raw_user_from_db(user_identifier)
+    user_result = await _get_raw_user_from_db(user_identifier)
     if user_result is None or not user_result:
         msg = f"no user found with user identifier: {user_identifier}"
         raise DefaultDataNotFoundException(detail=msg)
     return user_result
 
 
-def register_user_to_db(user_register_form: RegisterUserRequest) -> Id:
-    return register_user_to_db_and_get_secrets(user_register_form)[1]
+async def register_user_to_db(user_register_form: RegisterUserRequest) -> Id:
+    return (await register_user_to_db_and_get_secrets(user_register_form))[1]
 
 
-def register_user_to_db_and_get_secrets(
+async def register_user_to_db_and_get_secrets(
         user_register_form: RegisterUserRequest) -> tuple[DbUser, Id, Id]:
-    users_collection = get_users_collection()
+    users_collection = get_async_users_collection()
     encoded_new_pass = user_register_form.raw_password.encode('utf-8')
-    password_hash = str(bcrypt.hashpw(encoded_new_pass, bcrypt.gensalt()))
-
     encoded_secret = user_register_form.raw_user_secret.encode(
         'utf-8') or str(uuid4()).encode('utf-8')
-    user_secret_hash = str(bcrypt.hashpw(encoded_secret, bcrypt.gensalt()))
+
+    password_hash, user_secret_hash = await asyncio.gather(
+        hash_secret(encoded_new_pass), hash_secret(encoded_secret))
 
     db_user = DbUser(
         **{
@@ -69,10 +126,11 @@ def register_user_to_db_and_get_secrets(
 
     db_user_data = db_user.dict()
 
-    logging.info(f"registering user with: {db_user_data}...")
+    # never log the document itself, it holds the secret hashes
+    logging.info(f"registering user {db_user.get_id()}")
 
     try:
-        result = users_collection.insert_one(db_user_data)
+        result = await users_collection.insert_one(db_user_data)
     except pymongo_exceptions.DuplicateKeyError as dupe_error:
         detail = "Invalid user insertion: duplicate email"
         raise exceptions.DefaultDuplicateDataException(
@@ -85,5 +143,5 @@ def register_user_to_db_and_get_secrets(
     return (db_user, user_id, encoded_secret.decode('utf-8'))
 
 
-def check_if_admin_by_id(user_id: Id) -> bool:
+async def check_if_admin_by_id(user_id: Id) -> bool:
     return True
@@ -0,0 +1,85 @@
+"""
+Holds the per-process registry of long-poll waiters, keyed by device id.
+
+A polling request registers a waiter for its device before it looks for
+pending commands, and command creation wakes every waiter registered for
+the devices it enqueued work for. Waiters only live in the memory of the
+worker that created them, so a command created on another worker is picked
+up once the waiting request times out and re-checks the database.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Iterable
+
+from models.db.common import Id
+
+
+class CommandWaiter:
+    """
+    Single parked request waiting for work on a device.
+
+    Remembers the loop it was created on so that it can be woken safely
+    from any thread.
+    """
+
+    def __init__(self, device_id: Id):
+        self.device_id = device_id
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self) -> None:
+        """
+        Thread-safe way of setting the waiter's event.
+        """
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Waits until woken or until `timeout` seconds have passed.
+
+        Returns true if the waiter was woken before the timeout, and
+        re-arms it so it can be waited on again.
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+            self.event.clear()
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+WAITERS: dict[Id, set[CommandWaiter]] = defaultdict(set)
+
+
+def register_command_waiter(device_id: Id) -> CommandWaiter:
+    """
+    Creates a waiter for the given device and registers it so that it
+    is woken by the next `notify_command_waiters` call for that device.
+    """
+    waiter = CommandWaiter(device_id)
+    WAITERS[device_id].add(waiter)
+    return waiter
+
+
+def unregister_command_waiter(waiter: CommandWaiter) -> None:
+    """
+    Removes the waiter from the registry, dropping the device key
+    once no one is waiting on it anymore.
+    """
+    device_waiters = WAITERS.get(waiter.device_id)
+    if device_waiters is None:
+        return
+    device_waiters.discard(waiter)
+    if not device_waiters:
+        WAITERS.pop(waiter.device_id, None)
+
+
+def notify_command_waiters(device_ids: Iterable[Id]) -> None:
+    """
+    Wakes every waiter registered for any of the given device ids.
+    """
+    for device_id in set(device_ids):
+        for waiter in list(WAITERS.get(device_id, ())):
+            waiter.wake()
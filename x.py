@@ -78,6 +78,125 @@ def auto_pep():
     return 0
 
 
+def indexes(repair=False):
+    """
+    Prints the drift between the index registry in `config/indexes.py`
+    and the indexes present in the database.
+
+    If repair is True, also creates the missing indexes.
+    """
+    from config.db import get_index_drift, repair_index_drift
+    drift_dict = repair_index_drift() if repair else get_index_drift()
+
+    for collection_name, drift in drift_dict.items():
+        if not drift.has_drift():
+            print(f"{collection_name}: ok")
+            continue
+        print(f"{collection_name}:")
+        for index_model in drift.missing:
+            action = "created" if repair else "missing"
+            print(f"  {action}: {index_model.document['name']}")
+        for name in drift.changed:
+            print(f"  changed (drop and rerun with --repair): {name}")
+        for name in drift.extra:
+            print(f"  not in registry: {name}")
+
+
+def trim_command_history(batch_size=500):
+    """
+    Migration: trims the `command_ids` of every device down to the
+    configured DEVICE_COMMAND_HISTORY_LIMIT, batch_size devices at a time.
+    Does nothing unless the limit is set.
+    """
+    from utils.devices import trim_device_command_histories
+    trimmed = trim_device_command_histories(batch_size=batch_size)
+    print(f"trimmed command history of {trimmed} devices")
+
+
+def benchmark_serialization(items=1000, rounds=20):
+    """
+    Micro-benchmark of the per-item cost of turning a Mongo reply into the
+    /commands/batch/get/all and /devices/get/all response bodies: decoded
+    to dicts and through FastAPI's validating `response_model` path, and
+    through the trusted `dump_trusted` + orjson path.
+    """
+    import asyncio
+    import time
+    import uuid
+    import bson
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+    from models.db.command import Command
+    from models.db.device import Device
+    from models.routes.commands import BatchAllCommandsResponse
+    from models.routes.devices import GetDevicesResponse
+    from utils.responses import trusted_response
+
+    def new_id():
+        return str(uuid.uuid4())
+
+    commands = [{"_id": new_id(), "status": "Pending", "args": "ls -la",
+                 "name": "ShellCmd", "issuer_id": new_id(),
+                 "device_id": new_id(), "created_at": time.time()}
+                for _ in range(items)]
+    devices = [{"_id": new_id(), "name": f"device-{i}", "user_id": new_id(),
+                "command_ids": [new_id() for _ in range(20)],
+                "metadata": {"os": "linux", "version": "1.0"}}
+               for i in range(items)]
+
+    def validated(reply, response_model, build):
+        field = create_response_field(name="response", type_=response_model)
+
+        def run():
+            content = asyncio.run(serialize_response(
+                field=field, response_content=build(bson.decode_all(reply)),
+                is_coroutine=True))
+            return JSONResponse(content).body
+        return run
+
+    def trusted(reply, build):
+        def run():
+            return trusted_response(build(bson.decode_all(reply))).body
+        return run
+
+    command_reply = b"".join(bson.encode(x) for x in commands)
+    device_reply = b"".join(bson.encode(x) for x in devices)
+
+    def build_commands(documents):
+        return BatchAllCommandsResponse.model_construct(
+            commands=[Command.dump_trusted(x) for x in documents])
+
+    def build_devices(documents):
+        return GetDevicesResponse.model_construct(
+            devices=[Device.dump_trusted(x) for x in documents])
+
+    cases = {
+        "/commands/batch/get/all": (
+            validated(command_reply, BatchAllCommandsResponse,
+                      lambda documents: BatchAllCommandsResponse(
+                          commands=[Command(**x) for x in documents])),
+            trusted(command_reply, build_commands)),
+        "/devices/get/all": (
+            validated(device_reply, GetDevicesResponse,
+                      lambda documents: GetDevicesResponse(
+                          devices=[Device(**x) for x in documents])),
+            trusted(device_reply, build_devices)),
+    }
+
+    for route, paths in cases.items():
+        timings = []
+        for path in paths:
+            started = time.perf_counter()
+            for _ in range(rounds):
+                path()
+            timings.append(
+                (time.perf_counter() - started) / rounds / items * 1e6)
+        print(f"{route}: validated {timings[0]:.2f}us/item, "
+              f"trusted {timings[1]:.2f}us/item "
+              f"({timings[0] / timings[1]:.1f}x)")
+
+
 def testtest(arg=None):
     import requests
     arg = str(arg)
@@ -148,4 +267,6 @@ def testtest(arg=None):
 
 if __name__ == '__main__':
     fire.Fire({'run': run, 'test': test, "lint": lint,
-              "autofmt": auto_pep, "coverage": coverage, "testtest": testtest, "prod": prod})
+              "autofmt": auto_pep, "coverage": coverage, "testtest": testtest, "prod": prod, "indexes": indexes,
+              "trim_command_history": trim_command_history,
+              "benchmark_serialization": benchmark_serialization})